@@ -443,6 +443,16 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                                            'roi_stats_scale4.tsv', self.subject + '_label-L2008_desc-scale4_stats.tsv'),
                                            (
                                            'roi_stats_scale5.tsv', self.subject + '_label-L2008_desc-scale5_stats.tsv'),
+                                           ('roi_index_scale1.npz',
+                                            self.subject + '_label-L2008_desc-scale1_roiindex.npz'),
+                                           ('roi_index_scale2.npz',
+                                            self.subject + '_label-L2008_desc-scale2_roiindex.npz'),
+                                           ('roi_index_scale3.npz',
+                                            self.subject + '_label-L2008_desc-scale3_roiindex.npz'),
+                                           ('roi_index_scale4.npz',
+                                            self.subject + '_label-L2008_desc-scale4_roiindex.npz'),
+                                           ('roi_index_scale5.npz',
+                                            self.subject + '_label-L2008_desc-scale5_roiindex.npz'),
                                            ]
         elif self.parcellation_scheme == 'Lausanne2018':
             sinker.inputs.substitutions = [('T1.nii.gz', self.subject + '_desc-head_T1w.nii.gz'),
@@ -520,6 +530,16 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                                            'roi_stats_scale4.tsv', self.subject + '_label-L2018_desc-scale4_stats.tsv'),
                                            (
                                            'roi_stats_scale5.tsv', self.subject + '_label-L2018_desc-scale5_stats.tsv'),
+                                           ('roi_index_scale1.npz',
+                                            self.subject + '_label-L2018_desc-scale1_roiindex.npz'),
+                                           ('roi_index_scale2.npz',
+                                            self.subject + '_label-L2018_desc-scale2_roiindex.npz'),
+                                           ('roi_index_scale3.npz',
+                                            self.subject + '_label-L2018_desc-scale3_roiindex.npz'),
+                                           ('roi_index_scale4.npz',
+                                            self.subject + '_label-L2018_desc-scale4_roiindex.npz'),
+                                           ('roi_index_scale5.npz',
+                                            self.subject + '_label-L2018_desc-scale5_roiindex.npz'),
                                            ]
         elif self.parcellation_scheme == 'NativeFreesurfer':
             sinker.inputs.substitutions = [('T1.nii.gz', self.subject + '_desc-head_T1w.nii.gz'),
@@ -577,7 +597,7 @@ class AnatomicalPipeline(cmp_common.Pipeline):
             fields=["subjects_dir", "subject_id", "T1", "aseg", "aparc_aseg", "brain", "brain_mask", "csf_mask_file",
                     "wm_mask_file", "gm_mask_file", "wm_eroded", "brain_eroded", "csf_eroded",
                     "roi_volumes", "parcellation_scheme", "atlas_info", "roi_colorLUTs", "roi_graphMLs",
-                    "roi_volumes_stats"]), name="outputnode")
+                    "roi_volumes_stats", "roi_index_files"]), name="outputnode")
         anat_flow.add_nodes([anat_inputnode, anat_outputnode])
         
         anat_flow.connect([
@@ -630,6 +650,7 @@ class AnatomicalPipeline(cmp_common.Pipeline):
                                                   ("outputnode.roi_colorLUTs", "roi_colorLUTs"),
                                                   ("outputnode.roi_graphMLs", "roi_graphMLs"),
                                                   ("outputnode.roi_volumes_stats", "roi_volumes_stats"),
+                                                  ("outputnode.roi_index_files", "roi_index_files"),
                                                   ("outputnode.wm_eroded", "wm_eroded"),
                                                   ("outputnode.gm_mask_file", "gm_mask_file"),
                                                   ("outputnode.csf_mask_file", "csf_mask_file"),
@@ -674,6 +695,7 @@ class AnatomicalPipeline(cmp_common.Pipeline):
             (anat_outputnode, sinker, [("roi_colorLUTs", "anat.@luts")]),
             (anat_outputnode, sinker, [("roi_graphMLs", "anat.@graphmls")]),
             (anat_outputnode, sinker, [("roi_volumes_stats", "anat.@stats")]),
+            (anat_outputnode, sinker, [("roi_index_files", "anat.@roi_index")]),
             (anat_outputnode, sinker, [("brain_eroded", "anat.@brainmask_eroded")]),
             (anat_outputnode, sinker, [("wm_eroded", "anat.@wm_eroded")]),
             (anat_outputnode, sinker, [("csf_eroded", "anat.@csf_eroded")])
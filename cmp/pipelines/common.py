@@ -203,6 +203,7 @@ class Pipeline(HasTraits):
         inputnode = pe.Node(interface=util.IdentityInterface(fields=stage.inputs), name="inputnode")
         outputnode = pe.Node(interface=util.IdentityInterface(fields=stage.outputs), name="outputnode")
         flow.add_nodes([inputnode, outputnode])
+        stage.number_of_cores = self.number_of_cores
         stage.create_workflow(flow, inputnode, outputnode)
         return flow
     
@@ -637,5 +637,10 @@ class fMRIPipeline(Pipeline):
             
             if self.parcellation_scheme == "Custom":
                 fMRI_flow.connect([(fMRI_inputnode, con_flow, [('atlas_info', 'inputnode.atlas_info')])])
+            
+            # ROI time-series already extracted by the fused functional processing
+            func_config = self.stages['FunctionalMRI'].config
+            if func_config.fused_processing and not (func_config.lowpass_filter > 0 or func_config.highpass_filter > 0):
+                fMRI_flow.connect([(func_flow, con_flow, [('outputnode.roi_timeseries', 'inputnode.roi_timeseries')])])
         
         return fMRI_flow
@@ -20,6 +20,7 @@ class Stage(HasTraits):
     inspect_outputs_enum = Enum(values='inspect_outputs')
     inspect_outputs_dict = Dict
     enabled = True
+    number_of_cores = 1
     config = Instance(HasTraits)
     
     def is_running(self):
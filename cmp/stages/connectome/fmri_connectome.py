@@ -47,7 +47,7 @@ class ConnectomeStage(Stage):
         self.name = 'connectome_stage'
         self.config = ConnectomeConfig()
         self.inputs = ["roi_volumes_registered", "func_file", "FD", "DVARS",
-                       "parcellation_scheme", "atlas_info", "roi_graphMLs"]
+                       "parcellation_scheme", "atlas_info", "roi_graphMLs", "roi_timeseries"]
         self.outputs = ["connectivity_matrices", "avg_timeseries"]
     
     def create_workflow(self, flow, inputnode, outputnode):
@@ -60,7 +60,8 @@ class ConnectomeStage(Stage):
         flow.connect([
             (inputnode, cmtk_cmat, [('func_file', 'func_file'), ("FD", "FD"), ("DVARS", "DVARS"),
                                     ('parcellation_scheme', 'parcellation_scheme'), ('atlas_info', 'atlas_info'),
-                                    ('roi_volumes_registered', 'roi_volumes'), ('roi_graphMLs', 'roi_graphmls')]),
+                                    ('roi_volumes_registered', 'roi_volumes'), ('roi_graphMLs', 'roi_graphmls'),
+                                    ('roi_timeseries', 'roi_timeseries')]),
             (cmtk_cmat, outputnode,
              [('connectivity_matrices', 'connectivity_matrices'), ("avg_timeseries", "avg_timeseries")])
         ])
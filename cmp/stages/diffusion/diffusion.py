@@ -253,6 +253,11 @@ class DiffusionStage(Stage):
         if self.config.recon_processing_tool == 'Dipy':
             recon_flow = create_dipy_recon_flow(self.config.dipy_recon_config)
             
+            dipy_csd = recon_flow.get_node('dipy_CSD')
+            if dipy_csd is not None:
+                # Cache of the fitted SH coefficients, reused by the Dipy tractography and later runs
+                dipy_csd.inputs.cache_dir = os.path.join(self.stage_dir, 'csd_cache')
+            
             flow.connect([
                 (inputnode, recon_flow, [('diffusion', 'inputnode.diffusion')]),
                 (inputnode, recon_flow, [('bvals', 'inputnode.bvals')]),
@@ -304,6 +309,11 @@ class DiffusionStage(Stage):
             track_flow = create_dipy_tracking_flow(self.config.dipy_tracking_config)
             # print "Dipy tracking"
             
+            for node_name in ['dipy_deterministic_tracking', 'dipy_probabilistic_tracking']:
+                dipy_tracking = track_flow.get_node(node_name)
+                if dipy_tracking is not None:
+                    dipy_tracking.inputs.cache_dir = os.path.join(self.stage_dir, 'csd_cache')
+            
             if self.config.diffusion_imaging_model != 'DSI':
                 flow.connect([
                     (recon_flow, outputnode, [('outputnode.DWI', 'fod_file')]),
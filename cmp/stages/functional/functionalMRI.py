@@ -22,7 +22,7 @@ from nipype.interfaces import afni
 
 # Own imports
 from cmp.stages.common import Stage
-from cmtklib.functionalMRI import Scrubbing, Detrending, nuisance_regression
+from cmtklib.functionalMRI import Scrubbing, Detrending, nuisance_regression, FusedProcessing
 
 # Imports for processing
 import nibabel as nib
@@ -45,6 +45,10 @@ class FunctionalMRIConfig(HasTraits):
     highpass_filter = Float(0.1)
     
     scrubbing = Bool(True)
+    
+    # Run scrubbing, detrending and nuisance regression in a single node reading the fMRI volume once
+    fused_processing = Bool(False)
+    write_intermediate_files = Bool(False)
 
 
 class FunctionalMRIStage(Stage):
@@ -54,7 +58,7 @@ class FunctionalMRIStage(Stage):
         self.config = FunctionalMRIConfig()
         self.inputs = ["preproc_file", "motion_par_file", "registered_roi_volumes", "registered_wm", "eroded_wm",
                        "eroded_csf", "eroded_brain"]
-        self.outputs = ["func_file", "FD", "DVARS"]
+        self.outputs = ["func_file", "FD", "DVARS", "roi_timeseries"]
     
     def create_workflow(self, flow, inputnode, outputnode):
         
@@ -83,53 +87,82 @@ class FunctionalMRIStage(Stage):
         #                 (smoothing_output,discard_output,[("smoothing_output","discard_output")])
         #                 ])
         # scrubbing_output = pe.Node(interface=util.IdentityInterface(fields=["scrubbing_output"]),name="scrubbing_output")
-        if self.config.scrubbing:
-            scrubbing = pe.Node(interface=Scrubbing(), name='scrubbing')
-            flow.connect([
-                (inputnode, scrubbing, [("preproc_file", "in_file")]),
-                (inputnode, scrubbing, [("registered_wm", "wm_mask")]),
-                (inputnode, scrubbing, [("registered_roi_volumes", "gm_file")]),
-                (inputnode, scrubbing, [("motion_par_file", "motion_parameters")]),
-                (scrubbing, outputnode, [("fd_npy", "FD")]),
-                (scrubbing, outputnode, [("dvars_npy", "DVARS")])
-            ])
-        
-        detrending_output = pe.Node(interface=util.IdentityInterface(fields=["detrending_output"]),
-                                    name="detrending_output")
-        if self.config.detrending:
-            detrending = pe.Node(interface=Detrending(), name='detrending')
-            detrending.inputs.mode = self.config.detrending_mode
-            flow.connect([
-                (inputnode, detrending, [("preproc_file", "in_file")]),
-                (inputnode, detrending, [("registered_roi_volumes", "gm_file")]),
-                (detrending, detrending_output, [("out_file", "detrending_output")])
-            ])
-        else:
-            flow.connect([
-                (inputnode, detrending_output, [("preproc_file", "detrending_output")])
-            ])
-        
         nuisance_output = pe.Node(interface=util.IdentityInterface(fields=["nuisance_output"]), name="nuisance_output")
-        if self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
-            nuisance = pe.Node(interface=nuisance_regression(), name="nuisance_regression")
-            nuisance.inputs.global_nuisance = self.config.global_nuisance
-            nuisance.inputs.csf_nuisance = self.config.csf
-            nuisance.inputs.wm_nuisance = self.config.wm
-            nuisance.inputs.motion_nuisance = self.config.motion
-            nuisance.inputs.n_discard = self.config.discard_n_volumes
+        if self.config.fused_processing:
+            fused = pe.Node(interface=FusedProcessing(), name='fused_processing')
+            fused.inputs.scrubbing = self.config.scrubbing
+            fused.inputs.detrending = self.config.detrending
+            fused.inputs.detrending_mode = self.config.detrending_mode
+            fused.inputs.global_nuisance = self.config.global_nuisance
+            fused.inputs.csf_nuisance = self.config.csf
+            fused.inputs.wm_nuisance = self.config.wm
+            fused.inputs.motion_nuisance = self.config.motion
+            fused.inputs.write_intermediate_files = self.config.write_intermediate_files
+            # ROI time-series can only be extracted here if no temporal filtering follows
+            fused.inputs.compute_roi_timeseries = not (self.config.lowpass_filter > 0 or
+                                                       self.config.highpass_filter > 0)
             flow.connect([
-                (detrending_output, nuisance, [("detrending_output", "in_file")]),
-                (inputnode, nuisance, [("eroded_brain", "brainfile")]),
-                (inputnode, nuisance, [("eroded_csf", "csf_file")]),
-                (inputnode, nuisance, [("registered_wm", "wm_file")]),
-                (inputnode, nuisance, [("motion_par_file", "motion_file")]),
-                (inputnode, nuisance, [("registered_roi_volumes", "gm_file")]),
-                (nuisance, nuisance_output, [("out_file", "nuisance_output")])
+                (inputnode, fused, [("preproc_file", "in_file")]),
+                (inputnode, fused, [("eroded_brain", "brainfile")]),
+                (inputnode, fused, [("eroded_csf", "csf_file")]),
+                (inputnode, fused, [("registered_wm", "wm_file")]),
+                (inputnode, fused, [("motion_par_file", "motion_file")]),
+                (inputnode, fused, [("registered_roi_volumes", "gm_file")]),
+                (fused, nuisance_output, [("out_file", "nuisance_output")]),
+                (fused, outputnode, [("roi_timeseries", "roi_timeseries")])
             ])
+            if self.config.scrubbing:
+                flow.connect([
+                    (fused, outputnode, [("fd_npy", "FD")]),
+                    (fused, outputnode, [("dvars_npy", "DVARS")])
+                ])
         else:
-            flow.connect([
-                (detrending_output, nuisance_output, [("detrending_output", "nuisance_output")])
-            ])
+            if self.config.scrubbing:
+                scrubbing = pe.Node(interface=Scrubbing(), name='scrubbing')
+                flow.connect([
+                    (inputnode, scrubbing, [("preproc_file", "in_file")]),
+                    (inputnode, scrubbing, [("registered_wm", "wm_mask")]),
+                    (inputnode, scrubbing, [("registered_roi_volumes", "gm_file")]),
+                    (inputnode, scrubbing, [("motion_par_file", "motion_parameters")]),
+                    (scrubbing, outputnode, [("fd_npy", "FD")]),
+                    (scrubbing, outputnode, [("dvars_npy", "DVARS")])
+                ])
+            
+            detrending_output = pe.Node(interface=util.IdentityInterface(fields=["detrending_output"]),
+                                        name="detrending_output")
+            if self.config.detrending:
+                detrending = pe.Node(interface=Detrending(), name='detrending')
+                detrending.inputs.mode = self.config.detrending_mode
+                flow.connect([
+                    (inputnode, detrending, [("preproc_file", "in_file")]),
+                    (inputnode, detrending, [("registered_roi_volumes", "gm_file")]),
+                    (detrending, detrending_output, [("out_file", "detrending_output")])
+                ])
+            else:
+                flow.connect([
+                    (inputnode, detrending_output, [("preproc_file", "detrending_output")])
+                ])
+            
+            if self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
+                nuisance = pe.Node(interface=nuisance_regression(), name="nuisance_regression")
+                nuisance.inputs.global_nuisance = self.config.global_nuisance
+                nuisance.inputs.csf_nuisance = self.config.csf
+                nuisance.inputs.wm_nuisance = self.config.wm
+                nuisance.inputs.motion_nuisance = self.config.motion
+                nuisance.inputs.n_discard = self.config.discard_n_volumes
+                flow.connect([
+                    (detrending_output, nuisance, [("detrending_output", "in_file")]),
+                    (inputnode, nuisance, [("eroded_brain", "brainfile")]),
+                    (inputnode, nuisance, [("eroded_csf", "csf_file")]),
+                    (inputnode, nuisance, [("registered_wm", "wm_file")]),
+                    (inputnode, nuisance, [("motion_par_file", "motion_file")]),
+                    (inputnode, nuisance, [("registered_roi_volumes", "gm_file")]),
+                    (nuisance, nuisance_output, [("out_file", "nuisance_output")])
+                ])
+            else:
+                flow.connect([
+                    (detrending_output, nuisance_output, [("detrending_output", "nuisance_output")])
+                ])
         
         filter_output = pe.Node(interface=util.IdentityInterface(fields=["filter_output"]), name="filter_output")
         if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
@@ -194,12 +227,18 @@ class FunctionalMRIStage(Stage):
                 results = pickle.load(gzip.open(res_path))
                 self.inspect_outputs_dict['Smoothed image'] = ['fsleyes', '-sdefault', results.outputs.out_file, '-cm',
                                                                'brain_colours_blackbdy_iso']
-        if self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
+        if self.config.fused_processing:
+            res_path = os.path.join(self.stage_dir, "fused_processing", "result_fused_processing.pklz")
+            if (os.path.exists(res_path)):
+                results = pickle.load(gzip.open(res_path))
+                self.inspect_outputs_dict['Fused processing output'] = ['fsleyes', '-sdefault',
+                                                                        results.outputs.out_file]
+        elif self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
             res_path = os.path.join(self.stage_dir, "nuisance_regression", "result_nuisance_regression.pklz")
             if (os.path.exists(res_path)):
                 results = pickle.load(gzip.open(res_path))
                 self.inspect_outputs_dict['Regression output'] = ['fsleyes', '-sdefault', results.outputs.out_file]
-        if self.config.detrending:
+        if self.config.detrending and not self.config.fused_processing:
             res_path = os.path.join(self.stage_dir, "detrending", "result_detrending.pklz")
             if (os.path.exists(res_path)):
                 results = pickle.load(gzip.open(res_path))
@@ -218,6 +257,8 @@ class FunctionalMRIStage(Stage):
     def has_run(self):
         if self.config.lowpass_filter > 0 or self.config.highpass_filter > 0:
             return os.path.exists(os.path.join(self.stage_dir, "temporal_filter", "result_temporal_filter.pklz"))
+        elif self.config.fused_processing:
+            return os.path.exists(os.path.join(self.stage_dir, "fused_processing", "result_fused_processing.pklz"))
         elif self.config.detrending:
             return os.path.exists(os.path.join(self.stage_dir, "detrending", "result_detrending.pklz"))
         elif self.config.wm or self.config.global_nuisance or self.config.csf or self.config.motion:
@@ -87,7 +87,7 @@ class ParcellationStage(Stage):
             "csf_mask_file",
             "aseg", "aparc_aseg",
             # "cc_unknown_file","ribbon_file","roi_files",
-            "roi_volumes", "roi_colorLUTs", "roi_graphMLs", "roi_volumes_stats",
+            "roi_volumes", "roi_colorLUTs", "roi_graphMLs", "roi_volumes_stats", "roi_index_files",
             "parcellation_scheme", "atlas_info"]
     
     def create_workflow(self, flow, inputnode, outputnode):
@@ -204,6 +204,7 @@ class ParcellationStage(Stage):
                     (parcCombiner, computeROIVolumetry, [("output_rois", "roi_volumes")]),
                     (parcCombiner, computeROIVolumetry, [("graphML_files", "roi_graphMLs")]),
                     (computeROIVolumetry, outputnode, [("roi_volumes_stats", "roi_volumes_stats")]),
+                    (computeROIVolumetry, outputnode, [("roi_index_files", "roi_index_files")]),
                 ])
                 
                 # create_atlas_info = pe.Node(interface=CreateLausanne2018AtlasInfo(),name="create_atlas_info")
@@ -314,6 +315,7 @@ class ParcellationStage(Stage):
                     (parc_node, computeROIVolumetry, [("output_rois", "roi_volumes")]),
                     (parc_files, computeROIVolumetry, [("graphML_files", "roi_graphMLs")]),
                     (computeROIVolumetry, outputnode, [("roi_volumes_stats", "roi_volumes_stats")]),
+                    (computeROIVolumetry, outputnode, [("roi_index_files", "roi_index_files")]),
                 ])
             else:
                 # def get_atlas_LUTs(paths):
@@ -360,6 +362,7 @@ class ParcellationStage(Stage):
                     (parc_node, computeROIVolumetry, [("output_rois", "roi_volumes")]),
                     (parc_files, computeROIVolumetry, [("graphML_files", "roi_graphMLs")]),
                     (computeROIVolumetry, outputnode, [("roi_volumes_stats", "roi_volumes_stats")]),
+                    (computeROIVolumetry, outputnode, [("roi_index_files", "roi_index_files")]),
                 ])
             
             # TODO
@@ -249,7 +249,8 @@ class RegistrationStage(Stage):
             fsl_applyxfm_wm = pe.Node(
                 interface=fsl.ApplyXFM(apply_xfm=True, interp="nearestneighbour", out_file="wm_mask_registered.nii.gz"),
                 name="apply_registration_wm")
-            fsl_applyxfm_rois = pe.Node(interface=ApplymultipleXfm(), name="apply_registration_roivs")
+            fsl_applyxfm_rois = pe.Node(interface=ApplymultipleXfm(nbr_processes=self.number_of_cores),
+                                        name="apply_registration_roivs", n_procs=self.number_of_cores)
             fsl_applyxfm_brain_mask = pe.Node(
                 interface=fsl.ApplyXFM(apply_xfm=True, interp="spline", out_file="brain_mask_registered_temp.nii.gz"),
                 name="apply_registration_brain_mask")
@@ -338,7 +339,8 @@ class RegistrationStage(Stage):
                                           name="apply_warp_brain")
             fsl_applywarp_wm = pe.Node(interface=fsl.ApplyWarp(interp='nn', out_file="wm_mask_warped.nii.gz"),
                                        name="apply_warp_wm")
-            fsl_applywarp_rois = pe.Node(interface=ApplymultipleWarp(interp='nn'), name="apply_warp_roivs")
+            fsl_applywarp_rois = pe.Node(interface=ApplymultipleWarp(interp='nn', nbr_processes=self.number_of_cores),
+                                         name="apply_warp_roivs", n_procs=self.number_of_cores)
             
             flow.connect([
                 (inputnode, fsl_applywarp_T1, [('T1', 'in_file')]),
@@ -811,7 +813,8 @@ class RegistrationStage(Stage):
             fsl_applyxfm_wm = pe.Node(
                 interface=fsl.ApplyXFM(apply_xfm=True, interp="nearestneighbour", out_file="wm_mask_registered.nii.gz"),
                 name="apply_registration_wm")
-            fsl_applyxfm_rois = pe.Node(interface=ApplymultipleXfm(), name="apply_registration_roivs")
+            fsl_applyxfm_rois = pe.Node(interface=ApplymultipleXfm(nbr_processes=self.number_of_cores),
+                                        name="apply_registration_roivs", n_procs=self.number_of_cores)
             
             # TODO apply xfm to gmwmi / 5tt and pves
             
@@ -900,7 +903,8 @@ class RegistrationStage(Stage):
             fsl_applyxfm_wm = pe.Node(
                 interface=fsl.ApplyXFM(apply_xfm=True, interp="nearestneighbour", out_file="wm_mask_registered.nii.gz"),
                 name="apply_registration_wm")
-            fsl_applyxfm_rois = pe.Node(interface=ApplymultipleXfm(), name="apply_registration_roivs")
+            fsl_applyxfm_rois = pe.Node(interface=ApplymultipleXfm(nbr_processes=self.number_of_cores),
+                                        name="apply_registration_roivs", n_procs=self.number_of_cores)
             
             flow.connect([
                 (fs_bbregister, fsl_invertxfm, [('out_fsl_file', 'in_file')]),
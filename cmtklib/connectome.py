@@ -10,6 +10,7 @@ from nipype.interfaces import cmtk
 from traits.api import *
 from os import path as op
 import glob
+import itertools
 import os
 import nibabel
 import nibabel as nib
@@ -17,6 +18,7 @@ import numpy as np
 import networkx as nx
 import scipy.io
 import scipy.io as sio
+import scipy.sparse
 
 import nipype.pipeline.engine as pe
 import nipype.interfaces.mrtrix as mrtrix
@@ -28,8 +30,9 @@ from nipype.interfaces.base import CommandLine, CommandLineInputSpec, traits, \
 
 from nipype.utils.filemanip import split_filename
 
-from util import mean_curvature, length
-from parcellation import get_parcellation
+from util import batched_mean_curvature, batched_length
+from diffusion import read_trk_chunks, write_trk_subset, as_packed_streamlines
+from parcellation import get_parcellation, RoiIndex
 
 
 def group_analysis_sconn(output_dir, subjects_to_be_analyzed):
@@ -41,16 +44,8 @@ def compute_curvature_array(fib):
     """ Computes the curvature array """
     print("Compute curvature ...")
     
-    n = len(fib)
-    pc = -1
-    meancurv = np.zeros((n, 1))
-    for i, fi in enumerate(fib):
-        # Percent counter
-        pcN = int(round(float(100 * i) / n))
-        if pcN > pc and pcN % 1 == 0:
-            pc = pcN
-            print('%4.0f%%' % (pc))
-        meancurv[i, 0] = mean_curvature(fi[0])
+    packed = as_packed_streamlines(fib)
+    meancurv = batched_mean_curvature(packed.points, packed.offsets, packed.lengths).reshape(-1, 1)
     
     return meancurv
 
@@ -118,8 +113,472 @@ def create_endpoints_array(fib, voxelSize, print_info):
     return (endpoints, endpointsmm)
 
 
+def compute_endpoint_voxels(endpoints, shape):
+    """ Convert the endpoints array into integer voxel indices of a volume
+    
+    Parameters
+    ----------
+    endpoints: matrix of size [#fibers, 2, 3] returned by create_endpoints_array
+    shape: 3-tuple containing the shape of the ROI volume
+    
+    Returns
+    -------
+    (inside: boolean array of size [#fibers], False for the fibers with start or
+             endpoint outside the volume
+    vox) : matrix of size [#fibers inside, 2, 3] containing the voxel indices of
+           the start and end points of the fibers inside the volume
+    
+    """
+    # Voxel indices are truncated as int() does, negative indices wrap around
+    # as they do when indexing the volume with Python integers
+    vox = endpoints.astype(np.int64)
+    shape = np.array(shape[:3], dtype=np.int64)
+    inside = np.all((vox >= -shape) & (vox < shape), axis=(1, 2))
+    
+    return inside, vox[inside] % shape
+
+
+def compute_fiber_labels(endpoints, roiData, nROIs, endpoint_voxels=None):
+    """ Label the start and end ROIs of all fibers at once
+    
+    Parameters
+    ----------
+    endpoints: matrix of size [#fibers, 2, 3] returned by create_endpoints_array
+    roiData: 3D array of the ROI volume
+    nROIs: number of regions of the parcellation
+    endpoint_voxels: optional output of compute_endpoint_voxels for the shape of roiData
+    
+    Returns
+    -------
+    (fiberlabels: matrix of size [#fibers, 2] containing the (sorted) start and end
+                  ROIs of each fiber, -1 in the first column for orphan fibers
+    final_fiberlabels_array: matrix of size [#final fibers, 2] containing the labels
+                             of the fibers connecting two ROIs
+    final_fibers_idx: indices of the fibers connecting two ROIs
+    dis: number of orphan fibers
+    outside_idx) : indices of the fibers with start or endpoint outside the volume
+    
+    """
+    n = endpoints.shape[0]
+    fiberlabels = np.zeros((n, 2))
+    
+    if endpoint_voxels is None:
+        endpoint_voxels = compute_endpoint_voxels(endpoints, roiData.shape)
+    inside, vox = endpoint_voxels
+    outside_idx = np.where(~inside)[0]
+    
+    labels = np.zeros((n, 2), dtype=np.int64)
+    labels[inside, 0] = roiData[vox[:, 0, 0], vox[:, 0, 1], vox[:, 0, 2]].astype(np.int64)
+    labels[inside, 1] = roiData[vox[:, 1, 0], vox[:, 1, 1], vox[:, 1, 2]].astype(np.int64)
+    
+    # Filter
+    orphans = inside & ((labels[:, 0] == 0) | (labels[:, 1] == 0))
+    dis = int(np.sum(orphans))
+    fiberlabels[orphans, 0] = -1
+    
+    valid = inside & ~orphans & (labels[:, 0] <= nROIs) & (labels[:, 1] <= nROIs)
+    final_fibers_idx = np.where(valid)[0]
+    
+    # Switch the rois in order to enforce startROI < endROI
+    final_fiberlabels_array = np.sort(labels[final_fibers_idx], axis=1).astype(np.int32)
+    fiberlabels[final_fibers_idx] = final_fiberlabels_array
+    
+    return fiberlabels, final_fiberlabels_array, final_fibers_idx, dis, outside_idx
+
+
+def compute_multiscale_fiber_labels(endpoints, roi_datas, nROIs_list):
+    """ Label the start and end ROIs of all fibers against the ROI volumes of all scales
+    
+    The voxel indices of the endpoints are computed once for all the volumes
+    sharing the same shape, only the ROI lookup is done for each scale.
+    
+    Parameters
+    ----------
+    endpoints: matrix of size [#fibers, 2, 3] returned by create_endpoints_array
+    roi_datas: list of 3D arrays of the ROI volumes
+    nROIs_list: list of the number of regions of each ROI volume
+    
+    Returns
+    -------
+    labels : list of the compute_fiber_labels outputs, one per ROI volume
+    
+    """
+    endpoint_voxels = {}
+    labels = []
+    for roiData, nROIs in zip(roi_datas, nROIs_list):
+        shape = tuple(roiData.shape[:3])
+        if shape not in endpoint_voxels:
+            endpoint_voxels[shape] = compute_endpoint_voxels(endpoints, shape)
+        labels.append(compute_fiber_labels(endpoints, roiData, nROIs, endpoint_voxels[shape]))
+    
+    return labels
+
+
+def stack_scalar_maps(mmapdata):
+    """ Stack the scalar maps sharing the same shape and voxel size
+    
+    Parameters
+    ----------
+    mmapdata: dictionary of (map data, voxel size) tuples
+    
+    Returns
+    -------
+    stacks : list of (map names, [X, Y, Z, #maps] float64 stack, shape, voxel size) tuples
+    
+    """
+    groups = {}
+    for k, vv in mmapdata.items():
+        key = (tuple(vv[0].shape[:3]), tuple(float(z) for z in vv[1][:3]))
+        groups.setdefault(key, []).append(k)
+    stacks = []
+    for (shape, zooms), keys in groups.items():
+        stacks.append((keys, np.stack([mmapdata[k][0].astype(np.float64) for k in keys], axis=-1),
+                       np.array(shape), np.array(zooms)))
+    return stacks
+
+
+def init_fiber_scalar_statistics(keys, n_fibers, n_quantiles=5):
+    """ Return empty per-fiber statistics of the maps keys for n_fibers fibers """
+    fiber_stats = {}
+    for k in keys:
+        fiber_stats[k] = {'count': np.zeros(n_fibers, dtype=np.int64),
+                          'sum': np.zeros(n_fibers),
+                          'sumsq': np.zeros(n_fibers),
+                          'quantiles': np.zeros((n_fibers, n_quantiles), dtype=np.float32)}
+    return fiber_stats
+
+
+def compute_fiber_scalar_statistics(fibers_points, mmapdata, n_fibers, n_quantiles=5, block_size=10000,
+                                    stacks=None):
+    """ Sample all the scalar maps along each fiber in a single walk over the fibers
+    
+    Maps sharing the same shape and voxel size are stacked so that all of them
+    are sampled with a single gather per block of fibers. Only sufficient
+    statistics are kept for each fiber (number of samples, sum and sum of
+    squares of the values) together with n_quantiles evenly spaced quantiles
+    used as an approximate median sketch. Fibers with a point outside of a map
+    are discarded for this map (count set to 0).
+    
+    Parameters
+    ----------
+    fibers_points: iterable over the [#points, 3] arrays of the fiber points (mm)
+    mmapdata: dictionary of (map data, voxel size) tuples
+    n_fibers: number of fibers
+    n_quantiles: number of quantiles stored per fiber for the median sketch
+    block_size: number of fibers sampled together
+    stacks: maps stacked by stack_scalar_maps(mmapdata), to share them between
+            calls on successive blocks of a tractogram (stacked here if None)
+    
+    Returns
+    -------
+    fiber_stats : dictionary containing for each map a dictionary with the
+                  'count', 'sum', 'sumsq' arrays of size [#fibers] and the
+                  'quantiles' matrix of size [#fibers, n_quantiles]
+    
+    """
+    if stacks is None:
+        stacks = stack_scalar_maps(mmapdata)
+    
+    fiber_stats = init_fiber_scalar_statistics(mmapdata.keys(), n_fibers, n_quantiles)
+    if len(stacks) == 0:
+        return fiber_stats
+    
+    quantile_levels = (np.arange(n_quantiles) + 0.5) / n_quantiles
+    
+    block_start = 0
+    fibers_points = iter(fibers_points)
+    while block_start < n_fibers:
+        block = [np.asarray(points) for points in itertools.islice(fibers_points, block_size)]
+        if len(block) == 0:
+            break
+        block_idx = np.arange(block_start, block_start + len(block))
+        lengths = np.array([len(points) for points in block])
+        not_empty = lengths > 0
+        points = np.concatenate(block).reshape(-1, 3)
+        fiber_of_point = np.repeat(np.arange(len(block)), lengths)
+        offsets = np.r_[0, np.cumsum(lengths)[:-1]]
+        
+        for keys, stack, shape, zooms in stacks:
+            # retrieve indices, a fiber is discarded if one of its points is outside the map
+            coords = points / zooms
+            point_inside = np.all((coords > -1) & (coords < shape), axis=1)
+            fiber_inside = not_empty & (np.bincount(fiber_of_point, weights=~point_inside,
+                                                    minlength=len(block)) == 0)
+            for i in block_idx[~fiber_inside & not_empty]:
+                print("  ... ERROR - Index error occured when trying extract scalar values for measures", keys)
+                print("  ... ERROR - Discard fiber with index", i)
+            
+            vox = np.clip(coords, 0, shape - 1).astype(np.int64)
+            values = stack[vox[:, 0], vox[:, 1], vox[:, 2]]
+            
+            valid = fiber_inside[not_empty]
+            valid_idx = block_idx[not_empty][valid]
+            valid_lengths = lengths[not_empty][valid]
+            valid_offsets = offsets[not_empty]
+            for m, k in enumerate(keys):
+                val = values[:, m]
+                stats = fiber_stats[k]
+                stats['count'][valid_idx] = valid_lengths
+                stats['sum'][valid_idx] = np.add.reduceat(val, valid_offsets)[valid] if len(valid_offsets) else []
+                stats['sumsq'][valid_idx] = np.add.reduceat(val ** 2, valid_offsets)[valid] if len(valid_offsets) else []
+                
+                # approximate median sketch: quantiles of the values sorted inside each fiber
+                sorted_val = val[np.lexsort((val, fiber_of_point))]
+                positions = offsets[fiber_inside][:, None] + np.floor(
+                    quantile_levels[None, :] * lengths[fiber_inside][:, None]).astype(np.int64)
+                stats['quantiles'][valid_idx] = sorted_val[positions]
+        
+        block_start += len(block)
+    
+    return fiber_stats
+
+
+def compute_edge_scalar_measures(fiber_stats, fibers_idx, order, starts, counts):
+    """ Aggregate the per-fiber scalar statistics over the fibers of each edge
+    
+    Parameters
+    ----------
+    fiber_stats: per-fiber statistics returned by compute_fiber_scalar_statistics
+    fibers_idx: indices of the final fibers
+    order, starts, counts: edge grouping returned by group_fibers_by_edge
+    
+    Returns
+    -------
+    edge_measures : dictionary of arrays of size [#edges] with the mean, std and
+                    (approximate) median of each map
+    
+    """
+    n_edges = len(starts)
+    edge_of_fiber = np.repeat(np.arange(n_edges), counts)
+    fibers_idx = np.asarray(fibers_idx)[order]
+    
+    edge_measures = {}
+    for k, stats in fiber_stats.items():
+        mean = np.zeros(n_edges)
+        std = np.zeros(n_edges)
+        median = np.zeros(n_edges)
+        if n_edges > 0:
+            count = np.add.reduceat(stats['count'][fibers_idx], starts).astype(np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.add.reduceat(stats['sum'][fibers_idx], starts) / count
+                std = np.sqrt(np.maximum(np.add.reduceat(stats['sumsq'][fibers_idx], starts) / count - mean ** 2, 0))
+            
+            # weighted median of the quantiles of the fibers of each edge,
+            # each quantile standing for an equal share of the fiber samples
+            quantiles = stats['quantiles'][fibers_idx]
+            n_quantiles = quantiles.shape[1]
+            values = quantiles.ravel()
+            weights = np.repeat(stats['count'][fibers_idx] / float(n_quantiles), n_quantiles)
+            edges = np.repeat(edge_of_fiber, n_quantiles)
+            sort_idx = np.lexsort((values, edges))
+            cum_weights = np.cumsum(weights[sort_idx])
+            edge_weights = np.bincount(edges, weights=weights, minlength=n_edges)
+            edge_offsets = np.r_[0, np.cumsum(edge_weights)[:-1]]
+            pos = np.searchsorted(cum_weights, edge_offsets + 0.5 * edge_weights, side='left')
+            median = values[sort_idx][np.minimum(pos, len(values) - 1)].astype(np.float64)
+            median[count == 0] = np.nan
+        
+        edge_measures[k + '_mean'] = mean
+        edge_measures[k + '_std'] = std
+        edge_measures[k + '_median'] = median
+    
+    return edge_measures
+
+
+def group_fibers_by_edge(final_fiberlabels_array):
+    """ Group the final fibers by edge with a single sort on an encoded (u,v) key
+    
+    Parameters
+    ----------
+    final_fiberlabels_array: matrix of size [#final fibers, 2] of sorted (u,v) labels
+    
+    Returns
+    -------
+    (edges: matrix of size [#edges, 2] containing the (u,v) labels of each edge
+    order: stable permutation of the final fibers grouping them by edge
+    starts: index in order of the first fiber of each edge
+    counts) : number of fibers of each edge
+    
+    """
+    labels = np.asarray(final_fiberlabels_array, dtype=np.int64).reshape(-1, 2)
+    keys = labels[:, 0] * (labels.max() + 1 if len(labels) > 0 else 1) + labels[:, 1]
+    
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(keys) > 0 else np.zeros(0, int)
+    counts = np.diff(np.r_[starts, len(keys)])
+    edges = labels[order[starts]]
+    
+    return edges, order, starts, counts
+
+
+def compute_edge_measures(final_fiberlength_array, edges, order, starts, counts, roi_volumes, total_volume):
+    """ Compute the fiber number, length and density measures of all edges in a single pass
+    
+    Parameters
+    ----------
+    final_fiberlength_array: array of size [#final fibers] containing the fiber lengths
+    edges, order, starts, counts: edge grouping returned by group_fibers_by_edge
+    roi_volumes: array containing the volume of each ROI, indexed by ROI label
+    total_volume: total volume of the connected ROIs
+    
+    Returns
+    -------
+    edge_measures : dictionary of arrays of size [#edges], one per measure
+    
+    """
+    total_fibers = float(np.sum(counts))
+    
+    lengths = np.asarray(final_fiberlength_array, dtype=np.float64)[order]
+    
+    mean = np.zeros(len(edges))
+    std = np.zeros(len(edges))
+    median = np.zeros(len(edges))
+    if len(edges) > 0:
+        mean = np.add.reduceat(lengths, starts) / counts
+        std = np.sqrt(np.add.reduceat((lengths - np.repeat(mean, counts)) ** 2, starts) / counts)
+        # sort the lengths inside each edge to take the middle values
+        lengths = lengths[np.lexsort((lengths, np.repeat(np.arange(len(edges)), counts)))]
+        median = 0.5 * (lengths[starts + (counts - 1) // 2] + lengths[starts + counts // 2])
+    
+    # Compute density
+    # density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
+    pair_volumes = roi_volumes[edges[:, 0]] + roi_volumes[edges[:, 1]] if len(edges) > 0 else np.zeros(0)
+    positive = mean > 0.0
+    fiber_density = np.zeros(len(edges))
+    normalized_fiber_density = np.zeros(len(edges))
+    fiber_density[positive] = (counts[positive] / mean[positive]) * (2.0 / pair_volumes[positive])
+    normalized_fiber_density[positive] = ((counts[positive] / total_fibers) / mean[positive]) * (
+        (2.0 * float(total_volume)) / pair_volumes[positive])
+    
+    return {'number_of_fibers': counts,
+            'fiber_length_mean': mean,
+            'fiber_length_median': median,
+            'fiber_length_std': std,
+            'fiber_proportion': 100.0 * (counts / total_fibers) if total_fibers > 0 else np.zeros(len(edges)),
+            'fiber_density': fiber_density,
+            'normalized_fiber_density': normalized_fiber_density}
+
+
+def compute_edge_matrices(edges, edge_measures, nodelist, sparse=False):
+    """ Build the symmetric connectivity matrices directly from the edge measures
+    
+    Parameters
+    ----------
+    edges: matrix of size [#edges, 2] containing the (u,v) labels of each edge
+    edge_measures: dictionary of arrays of size [#edges], one per measure
+    nodelist: list of node labels giving the row/column order of the matrices
+    sparse: return scipy.sparse CSR matrices instead of dense arrays
+    
+    Returns
+    -------
+    matrices : dictionary of [#nodes, #nodes] matrices, one per measure
+    
+    """
+    node_index = dict((int(u), i) for i, u in enumerate(nodelist))
+    size = len(nodelist)
+    rows = np.array([node_index[int(u)] for u in edges[:, 0]], dtype=np.int64)
+    cols = np.array([node_index[int(v)] for v in edges[:, 1]], dtype=np.int64)
+    off_diag = rows != cols
+    sym_rows = np.concatenate([rows, cols[off_diag]])
+    sym_cols = np.concatenate([cols, rows[off_diag]])
+    
+    matrices = {}
+    for key, values in edge_measures.items():
+        values = np.asarray(values, dtype=np.float64)
+        sym_values = np.concatenate([values, values[off_diag]])
+        if sparse:
+            matrices[key] = scipy.sparse.csr_matrix((sym_values, (sym_rows, sym_cols)), shape=(size, size))
+        else:
+            matrices[key] = np.zeros((size, size))
+            matrices[key][sym_rows, sym_cols] = sym_values
+    
+    return matrices
+
+
+def compute_roi_statistics(roiData, nROIs, fdata=None):
+    """ Compute the volume, centroid and average time-series of all the ROIs in one pass
+    
+    The labels are used as indices of a sparse ROI indicator matrix, so that
+    the volumes and centroids are obtained with np.bincount and the average
+    time-series with a single sparse product over the voxels x time matrix,
+    instead of scanning the whole volume once per ROI.
+    
+    Parameters
+    ----------
+    roiData: 3D volume of ROI labels
+    nROIs: number of ROIs, labelled from 1 to nROIs
+    fdata: optional 4D volume of the same spatial shape as roiData
+    
+    Returns
+    -------
+    volumes : array of size [max label + 1] containing the number of voxels of each label
+    centroids : matrix of size [max label + 1, 3] containing the mean voxel coordinates
+                of each label (NaN for labels absent from the volume)
+    ts : matrix of size [nROIs, #timepoints] containing the average time-series of
+         ROIs 1 to nROIs (NaN for empty ROIs), or None if fdata is not given
+    
+    """
+    # follow the memory layout of the 4D data so that it is not copied
+    order = 'F' if np.isfortran(fdata if fdata is not None else roiData) else 'C'
+    labels = np.asarray(roiData).ravel(order=order).astype(np.int64)
+    n_labels = max(int(nROIs), int(labels.max()) if labels.size > 0 else 0) + 1
+    
+    volumes = np.bincount(labels, minlength=n_labels)
+    coords = np.unravel_index(np.arange(labels.size), roiData.shape, order=order)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroids = np.column_stack([np.bincount(labels, weights=c, minlength=n_labels) / volumes
+                                     for c in coords])
+    
+    if fdata is None:
+        return volumes, centroids, None
+    
+    tp = fdata.shape[3]
+    # (voxels x time) view of the 4D data, flattened in the same order as the labels
+    fdata_2d = fdata.reshape((-1, tp), order=order)
+    in_roi = np.flatnonzero((labels >= 1) & (labels <= nROIs))
+    indicator = scipy.sparse.csr_matrix((np.ones(len(in_roi)), (labels[in_roi] - 1, in_roi)),
+                                        shape=(int(nROIs), labels.size))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ts = indicator.dot(fdata_2d) / volumes[1:int(nROIs) + 1][:, np.newaxis]
+    
+    return volumes, centroids, ts.astype(np.float32)
+
+
+def compute_correlation_matrix(ts):
+    """ Compute the Pearson correlation matrix of the ROI time-series
+    
+    The time-series are standardized once and all the pairwise correlations are
+    obtained with a single matrix product, which gives the same values as
+    np.corrcoef for each pair of ROIs.
+    
+    Parameters
+    ----------
+    ts: matrix of size [#rois, #timepoints] containing the ROI average time-series
+    
+    Returns
+    -------
+    fmat : matrix of size [#rois, #rois] containing the correlation coefficients
+    
+    """
+    ts = np.asarray(ts, dtype=np.float64)
+    ts = ts - ts.mean(axis=1)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ts = ts / np.sqrt(np.sum(ts ** 2, axis=1))[:, np.newaxis]
+    fmat = np.dot(ts, ts.T)
+    return np.clip(fmat, -1, 1, out=fmat)
+
+
 def save_fibers(oldhdr, oldfib, fname, indices):
-    """ Stores a new trackvis file fname using only given indices """
+    """ Stores a new trackvis file fname using only given indices
+    
+    oldfib is either the list of fibers or the trackvis file they are streamed from.
+    """
+    
+    if isinstance(oldfib, basestring):
+        print("Writing final no orphan fibers: %s" % fname)
+        write_trk_subset(oldfib, fname, indices, hdr=oldhdr)
+        return
     
     hdrnew = oldhdr.copy()
     
@@ -135,7 +594,7 @@ def save_fibers(oldhdr, oldfib, fname, indices):
 
 
 def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvature=True, additional_maps={},
-         output_types=['gPickle'], atlas_info={}):
+         output_types=['gPickle'], atlas_info={}, chunk_size=100000):
     """ Create the connection matrix for each resolution using fibers and ROIs. """
     
     print("========================")
@@ -148,11 +607,6 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     curv_fname = 'meancurvature.npy'
     # intrk = op.join(gconf.get_cmp_fibers(), 'streamline_filtered.trk')
     print('... tractogram :' + intrk)
-    fib, hdr = nibabel.trackvis.read(intrk, False)
-    
-    # print "Header trackvis : ",hdr
-    # print "Header trackvis id_string : ",hdr['id_string']
-    # print "Fibers trackvis : ",fib
     
     print('... parcellation : %s' % parcellation_scheme)
     
@@ -201,19 +655,94 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
     firstROI = nibabel.load(firstROIFile)
     roiVoxelSize = firstROI.get_header().get_zooms()
     
-    # print "roi Voxel Size",roiVoxelSize
-    (endpoints, endpointsmm) = create_endpoints_array(fib, roiVoxelSize, True)
+    mmap = additional_maps
+    mmapdata = {}
+    print('  >> Maps to be processed :')
+    for k, v in mmap.items():
+        print("     - %s map" % k)
+        da = nibabel.load(v)
+        mdata = da.get_data()
+        print(mdata.max())
+        mdata = np.nan_to_num(mdata)
+        print(mdata.max())
+        mmapdata[k] = (mdata, da.get_header().get_zooms())
+    
+    # print("mmapdata size : %g " % len(mmapdata.items()))
+    
+    # The maps are stacked once and sampled by every block of fibers
+    map_stacks = stack_scalar_maps(mmapdata)
+    
+    # The fiber geometry is the same for all resolutions: endpoints, lengths and
+    # scalar map statistics are computed once and only the ROI lookup is done per resolution.
+    # The tractogram is streamed by blocks of fibers so that it is never entirely loaded in memory
+    print("  >> Compute fiber endpoints, lengths and measures")
+    fib_chunks, hdr = read_trk_chunks(intrk, chunk_size)
+    endpoints_chunks = [np.zeros((0, 2, 3))]
+    endpointsmm_chunks = [np.zeros((0, 2, 3))]
+    meancurv_chunks = [np.zeros((0, 1))]
+    fiberlength_chunks = [np.zeros(0)]
+    fiber_stats_chunks = [init_fiber_scalar_statistics(mmapdata.keys(), 0)]
+    n = 0
+    for chunk in fib_chunks:
+        # print "roi Voxel Size",roiVoxelSize
+        (chunk_endpoints, chunk_endpointsmm) = create_endpoints_array(chunk, roiVoxelSize, False)
+        endpoints_chunks.append(chunk_endpoints)
+        endpointsmm_chunks.append(chunk_endpointsmm)
+        
+        # only compute curvature if required
+        packed = as_packed_streamlines(chunk)
+        if compute_curvature:
+            meancurv_chunks.append(
+                batched_mean_curvature(packed.points, packed.offsets, packed.lengths).reshape(-1, 1))
+        
+        fiberlength_chunks.append(batched_length(packed.points, packed.offsets, packed.lengths))
+        
+        # prepare: compute the measures
+        fiber_stats_chunks.append(compute_fiber_scalar_statistics((fi[0] for fi in chunk), mmapdata, len(chunk),
+                                                                  stacks=map_stacks))
+        
+        n += len(chunk)
+        print("     %i fibers processed" % n)
+    
+    endpoints = np.concatenate(endpoints_chunks)
+    endpointsmm = np.concatenate(endpointsmm_chunks)
     np.save(en_fname, endpoints)
     np.save(en_fnamemm, endpointsmm)
     
-    # only compute curvature if required
     if compute_curvature:
-        meancurv = compute_curvature_array(fib)
+        meancurv = np.concatenate(meancurv_chunks)
         np.save(curv_fname, meancurv)
     
-    print("========================")
+    fiberlength_array = np.concatenate(fiberlength_chunks)
     
-    n = len(fib)
+    fiber_stats = {}
+    for k in mmapdata.keys():
+        fiber_stats[k] = {}
+        for stat in ['count', 'sum', 'sumsq', 'quantiles']:
+            fiber_stats[k][stat] = np.concatenate([chunk_stats[k][stat] for chunk_stats in fiber_stats_chunks])
+    del endpoints_chunks, endpointsmm_chunks, meancurv_chunks, fiberlength_chunks, fiber_stats_chunks, map_stacks
+    
+    # Open the corresponding ROI of each resolution (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
+    roi_fnames = {}
+    for parkey, parval in resolutions.items():
+        for vol in roi_volumes:
+            # print parkey
+            if (parkey in vol) or (len(roi_volumes) == 1):
+                roi_fname = vol
+                # print roi_fname
+        roi_fnames[parkey] = roi_fname
+    
+    rois = dict((parkey, nibabel.load(roi_fnames[parkey])) for parkey in resolutions.keys())
+    roi_datas = dict((parkey, roi.get_data()) for parkey, roi in rois.items())
+    
+    # Label the fibers against the ROI volumes of all resolutions in one pass
+    print("  >> Label fibers for all resolutions (%s fibers)" % n)
+    parkeys = list(resolutions.keys())
+    multiscale_fiberlabels = dict(zip(parkeys, compute_multiscale_fiber_labels(
+        endpoints, [roi_datas[parkey] for parkey in parkeys],
+        [resolutions[parkey]['number_of_regions'] for parkey in parkeys])))
+    
+    print("========================")
     
     # resolution = gconf.parcellation.keys()
     
@@ -228,23 +757,9 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
         print("Resolution = " + parkey)
         print("------------------------")
         
-        # create empty fiber label array
-        fiberlabels = np.zeros((n, 2))
-        final_fiberlabels = []
-        final_fibers_idx = []
-        
-        # Open the corresponding ROI (scale1 for lausanne2008/18) (first volume for nativefreesurfer)
-        
-        # print("Open the corresponding ROI")
-        for vol in roi_volumes:
-            # print parkey
-            if (parkey in vol) or (len(roi_volumes) == 1):
-                roi_fname = vol
-                # print roi_fname
-        # roi_fname = roi_volumes[r]
-        # r += 1
-        roi = nibabel.load(roi_fname)
-        roiData = roi.get_data()
+        roi = rois[parkey]
+        roiData = roi_datas[parkey]
+        roi_index = RoiIndex.from_volume(roiData)
         affine_vox_to_world = np.matrix(roi.affine[:3, :3])
         
         # print "roiData shape : %s " % roiData.shape
@@ -284,23 +799,16 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
             # compute a position for the node based on the mean position of the
             # ROI in voxel coordinates (segmentation volume )
             if parcellation_scheme != "Lausanne2018":
-                G.node[int(u)]['dn_position'] = tuple(
-                    np.mean(np.where(roiData == int(d["dn_correspondence_id"])), axis=1))
-                G.node[int(u)]['roi_volume'] = np.sum(roiData == int(d["dn_correspondence_id"]))
+                G.node[int(u)]['dn_position'] = tuple(roi_index.centroid(int(d["dn_correspondence_id"])))
+                G.node[int(u)]['roi_volume'] = roi_index.voxel_count(int(d["dn_correspondence_id"]))
                 # print "Add node %g - roi volume : %g " % (int(u),np.sum( roiData== int(d["dn_correspondence_id"]) ))
                 # Store parcellation labels corresponding to thalamic nuclei
                 # if gp.node[int(u)]['dn_fsname'] == 'thalamus':
                 #     thalamic_labels.append(int(u))
             else:
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-                G.node[int(u)]['dn_position'] = tuple(np.mean(np.where(roiData == int(d["dn_multiscaleID"])), axis=1))
-                G.node[int(u)]['roi_volume'] = np.sum(roiData == int(d["dn_multiscaleID"]))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
+                G.node[int(u)]['dn_position'] = tuple(roi_index.centroid(int(d["dn_multiscaleID"])))
+                G.node[int(u)]['roi_volume'] = roi_index.voxel_count(int(d["dn_multiscaleID"]))
                 # print "Add node %g - roi volume (2018): %g " % (int(u),np.sum( roiData== int(d["dn_multiscaleID"]) ))
-                # if int(u) == 53:
-                #    print("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
         
         thalamic_labels = np.array(thalamic_labels)
         print("  ************************")
@@ -308,99 +816,23 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
         print('  {}'.format(thalamic_labels))
         print("  ************************")
         
-        dis = 0
+        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
+        # ROI start => ROI end (endpoints from create_endpoints_array)
+        fiberlabels, final_fiberlabels_array, final_fibers_idx, dis, outside_idx = multiscale_fiberlabels[parkey]
+        for i in outside_idx:
+            print(
+                        "... ERROR: An index error occured for fiber %s. This means that the fiber start or endpoint is outside the volume. Continue." % i)
         
-        # prepare: compute the measures
-        t = [c[0] for c in fib]
-        h = np.array(t, dtype=np.object)
-        
-        mmap = additional_maps
-        mmapdata = {}
-        print('  >> Maps to be processed :')
-        for k, v in mmap.items():
-            print("     - %s map" % k)
-            da = nibabel.load(v)
-            mdata = da.get_data()
-            print(mdata.max())
-            mdata = np.nan_to_num(mdata)
-            print(mdata.max())
-            mmapdata[k] = (mdata, da.get_header().get_zooms())
-        
-        # print("mmapdata size : %g " % len(mmapdata.items()))
+        # TODO: Refine fibers ending in thalamus
+        # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
+        # Extract all thalamic nuclei the fiber is passing through
         
-        print("  ************************")
+        # Refine start/endROI connecting to the most probable nucleus
         
-        print("  >> Processing fibers and computing metrics (%s fibers)" % n)
-        pc = -1
-        for i in range(n):  # n: number of fibers
-            
-            # Percent counter
-            pcN = int(round(float(100 * i) / n))
-            if pcN > pc and pcN % 10 == 0:
-                pc = pcN
-                print('%4.0f%%' % (pc))
-            
-            # ROI start => ROI end
-            try:
-                startvox = np.zeros((3, 1)).astype(int)
-                startvox[0] = np.int(endpoints[i, 0, 0])
-                startvox[1] = np.int(endpoints[i, 0, 1])
-                startvox[2] = np.int(endpoints[i, 0, 2])
-                
-                endvox = np.zeros((3, 1)).astype(int)
-                endvox[0] = np.int(endpoints[i, 1, 0])
-                endvox[1] = np.int(endpoints[i, 1, 1])
-                endvox[2] = np.int(endpoints[i, 1, 2])
-                
-                ##print "start point : ",startvox
-                ##print "end point : ",endvox
-                ##print "roi data shape : ",roiData.shape
-                
-                startROI = int(roiData[startvox[0], startvox[1], startvox[2]])  # endpoints from create_endpoints_array
-                endROI = int(roiData[endvox[0], endvox[1], endvox[2]])
-            
-            except IndexError:
-                print(
-                            "... ERROR: An index error occured for fiber %s. This means that the fiber start or endpoint is outside the volume. Continue." % i)
-                continue
-            
-            # Filter
-            if startROI == 0 or endROI == 0:
-                dis += 1
-                fiberlabels[i, 0] = -1
-                continue
-            
-            if startROI > nROIs or endROI > nROIs:
-                #                print("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-                #                print("than is expected by the parcellation node information.")
-                #                print("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-                #                print("This needs bugfixing!")
-                continue
-            
-            # Switch the rois in order to enforce startROI < endROI
-            if endROI < startROI:
-                tmp = startROI
-                startROI = endROI
-                endROI = tmp
-            
-            # TODO: Refine fibers ending in thalamus
-            # if (startROI in thalamic_labels) or (endROI in thalamic_labels):
-            # Extract all thalamic nuclei the fiber is passing through
-            
-            # Refine start/endROI connecting to the most probable nucleus
-            
-            # Update fiber label
-            fiberlabels[i, 0] = startROI
-            fiberlabels[i, 1] = endROI
-            
-            final_fiberlabels.append([startROI, endROI])
-            final_fibers_idx.append(i)
-            
-            # Add edge to graph
-            if G.has_edge(startROI, endROI):
-                G[startROI][endROI]['fiblist'].append(i)
-            else:
-                G.add_edge(startROI, endROI, fiblist=[i])
+        # Group the fibers by edge and add the edges to the graph, in the order the fibers first connect them
+        edges, edge_fibers_order, edge_starts, edge_counts = group_fibers_by_edge(final_fiberlabels_array)
+        for e in np.argsort(edge_fibers_order[edge_starts]):
+            G.add_edge(int(edges[e, 0]), int(edges[e, 1]))
         
         print(
                     "  ... INFO - Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (
@@ -412,106 +844,38 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
         # print "roiData shape : ",roiData.shape
         
         # create a final fiber length array
-        finalfiberlength = []
-        for idx in final_fibers_idx:
-            # compute length of fiber
-            finalfiberlength.append(length(fib[idx][0]))
-        
-        # convert to array
-        final_fiberlength_array = np.array(finalfiberlength)
-        
-        # make final fiber labels as array
-        final_fiberlabels_array = np.array(final_fiberlabels, dtype=np.int32)
+        final_fiberlength_array = fiberlength_array[final_fibers_idx]
         
-        total_fibers = 0
         total_volume = 0
         u_old = -1
-        for u, v, d in G.edges(data=True):
-            total_fibers += len(d['fiblist'])
+        for u, v in G.edges():
             if u != u_old:
                 # print("Node %i"%int(u))
                 # print(G.node[int(u)])
                 total_volume += G.node[int(u)]['roi_volume']
             u_old = u
         
+        # node volumes indexed by ROI label
+        node_volumes = np.zeros(int(max([nROIs] + [int(u) for u in G.nodes()])) + 1)
+        for u, d in G.nodes(data=True):
+            node_volumes[int(u)] = d['roi_volume']
+        
         # update edges
         # measures to add here
         # FIXME treat case of self-connection that gives di['fiber_length_mean'] = 0.0
-        for u, v, d in G.edges(data=True):
-            G.remove_edge(u, v)
-            di = {'number_of_fibers': len(d['fiblist']), }
-            
-            # print di
-            
-            # additional measures
-            # compute mean/std of fiber measure
-            idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (final_fiberlabels_array[:, 1] == int(v)))[0]
-            
-            # print "idx : ",idx
-            
-            di['fiber_length_mean'] = float(np.mean(final_fiberlength_array[idx]))
-            di['fiber_length_median'] = float(np.median(final_fiberlength_array[idx]))
-            di['fiber_length_std'] = float(np.std(final_fiberlength_array[idx]))
-            
-            di['fiber_proportion'] = float(100.0 * (di['number_of_fibers'] / float(total_fibers)))
-            
-            # Compute density
-            # density = (#fibers / mean_fibers_length) * (2 / (area_roi_u + area_roi_v))
-            
-            # print "G.node[int(u)]['roi_volume'] : %i / G.node[int(v)]['roi_volume'] : %i" % (G.node[int(u)]['roi_volume'],G.node[int(v)]['roi_volume'])
-            # print "di['number_of_fibers'] : %i / di['fiber_length_mean'] : %i" % (di['number_of_fibers'],di['fiber_length_mean'])
-            
-            if di['fiber_length_mean'] > 0.0:
-                di['fiber_density'] = float((float(di['number_of_fibers']) / float(di['fiber_length_mean'])) * float(
-                    2.0 / (G.node[int(u)]['roi_volume'] + G.node[int(v)]['roi_volume'])))
-                di['normalized_fiber_density'] = float(
-                    ((float(di['number_of_fibers']) / float(total_fibers)) / float(di['fiber_length_mean'])) * (
-                                (2.0 * float(total_volume)) / (
-                                    G.node[int(u)]['roi_volume'] + G.node[int(v)]['roi_volume'])))
-            else:
-                di['fiber_density'] = 0.0
-                di['normalized_fiber_density'] = 0.0
-            # this is indexed into the fibers that are valid in the sense of touching start
-            # and end roi and not going out of the volume
-            idx_valid = np.where((fiberlabels[:, 0] == int(u)) & (fiberlabels[:, 1] == int(v)))[0]
-            
-            for k, vv in mmapdata.items():
-                val = []
-                
-                # print("Processing %s map..." % k)
-                # print(vv[1])
-                for i in idx_valid:
-                    # retrieve indices
-                    try:
-                        # print(h[i])
-                        idx2 = (h[i] / vv[1]).astype(np.uint32)
-                        # print "idx2 : ",idx2
-                        val.append(vv[0][idx2[:, 0], idx2[:, 1], idx2[:, 2]])
-                    except IndexError, e:
-                        print("  ... ERROR - Index error occured when trying extract scalar values for measure", k)
-                        print("  ... ERROR - Discard fiber with index", i, "Exception: ", e)
-                
-                # print(k)
-                da = np.concatenate(val)
-                # print(da.max())
-                # print(np.median(da))
-                
-                if k == 'shore_rtop':
-                    di[k + '_mean'] = da.astype(np.float64).mean()
-                    di[k + '_std'] = da.astype(np.float64).std()
-                    di[k + '_median'] = np.median(da.astype(np.float64))
-                else:
-                    di[k + '_mean'] = da.mean().astype(np.float)
-                    di[k + '_std'] = da.std().astype(np.float)
-                    di[k + '_median'] = np.median(da).astype(np.float)
-                
-                # print(di[k + '_median'])
-                del da
-                del val
-            
-            G.add_edge(u, v)
-            for key in di:
-                G[u][v][key] = di[key]
+        edge_measures = compute_edge_measures(final_fiberlength_array, edges, edge_fibers_order, edge_starts,
+                                              edge_counts, node_volumes, total_volume)
+        
+        # this is indexed into the fibers that are valid in the sense of touching start
+        # and end roi and not going out of the volume
+        edge_measures.update(compute_edge_scalar_measures(fiber_stats, final_fibers_idx, edge_fibers_order,
+                                                          edge_starts, edge_counts))
+        
+        for e, (u, v) in enumerate(edges):
+            di = G[int(u)][int(v)]
+            for key in edge_measures:
+                di[key] = float(edge_measures[key][e])
+            di['number_of_fibers'] = int(edge_measures['number_of_fibers'][e])
         
         print("  ************************")
         
@@ -524,16 +888,7 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
             # edges
             size_edges = (int(parval['number_of_regions']), int(parval['number_of_regions']))
             
-            # Get the edge attributes/keys/weights from the first edge and then break. 
-            # Change w.r.t networkx2
-            edge_keys = []
-            for u, v, d in G.edges(data=True):
-                edge_keys = d.keys()
-                break
-            
-            edge_struct = {}
-            for edge_key in edge_keys:
-                edge_struct[edge_key] = nx.to_numpy_matrix(G, weight=edge_key)
+            edge_struct = compute_edge_matrices(edges, edge_measures, list(G.nodes()))
             
             # nodes
             size_nodes = int(parval['number_of_regions'])
@@ -602,7 +957,7 @@ def cmat(intrk, roi_volumes, roi_graphmls, parcellation_scheme, compute_curvatur
         if not streamline_wrote:
             print("  > Filtering tractography - keeping only no orphan fibers")
             finalfibers_fname = 'streamline_final.trk'
-            save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
+            save_fibers(hdr, intrk, finalfibers_fname, final_fibers_idx)
     
     print("Done.")
     print("========================")
@@ -618,6 +973,8 @@ class CMTK_cmatInputSpec(BaseInterfaceInputSpec):
     compute_curvature = traits.Bool(True, desc='Compute curvature', usedefault=True)
     additional_maps = traits.List(File, desc='Additional calculated maps (ADC, gFA, ...)')
     output_types = traits.List(Str, desc='Output types of the connectivity matrices')
+    streaming_chunk_size = traits.Int(100000, usedefault=True,
+                                      desc='Number of fibers read at a time when streaming the tractogram')
     probtrackx = traits.Bool(False)
     voxel_connectivity = InputMultiPath(File(exists=True),
                                         desc="ProbtrackX connectivity matrices (# seed voxels x # target ROIs)")
@@ -657,7 +1014,8 @@ class CMTK_cmat(BaseInterface):
              roi_graphmls=self.inputs.roi_graphMLs,
              parcellation_scheme=self.inputs.parcellation_scheme, atlas_info=self.inputs.atlas_info,
              compute_curvature=self.inputs.compute_curvature,
-             additional_maps=additional_maps, output_types=self.inputs.output_types)
+             additional_maps=additional_maps, output_types=self.inputs.output_types,
+             chunk_size=self.inputs.streaming_chunk_size)
         
         if 'cff' in self.inputs.output_types:
             cvt = cmtk.CFFConverter()
@@ -696,12 +1054,16 @@ class rsfmri_conmat_InputSpec(BaseInterfaceInputSpec):
     DVARS = File(exists=True)
     DVARS_th = Float()
     output_types = traits.List(Str, desc='Output types of the connectivity matrices')
+    roi_timeseries = InputMultiPath(File(exists=True),
+                                    desc='ROI average time-series already extracted from func_file (.npy), '
+                                         'in the same order as roi_volumes')
 
 
 class rsfmri_conmat_OutputSpec(TraitedSpec):
     avg_timeseries = OutputMultiPath(File(exists=True), desc="ROI average timeseries")
     scrubbed_idx = File(exists=True)
     connectivity_matrices = OutputMultiPath(File(exists=True))
+    correlation_matrices = OutputMultiPath(File(exists=True), desc="ROI correlation matrices (.npy and .mat)")
 
 
 class rsfmri_conmat(BaseInterface):
@@ -714,9 +1076,10 @@ class rsfmri_conmat(BaseInterface):
         print("Compute average rs-fMRI signal for each cortical ROI")
         print("====================================================")
         
-        fdata = nib.load(self.inputs.func_file).get_data()
+        # the 4D volume is only loaded if some ROI time-series have to be extracted
+        fdata = None
         
-        tp = fdata.shape[3]
+        tp = nib.load(self.inputs.func_file).shape[3]
         
         # OLD
         # if self.inputs.parcellation_scheme != "Custom":
@@ -779,6 +1142,9 @@ class rsfmri_conmat(BaseInterface):
         # else:
         #     index = np.linspace(0,tp-1,tp).astype('int')
         
+        # ROI indexes (centroids in voxel coordinates), for the node positions
+        roi_indexes = {}
+        
         # loop throughout all the resolutions ('scale33', ..., 'scale500')
         for parkey, parval in resolutions.items():
             print("Resolution = " + parkey)
@@ -790,19 +1156,26 @@ class rsfmri_conmat(BaseInterface):
                     roi_fname = vol
                     print(roi_fname)
             
-            roi = nib.load(roi_fname)
-            mask = roi.get_data()
+            roiData = nib.load(roi_fname).get_data()
+            roi_indexes[parkey] = RoiIndex.from_volume(roiData)
             
             ## Compute average time-series
             # nROIs: number of ROIs for current resolution
             nROIs = parval['number_of_regions']
             
-            # matrix number of rois vs timepoints
-            ts = np.zeros((nROIs, tp), dtype=np.float32)
-            
-            # loop throughout all the ROIs (current resolution)
-            for i in range(1, nROIs + 1):
-                ts[i - 1, :] = fdata[mask == i].mean(axis=0)
+            # matrix number of rois vs timepoints, ROI volumes and centroids in one pass
+            ts = None
+            if isdefined(self.inputs.roi_timeseries) and len(self.inputs.roi_timeseries) == len(
+                    self.inputs.roi_volumes):
+                ts = np.load(self.inputs.roi_timeseries[self.inputs.roi_volumes.index(roi_fname)])
+                if ts.shape != (nROIs, tp):
+                    ts = None
+            if ts is None:
+                if fdata is None:
+                    fdata = nib.load(self.inputs.func_file).get_data()
+                _, _, ts = compute_roi_statistics(roiData, nROIs, fdata)
+            else:
+                print("Use the ROI time-series extracted by the functional stage")
             print("ts_shape:", ts.shape)
             
             np.save(os.path.abspath('averageTimeseries_%s.npy' % parkey), ts)
@@ -813,51 +1186,12 @@ class rsfmri_conmat(BaseInterface):
         for parkey, parval in resolutions.items():
             print("Resolution = " + parkey)
             
-            # Open the corresponding ROI
-            print("Open the corresponding ROI")
-            for vol in self.inputs.roi_volumes:
-                if parkey in vol:
-                    roi_fname = vol
-                    print roi_fname
-            roi = nib.load(roi_fname)
-            roiData = roi.get_data()
-            
             # Average roi time-series
             ts = np.load(os.path.abspath('averageTimeseries_%s.npy' % parkey))
             
             # nROIs: number of ROIs for current resolution
             nROIs = parval['number_of_regions']
             
-            # Create matrix, add node information from parcellation and recover ROI indexes
-            print("Create the connection matrix (%s rois)" % nROIs)
-            G = nx.Graph()
-            gp = nx.read_graphml(parval['node_information_graphml'])
-            ROI_idx = []
-            for u, d in gp.nodes(data=True):
-                G.add_node(int(u))
-                for key in d:
-                    G.node[int(u)][key] = d[key]
-                # compute a position for the node based on the mean position of the
-                # ROI in voxel coordinates (segmentation volume )
-                if self.inputs.parcellation_scheme != "Lausanne2018":
-                    G.node[int(u)]['dn_position'] = tuple(
-                        np.mean(np.where(mask == int(d["dn_correspondence_id"])), axis=1))
-                    ROI_idx.append(int(d["dn_correspondence_id"]))
-                else:
-                    G.node[int(u)]['dn_position'] = tuple(np.mean(np.where(mask == int(d["dn_multiscaleID"])), axis=1))
-                    ROI_idx.append(int(d["dn_multiscaleID"]))
-            # # matrix number of rois vs timepoints
-            # ts = np.zeros( (nROIs,tp), dtype = np.float32 )
-            #
-            # # loop throughout all the ROIs (current resolution)
-            # roi_line = 0
-            # for i in ROI_idx:
-            #     ts[roi_line,:] = fdata[roiData==i].mean( axis = 0 )
-            #     roi_line += 1
-            #
-            # np.save( os.path.abspath('averageTimeseries_%s.npy' % parkey), ts )
-            # sio.savemat( os.path.abspath('averageTimeseries_%s.mat' % parkey), {'TCS':ts} )
-            
             # Censoring time-series
             if self.inputs.apply_scrubbing:
                 # load scrubbing FD and DVARS series
@@ -881,36 +1215,39 @@ class rsfmri_conmat(BaseInterface):
                             {'ts': ts_after_scrubbing})
                 ts = ts_after_scrubbing
                 print('ts.shape : ', ts.shape)
-                
-                # initialize connectivity matrix
-                nnodes = ts.shape[0]
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in xrange(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s_after_scrubbing.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(), 'fconnectome_%s_after_scrubbing.mat' % s), {'fmat':fmat} )
+                fmat_fname = 'fconnectome_%s_after_scrubbing' % parkey
             else:
-                nnodes = ts.shape[0]
-                
-                i = -1
-                for i_signal in ts:
-                    i += 1
-                    for j in xrange(i, nnodes):
-                        j_signal = ts[j, :]
-                        value = np.corrcoef(i_signal, j_signal)[0, 1]
-                        G.add_edge(ROI_idx[i], ROI_idx[j])
-                        G[ROI_idx[i]][ROI_idx[j]]['corr'] = value
-                        # fmat[i,j] = value
-                        # fmat[j,i] = value
-                # np.save( op.join(gconf.get_timeseries(), 'fconnectome_%s.npy' % s), fmat )
-                # sio.savemat( op.join(gconf.get_timeseries(), 'fconnectome_%s.mat' % s), {'fmat':fmat} )
+                fmat_fname = 'fconnectome_%s' % parkey
+            
+            # Compute the correlation of all pairs of ROIs at once
+            fmat = compute_correlation_matrix(ts)
+            np.save(os.path.abspath('%s.npy' % fmat_fname), fmat)
+            sio.savemat(os.path.abspath('%s.mat' % fmat_fname), {'fmat': fmat})
+            
+            # The networkx graph is only needed by the gPickle, mat, graphml and cff outputs
+            if not set(self.inputs.output_types) & set(['gPickle', 'mat', 'graphml', 'cff']):
+                continue
+            
+            # Create matrix, add node information from parcellation and recover ROI indexes
+            print("Create the connection matrix (%s rois)" % nROIs)
+            G = nx.Graph()
+            gp = nx.read_graphml(parval['node_information_graphml'])
+            ROI_idx = []
+            for u, d in gp.nodes(data=True):
+                G.add_node(int(u))
+                for key in d:
+                    G.node[int(u)][key] = d[key]
+                # compute a position for the node based on the mean position of the
+                # ROI in voxel coordinates (segmentation volume )
+                if self.inputs.parcellation_scheme != "Lausanne2018":
+                    ROI_idx.append(int(d["dn_correspondence_id"]))
+                else:
+                    ROI_idx.append(int(d["dn_multiscaleID"]))
+                G.node[int(u)]['dn_position'] = tuple(roi_indexes[parkey].centroid(ROI_idx[-1]))
+            
+            nnodes = ts.shape[0]
+            G.add_edges_from((ROI_idx[i], ROI_idx[j], {'corr': fmat[i, j]})
+                             for i in xrange(nnodes) for j in xrange(i, nnodes))
             
             # storing network
             if 'gPickle' in self.inputs.output_types:
@@ -928,7 +1265,11 @@ class rsfmri_conmat(BaseInterface):
                 
                 edge_struct = {}
                 for edge_key in edge_keys:
-                    edge_struct[edge_key] = nx.to_numpy_matrix(G, weight=edge_key)
+                    if edge_key == 'corr' and nnodes == G.number_of_nodes():
+                        # G nodes follow the rows of fmat
+                        edge_struct[edge_key] = fmat
+                    else:
+                        edge_struct[edge_key] = nx.to_numpy_matrix(G, weight=edge_key)
                 
                 # nodes
                 size_nodes = int(parval['number_of_regions'])
@@ -997,6 +1338,7 @@ class rsfmri_conmat(BaseInterface):
         outputs = self._outputs().get()
         outputs['connectivity_matrices'] = glob.glob(os.path.abspath('connectome*'))
         outputs['avg_timeseries'] = glob.glob(os.path.abspath('averageTimeseries_*'))
+        outputs['correlation_matrices'] = glob.glob(os.path.abspath('fconnectome_*'))
         if self.inputs.apply_scrubbing:
             outputs['scrubbed_idx'] = os.path.abspath('tp_after_scrubbing.npy')
         return outputs
@@ -8,27 +8,264 @@
 """
 
 import os
+import itertools
 import numpy as np
 import nibabel.trackvis as tv
 
-from util import length
+from util import batched_length
 
 
-def compute_length_array(trkfile=None, streams=None, savefname='lengths.npy'):
+class SizedStreamlines(object):
+    """ Iterable over a known number of streamlines
+    
+    trackvis.write only stores the number of streamlines in the header when the
+    streamlines have a len, this wraps a generator so that it can be written
+    without loading all the streamlines in memory.
+    """
+    
+    def __init__(self, streamlines, n_streamlines):
+        self.streamlines = streamlines
+        self.n_streamlines = n_streamlines
+    
+    def __len__(self):
+        return self.n_streamlines
+    
+    def __iter__(self):
+        return iter(self.streamlines)
+
+
+PACKED_STREAMLINES_EXT = '.pks'
+PACKED_STREAMLINES_MAGIC = b'CMTKPSL1'
+PACKED_STREAMLINES_HEADER_SIZE = 1024
+
+
+class PackedStreamlines(object):
+    """ Streamlines packed in one contiguous float32 points buffer
+    
+    The points of all the streamlines are stored in a single [#points, 3] array
+    and each streamline is described by its offset and length in this array.
+    Indexing returns (points, None, None) tuples as trackvis.read does, the points
+    being views into the buffer, so that the object can be used wherever a list
+    of trackvis streamlines is expected.
+    
+    On disk, the file contains a small header (magic string, number of
+    streamlines and points, trackvis header) followed by the points, offsets
+    and lengths arrays, which are memory-mapped when loaded.
+    """
+    
+    def __init__(self, points, offsets, lengths, hdr=None):
+        self.points = points
+        self.offsets = offsets
+        self.lengths = lengths
+        self.hdr = hdr
+    
+    def __len__(self):
+        return len(self.lengths)
+    
+    def __getitem__(self, i):
+        start = self.offsets[i]
+        return self.points[start:start + self.lengths[i]], None, None
+    
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    
+    def iter_chunks(self, chunk_size=100000):
+        """ Iterate over blocks of chunk_size streamlines, as PackedStreamlines views of the buffer """
+        for start in range(0, len(self), chunk_size):
+            stop = min(start + chunk_size, len(self))
+            offsets = np.asarray(self.offsets[start:stop], dtype=np.int64)
+            lengths = np.asarray(self.lengths[start:stop], dtype=np.int64)
+            first, end = offsets[0], offsets[-1] + lengths[-1]
+            yield PackedStreamlines(self.points[first:end], offsets - first, lengths, self.hdr)
+    
+    @classmethod
+    def from_streamlines(cls, streamlines, hdr=None):
+        """ Pack a list of (points, scalars, properties) streamlines """
+        lengths = np.array([len(s[0]) for s in streamlines], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        if len(lengths) > 0:
+            points = np.concatenate([np.asarray(s[0], dtype=np.float32).reshape(-1, 3) for s in streamlines])
+        else:
+            points = np.zeros((0, 3), dtype=np.float32)
+        return cls(points, offsets[:len(lengths)], lengths, hdr)
+    
+    @classmethod
+    def load(cls, fname, mmap_mode='r'):
+        """ Load a packed streamlines file, memory-mapping its arrays """
+        with open(fname, 'rb') as f:
+            header = f.read(PACKED_STREAMLINES_HEADER_SIZE)
+        if header[:len(PACKED_STREAMLINES_MAGIC)] != PACKED_STREAMLINES_MAGIC:
+            raise IOError("%s is not a packed streamlines file" % fname)
+        n_streamlines, n_points = [int(v) for v in np.frombuffer(header[8:24], dtype='<i8')]
+        hdr = np.frombuffer(header[24:24 + tv.header_2_dtype.itemsize], dtype=tv.header_2_dtype).reshape(()).copy()
+        
+        offset = PACKED_STREAMLINES_HEADER_SIZE
+        if n_points > 0:
+            points = np.memmap(fname, dtype='<f4', mode=mmap_mode, offset=offset, shape=(n_points, 3))
+        else:
+            points = np.zeros((0, 3), dtype=np.float32)
+        offset += n_points * 3 * 4
+        if n_streamlines > 0:
+            offsets = np.memmap(fname, dtype='<i8', mode=mmap_mode, offset=offset, shape=(n_streamlines,))
+            lengths = np.memmap(fname, dtype='<i8', mode=mmap_mode, offset=offset + n_streamlines * 8,
+                                shape=(n_streamlines,))
+        else:
+            offsets = np.zeros(0, dtype=np.int64)
+            lengths = np.zeros(0, dtype=np.int64)
+        return cls(points, offsets, lengths, hdr)
+    
+    def save(self, fname):
+        """ Write the packed streamlines file """
+        writer = PackedStreamlinesWriter(fname, self.hdr)
+        writer.write_packed(self.points, self.lengths)
+        writer.close()
+
+
+class PackedStreamlinesWriter(object):
+    """ Write a packed streamlines file block by block
+    
+    The points are appended as they come, the offsets and lengths are written
+    at the end by close().
+    """
+    
+    def __init__(self, fname, hdr=None):
+        self.fname = fname
+        self.hdr = hdr
+        self.lengths = []
+        self.n_points = 0
+        self.f = open(fname, 'wb')
+        self.f.write(b'\x00' * PACKED_STREAMLINES_HEADER_SIZE)
+    
+    def write(self, streamlines):
+        """ Append (points, scalars, properties) streamlines """
+        lengths = []
+        for s in streamlines:
+            points = np.asarray(s[0], dtype='<f4').reshape(-1, 3)
+            self.f.write(points.tostring())
+            lengths.append(len(points))
+        self.lengths.append(np.array(lengths, dtype=np.int64))
+        self.n_points += int(np.sum(lengths))
+    
+    def write_packed(self, points, lengths):
+        """ Append streamlines already packed as points and lengths arrays """
+        self.f.write(np.asarray(points, dtype='<f4').tostring())
+        self.lengths.append(np.asarray(lengths, dtype=np.int64))
+        self.n_points += len(points)
+    
+    def close(self):
+        lengths = np.concatenate([np.zeros(0, dtype=np.int64)] + self.lengths)
+        offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)[:len(lengths)]
+        self.f.write(offsets.astype('<i8').tostring())
+        self.f.write(lengths.astype('<i8').tostring())
+        
+        header = PACKED_STREAMLINES_MAGIC + np.array([len(lengths), self.n_points], dtype='<i8').tostring()
+        if self.hdr is not None:
+            hdr = np.asarray(self.hdr).astype(tv.header_2_dtype)
+            hdr['n_count'] = len(lengths)
+            header += hdr.tostring()
+        self.f.seek(0)
+        self.f.write(header)
+        self.f.close()
+
+
+def as_packed_streamlines(streamlines):
+    """ Return streamlines as PackedStreamlines, packing them if they are a list of tuples """
+    if isinstance(streamlines, PackedStreamlines):
+        return streamlines
+    return PackedStreamlines.from_streamlines(streamlines)
+
+
+def is_packed_streamlines(fname):
+    """ Return True if fname is a packed streamlines file """
+    with open(fname, 'rb') as f:
+        return f.read(len(PACKED_STREAMLINES_MAGIC)) == PACKED_STREAMLINES_MAGIC
+
+
+def trk_to_packed(intrk, outfname, chunk_size=100000):
+    """ Convert a trackvis file into a packed streamlines file, streaming it by blocks """
+    chunks, hdr = read_trk_chunks(intrk, chunk_size)
+    writer = PackedStreamlinesWriter(outfname, hdr)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close()
+    return outfname
+
+
+def read_trk_chunks(trkfile, chunk_size=100000):
+    """ Read a trackvis file by blocks of chunk_size streamlines
+    
+    Only one block of streamlines is in memory at a time. Packed streamlines
+    files are also accepted, in which case the points are memory-mapped views.
+    
+    Returns
+    -------
+    (chunks: generator of lists of at most chunk_size (points, scalars, properties) tuples
+    hdr) : trackvis header
+    """
+    if is_packed_streamlines(trkfile):
+        packed = PackedStreamlines.load(trkfile)
+        return packed.iter_chunks(chunk_size), packed.hdr
+    
+    streams, hdr = tv.read(trkfile, as_generator=True)
+    
+    def chunks():
+        while True:
+            chunk = list(itertools.islice(streams, chunk_size))
+            if len(chunk) == 0:
+                break
+            yield chunk
+    
+    return chunks(), hdr
+
+
+def write_trk_subset(intrk, outtrk, indices, hdr=None, chunk_size=100000):
+    """ Write a new trackvis file with the streamlines of intrk at the given indices
+    
+    The input file is streamed, so that only one block of streamlines is in memory at a time.
+    A packed streamlines file is written instead if outtrk ends with PACKED_STREAMLINES_EXT.
+    """
+    chunks, hdrold = read_trk_chunks(intrk, chunk_size)
+    if hdr is None:
+        hdr = hdrold
+    indices = np.unique(np.asarray(indices, dtype=np.int64))
+    
+    def selected_streamlines():
+        start = 0
+        for chunk in chunks:
+            sel = indices[(indices >= start) & (indices < start + len(chunk))] - start
+            for i in sel:
+                yield chunk[i]
+            start += len(chunk)
+    
+    hdrnew = hdr.copy()
+    hdrnew['n_count'] = len(indices)
+    if outtrk.endswith(PACKED_STREAMLINES_EXT):
+        writer = PackedStreamlinesWriter(outtrk, hdrnew)
+        writer.write(selected_streamlines())
+        writer.close()
+    else:
+        tv.write(outtrk, SizedStreamlines(selected_streamlines(), len(indices)), hdrnew)
+    return hdrnew
+
+
+def compute_length_array(trkfile=None, streams=None, savefname='lengths.npy', chunk_size=100000):
     if streams is None and not trkfile is None:
         print("Compute length array for fibers in %s" % trkfile)
-        streams, hdr = tv.read(trkfile, as_generator=True)
-        n_fibers = hdr['n_count']
-        if n_fibers == 0:
+        chunks, hdr = read_trk_chunks(trkfile, chunk_size)
+        if not is_packed_streamlines(trkfile) and hdr['n_count'] == 0:
             msg = "Header field n_count of trackfile %s is set to 0. No track seem to exist in this file." % trkfile
             print(msg)
             raise Exception(msg)
     else:
-        n_fibers = len(streams)
+        chunks = as_packed_streamlines(streams).iter_chunks(chunk_size)
     
-    leng = np.zeros(n_fibers, dtype=np.float)
-    for i, fib in enumerate(streams):
-        leng[i] = length(fib[0])
+    # lengths of all the fibers of a block at once
+    leng = [np.zeros(0, dtype=np.float)]
+    for chunk in chunks:
+        packed = as_packed_streamlines(chunk)
+        leng.append(batched_length(packed.points, packed.offsets, packed.lengths))
+    leng = np.concatenate(leng)
     
     # store length array
     np.save(savefname, leng)
@@ -37,7 +274,7 @@ def compute_length_array(trkfile=None, streams=None, savefname='lengths.npy'):
     return leng
 
 
-def filter_fibers(intrk, outtrk='', fiber_cutoff_lower=20, fiber_cutoff_upper=500):
+def filter_fibers(intrk, outtrk='', fiber_cutoff_lower=20, fiber_cutoff_upper=500, chunk_size=100000):
     print("Cut Fiber Filtering")
     print("===================")
     
@@ -54,23 +291,11 @@ def filter_fibers(intrk, outtrk='', fiber_cutoff_lower=20, fiber_cutoff_upper=50
     # cut the fibers smaller than value
     reducedidx = np.where((le > fiber_cutoff_lower) & (le < fiber_cutoff_upper))[0]
     
-    # load trackfile (downside, needs everything in memory)
-    fibold, hdrold = tv.read(intrk)
-    
-    # rewrite the track vis file with the reduced number of fibers
-    outstreams = []
-    for i in reducedidx:
-        outstreams.append(fibold[i])
-    
-    n_fib_out = len(outstreams)
-    hdrnew = hdrold.copy()
-    hdrnew['n_count'] = n_fib_out
-    
-    # print("Compute length array for cutted fibers")
-    # le = compute_length_array(streams=outstreams)
+    # rewrite the track vis file with the reduced number of fibers,
+    # streaming the input file by blocks of fibers instead of loading it in memory
     print("Write out file: %s" % outtrk)
+    hdrnew = write_trk_subset(intrk, outtrk, reducedidx, chunk_size=chunk_size)
     print("Number of fibers out : %d" % hdrnew['n_count'])
-    tv.write(outtrk, outstreams, hdrnew)
     print("File wrote : %d" % os.path.exists(outtrk))
     
     # ----
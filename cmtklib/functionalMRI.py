@@ -15,7 +15,170 @@ import numpy as np
 import nibabel as nib
 
 # Nipype imports
-from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, InputMultiPath
+from nipype.interfaces.base import BaseInterface, BaseInterfaceInputSpec, TraitedSpec, InputMultiPath, \
+    OutputMultiPath
+from nipype.utils.filemanip import split_filename
+
+
+def as_voxels_by_time(data):
+    """ Return a [#voxels, #timepoints] view of a 4D volume
+    
+    The voxels are flattened following the memory layout of the volume so that
+    no copy is made; the order used ('C' or 'F') is returned as well so that
+    3D masks can be flattened in the same way.
+    """
+    order = 'F' if np.isfortran(data) else 'C'
+    return data.reshape((-1, data.shape[3]), order=order), order
+
+
+def compute_glm_residuals(data, X, mask=None, chunk_size=10000, overwrite=False):
+    """ Regress the columns of the design matrix X out of the voxel time-series
+    
+    The pseudo-inverse of X is computed once and the ordinary least squares
+    residuals of all the voxels are obtained with matrix products, processing
+    chunk_size voxels at a time to bound memory.
+    
+    Parameters
+    ----------
+    data: 4D volume of size [x, y, z, #timepoints]
+    X: design matrix of size [#timepoints, #regressors]
+    mask: optional 3D volume, only the voxels where it is nonzero are regressed
+    chunk_size: number of voxels processed at once
+    overwrite: write the residuals into data instead of a copy of it
+    
+    Returns
+    -------
+    new_data : data, or a copy of it, where the time-series of the regressed
+               voxels are replaced by the residuals of the fit
+    """
+    X = np.asarray(X, dtype=np.float64).reshape(data.shape[3], -1)
+    X_pinv = np.linalg.pinv(X)
+    
+    if overwrite:
+        new_data = data
+    else:
+        new_data = np.array(data, order='F' if np.isfortran(data) else 'C')
+    new_data_2d, order = as_voxels_by_time(new_data)
+    if mask is None:
+        voxels = np.arange(new_data_2d.shape[0])
+    else:
+        voxels = np.flatnonzero(np.asarray(mask).ravel(order=order))
+    
+    for start in xrange(0, len(voxels), chunk_size):
+        idx = voxels[start:start + chunk_size]
+        Y = new_data_2d[idx].astype(np.float64)
+        new_data_2d[idx] = Y - np.dot(np.dot(Y, X_pinv.T), X.T)
+    
+    return new_data
+
+
+def compute_average_signal(data, mask):
+    """ Return the demeaned average time-series of the voxels where mask == 1 """
+    values = data[mask == 1].mean(axis=0)
+    return values - np.mean(values)
+
+
+def compute_motion_regressors(move, nb_reg):
+    """ Return the motion nuisance regressors derived from the head motion parameters
+    
+    Parameters
+    ----------
+    move: matrix of size [#timepoints, 6] containing the motion parameters
+    nb_reg: number of motion regressors
+    """
+    move = move - np.mean(move, 0)
+    
+    # Update
+    move_der1 = np.concatenate((np.zeros([1, 6]), move[0:-1, :]), axis=0)
+    move_der2 = np.concatenate((np.zeros([2, 6]), move[0:-2, :]), axis=0)
+    move_sq = np.square(move)
+    move_der1_sq = np.square(move_der1)
+    move_der2_sq = np.square(move_der2)
+    
+    move_der1 = move_der1 - np.mean(move_der1)
+    move_der2 = move_der2 - np.mean(move_der2)
+    move_der1_sq = move_der1_sq - np.mean(move_der1_sq)
+    move_der2_sq = move_der2_sq - np.mean(move_der2_sq)
+    move_sq = move_sq - np.mean(move_sq)
+    
+    if nb_reg == '12' or nb_reg == '24' or nb_reg == '36':
+        move = np.hstack((move, move_sq))
+    if nb_reg == '24' or nb_reg == '36':
+        move = np.hstack((move, move_der1))
+        move = np.hstack((move, move_der1_sq))
+    if nb_reg == '36':
+        move = np.hstack((move, move_der2))
+        move = np.hstack((move, move_der2_sq))
+    
+    return move
+
+
+def compute_scrubbing_parameters(data, mask, move, chunk_size=10000):
+    """ Compute the framewise displacement (FD) and DVARS scrubbing parameters in one pass
+    
+    The voxels of the mask are read once, chunk_size voxels at a time, and
+    the squared differences between consecutive time points are accumulated
+    with np.diff instead of subtracting full volumes for each time point.
+    
+    Parameters
+    ----------
+    data: 4D volume of size [x, y, z, #timepoints]
+    mask: 3D volume, DVARS is computed over the voxels where it is nonzero
+    move: matrix of size [#timepoints, 6] containing the motion parameters
+    chunk_size: number of voxels processed at once
+    
+    Returns
+    -------
+    FD : matrix of size [#timepoints - 1, 1]
+    DVARS : matrix of size [#timepoints - 1, 1]
+    """
+    tp = data.shape[3]
+    FD = np.zeros((tp - 1, 1))
+    DVARS = np.zeros((tp - 1, 1))
+    
+    # FD: sum of the absolute differences of the motion parameters
+    FD[1:, 0] = np.absolute(np.diff(move[:tp - 1, :], axis=0)).sum(axis=1)
+    
+    # DVARS: root mean square over the mask of the differences between volumes
+    data_2d, order = as_voxels_by_time(data)
+    voxels = np.flatnonzero(np.asarray(mask).ravel(order=order) > 0)
+    sumsq = np.zeros(tp - 2)
+    for start in xrange(0, len(voxels), chunk_size):
+        Y = data_2d[voxels[start:start + chunk_size], :tp - 1]
+        sumsq += np.sum(np.power(np.diff(Y.astype(np.float64), axis=1), 2), axis=0)
+    DVARS[1:, 0] = np.power(sumsq / len(voxels), 0.5)
+    
+    return FD, DVARS
+
+
+def save_scrubbing_parameters(FD, DVARS):
+    """ Save FD and DVARS in the current directory as .npy and .mat files """
+    import scipy.io as sio
+    
+    np.save(os.path.abspath('FD.npy'), FD)
+    np.save(os.path.abspath('DVARS.npy'), DVARS)
+    sio.savemat(os.path.abspath('FD.mat'), {'FD': FD})
+    sio.savemat(os.path.abspath('DVARS.mat'), {'DVARS': DVARS})
+
+
+def polynomial_trend_basis(tp, order):
+    """ Return the [#timepoints, order + 1] Vandermonde matrix of the polynomial trends """
+    return np.vander(np.arange(tp, dtype=np.float64), order + 1)
+
+
+def spline_trend_basis(tp, knot_spacing, order=3):
+    """ Return the B-spline basis of the trends, with interior knots every knot_spacing time points
+    
+    Least squares fitting the time-series on this basis gives the same trend as
+    a scipy LSQUnivariateSpline with these knots.
+    """
+    from scipy.interpolate import splev
+    
+    x = np.arange(tp, dtype=np.float64)
+    interior_knots = np.arange(knot_spacing, tp - 1, knot_spacing, dtype=np.float64)
+    knots = np.concatenate(([x[0]] * (order + 1), interior_knots, [x[-1]] * (order + 1)))
+    n_basis = len(knots) - order - 1
+    return np.column_stack([splev(x, (knots, np.eye(n_basis)[i], order)) for i in range(n_basis)])
 
 
 class discard_tp_InputSpec(BaseInterfaceInputSpec):
@@ -66,6 +229,7 @@ class nuisance_InputSpec(BaseInterfaceInputSpec):
     motion_nuisance = Bool()
     nuisance_motion_nb_reg = Int('36')
     n_discard = Int(desc='Number of volumes discarded from the fMRI sequence during preprocessing')
+    chunk_size = Int(10000, usedefault=True, desc='Number of voxels regressed at once')
 
 
 class nuisance_OutputSpec(TraitedSpec):
@@ -95,11 +259,11 @@ class nuisance_regression(BaseInterface):
         dataimg = nib.load(ref_path)
         data = dataimg.get_data()
         tp = data.shape[3]
+        
         if self.inputs.global_nuisance:
             brainfile = self.inputs.brainfile  # load eroded whole brain mask
             brain = nib.load(brainfile).get_data().astype(np.uint32)
-            global_values = data[brain == 1].mean(axis=0)
-            global_values = global_values - np.mean(global_values)
+            global_values = compute_average_signal(data, brain)
             np.save(os.path.abspath('averageGlobal.npy'), global_values)
             sio.savemat(os.path.abspath('averageGlobal.mat'), {'avgGlobal': global_values})
         
@@ -107,8 +271,7 @@ class nuisance_regression(BaseInterface):
         if self.inputs.csf_nuisance:
             csffile = self.inputs.csf_file  # load eroded CSF mask
             csf = nib.load(csffile).get_data().astype(np.uint32)
-            csf_values = data[csf == 1].mean(axis=0)
-            csf_values = csf_values - np.mean(csf_values)
+            csf_values = compute_average_signal(data, csf)
             np.save(os.path.abspath('averageCSF.npy'), csf_values)
             sio.savemat(os.path.abspath('averageCSF.mat'), {'avgCSF': csf_values})
         
@@ -116,44 +279,18 @@ class nuisance_regression(BaseInterface):
         if self.inputs.wm_nuisance:
             WMfile = self.inputs.wm_file  # load eroded WM mask
             WM = nib.load(WMfile).get_data().astype(np.uint32)
-            wm_values = data[WM == 1].mean(axis=0)
-            wm_values = wm_values - np.mean(wm_values)
+            wm_values = compute_average_signal(data, WM)
             np.save(os.path.abspath('averageWM.npy'), wm_values)
             sio.savemat(os.path.abspath('averageWM.mat'), {'avgWM': wm_values})
         
         # Import parameters from head motion estimation
         if self.inputs.motion_nuisance:
             move = np.genfromtxt(self.inputs.motion_file)
-            move = move - np.mean(move, 0)
-            
-            # Update
-            move_der1 = np.concatenate((np.zeros([1, 6]), move[0:-1, :]), axis=0)
-            move_der2 = np.concatenate((np.zeros([2, 6]), move[0:-2, :]), axis=0)
-            move_sq = np.square(move)
-            move_der1_sq = np.square(move_der1)
-            move_der2_sq = np.square(move_der2)
-            
-            move_der1 = move_der1 - np.mean(move_der1)
-            move_der2 = move_der2 - np.mean(move_der2)
-            move_der1_sq = move_der1_sq - np.mean(move_der1_sq)
-            move_der2_sq = move_der2_sq - np.mean(move_der2_sq)
-            move_sq = move_sq - np.mean(move_sq)
-            
-            if self.inputs.nuisance_motion_nb_reg == '12' or self.inputs.nuisance_motion_nb_reg == '24' or self.inputs.nuisance_motion_nb_reg == '36':
-                move = np.hstack((move, move_sq))
-            if self.inputs.nuisance_motion_nb_reg == '24' or self.inputs.nuisance_motion_nb_reg == '36':
-                move = np.hstack((move, move_der1))
-                move = np.hstack((move, move_der1_sq))
-            if self.inputs.nuisance_motion_nb_reg == '36':
-                move = np.hstack((move, move_der2))
-                move = np.hstack((move, move_der2_sq))
+            move = compute_motion_regressors(move, self.inputs.nuisance_motion_nb_reg)
         
         # GLM: regress out nuisance covariates
-        new_data = data.copy()
-        
         # s = gconf.parcellation.keys()[0]
         
-        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         # if float(self.inputs.n_discard) > 0:
         #     n_discard = int(self.inputs.n_discard) - 1
         #     if self.inputs.motion_nuisance:
@@ -212,18 +349,14 @@ class nuisance_regression(BaseInterface):
             X = move
             print('> Detrend motion average signals')
         
-        import statsmodels.api as sm
-        X = sm.add_constant(X)
+        # add the constant regressor
+        X = np.column_stack((np.ones(tp), X.reshape(tp, -1)))
         # print('Shape X GLM')
         # print(X.shape)
         
-        # loop throughout all GM voxels
-        for index, value in np.ndenumerate(gm):
-            Y = data[index[0], index[1], index[2], :].reshape(tp, 1)
-            gls_model = sm.GLS(Y, X)
-            gls_results = gls_model.fit()
-            # new_data[index[0],index[1],index[2],:] = gls_results.resid
-            new_data[index[0], index[1], index[2], :] = gls_results.resid  # + gls_results.params[8]
+        # regress out the nuisance covariates from all the voxels at once
+        # (same residuals as an OLS / GLS fit without covariance per voxel)
+        new_data = compute_glm_residuals(data, X, chunk_size=self.inputs.chunk_size)
         
         img = nib.Nifti1Image(new_data, dataimg.get_affine(), dataimg.get_header())
         nib.save(img, os.path.abspath('fMRI_nuisance.nii.gz'))
@@ -249,6 +382,9 @@ class detrending_InputSpec(BaseInterfaceInputSpec):
     in_file = File(exists=True, mandatory=True, desc="fMRI volume to detrend")
     gm_file = InputMultiPath(File(exists=True), desc="ROI files registered to fMRI space")
     mode = Enum(["linear", "quadratic", "cubic"])
+    spline_knot_spacing = Int(100, usedefault=True,
+                              desc='Number of time points between the knots of the cubic spline trend')
+    chunk_size = Int(10000, usedefault=True, desc='Number of voxels detrended at once')
 
 
 class detrending_OutputSpec(TraitedSpec):
@@ -260,12 +396,9 @@ class Detrending(BaseInterface):
     output_spec = detrending_OutputSpec
     
     def _run_interface(self, runtime):
-        """ linear/quadratic detrending
+        """ linear/quadratic/cubic-spline detrending
         """
         
-        print("Linear detrending")
-        print("=================")
-        
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
         
@@ -274,51 +407,26 @@ class Detrending(BaseInterface):
         data = dataimg.get_data()
         tp = data.shape[3]
         
-        # GLM: regress out nuisance covariates
-        new_data_det = data.copy()
         gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         
-        from scipy import signal
-        
-        for index, value in np.ndenumerate(gm):
-            if value == 0:
-                continue
-            
-            Ydet = signal.detrend(data[index[0], index[1], index[2], :].reshape(tp, 1), axis=0)
-            new_data_det[index[0], index[1], index[2], :] = Ydet[:, 0]
-        
-        img = nib.Nifti1Image(new_data_det, dataimg.get_affine(), dataimg.get_header())
-        nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-        
+        # trends fitted to all the GM voxels at once
         if self.inputs.mode == 'quadratic':
             print("Quadratic detrending")
             print("=================")
-            from obspy.signal.detrend import polynomial
-            
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = polynomial(new_data_det2[index[0], index[1], index[2], :], order=2)
-            
-            img = nib.Nifti1Image(new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
-        
-        if self.inputs.mode == 'cubic':
+            basis = polynomial_trend_basis(tp, 2)
+        elif self.inputs.mode == 'cubic':
             print("Cubic-spline detrending")
             print("=================")
-            from obspy.signal.detrend import spline
-            
-            # GLM: regress out nuisance covariates
-            new_data_det2 = new_data_det.copy()
-            for index, value in np.ndenumerate(gm):
-                if value == 0:
-                    continue
-                Ydet = spline(new_data_det2[index[0], index[1], index[2], :], order=3)
-            
-            img = nib.Nifti1Image(new_data_det2, dataimg.get_affine(), dataimg.get_header())
-            nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
+            basis = spline_trend_basis(tp, self.inputs.spline_knot_spacing, order=3)
+        else:
+            print("Linear detrending")
+            print("=================")
+            basis = polynomial_trend_basis(tp, 1)
+        
+        new_data_det = compute_glm_residuals(data, basis, mask=gm, chunk_size=self.inputs.chunk_size)
+        
+        img = nib.Nifti1Image(new_data_det, dataimg.get_affine(), dataimg.get_header())
+        nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
         
         print("[ DONE ]")
         return runtime
@@ -334,6 +442,7 @@ class scrubbing_InputSpec(BaseInterfaceInputSpec):
     wm_mask = File(exists=True, desc='WM mask registered to fMRI space')
     gm_file = InputMultiPath(File(exists=True), desc='ROI volumes registered to fMRI space')
     motion_parameters = File(exists=True, desc='Motion parameters from preprocessing stage')
+    chunk_size = Int(10000, usedefault=True, desc='Number of voxels processed at once')
 
 
 class scrubbing_OutputSpec(TraitedSpec):
@@ -352,48 +461,21 @@ class Scrubbing(BaseInterface):
         """
         print("Precompute FD and DVARS for scrubbing")
         print("=====================================")
-        import scipy.io as sio
         
         # Output from previous preprocessing step
         ref_path = self.inputs.in_file
         
         dataimg = nib.load(ref_path)
         data = dataimg.get_data()
-        tp = data.shape[3]
         WMfile = self.inputs.wm_mask
         WM = nib.load(WMfile).get_data().astype(np.uint32)
         GM = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
         mask = WM + GM
         move = np.genfromtxt(self.inputs.motion_parameters)
         
-        # initialize motion measures
-        FD = np.zeros((tp - 1, 1))
-        DVARS = np.zeros((tp - 1, 1))
-        
-        # loop throughout all the time points
-        FD[0] = 0
-        DVARS[0] = 0
-        for i in xrange(1, tp - 1):
-            # FD
-            move0 = move[i - 1, :]
-            move1 = move[i, :]
-            this_move = move1 - move0
-            this_move = np.absolute(this_move)
-            FD[i] = this_move.sum()
-            
-            # DVARS
-            # extract current and following time points
-            temp0 = data[:, :, :, i - 1]
-            temp1 = data[:, :, :, i]
-            temp = temp1 - temp0
-            temp = np.power(temp, 2)
-            temp = temp[mask > 0]
-            DVARS[i] = np.power(temp.mean(), 0.5)
-        
-        np.save(os.path.abspath('FD.npy'), FD)
-        np.save(os.path.abspath('DVARS.npy'), DVARS)
-        sio.savemat(os.path.abspath('FD.mat'), {'FD': FD})
-        sio.savemat(os.path.abspath('DVARS.mat'), {'DVARS': DVARS})
+        # compute the motion measures in a single pass over the masked voxels
+        FD, DVARS = compute_scrubbing_parameters(data, mask, move, chunk_size=self.inputs.chunk_size)
+        save_scrubbing_parameters(FD, DVARS)
         
         print("[ DONE ]")
         return runtime
@@ -405,3 +487,156 @@ class Scrubbing(BaseInterface):
         outputs["fd_npy"] = os.path.abspath("FD.npy")
         outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
         return outputs
+
+
+class fused_processing_InputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="fMRI volume to process")
+    brainfile = File(desc='Eroded brain mask registered to fMRI space')
+    csf_file = File(desc='Eroded CSF mask registered to fMRI space')
+    wm_file = File(desc='WM mask registered to fMRI space')
+    motion_file = File(desc='Motion parameters from preprocessing stage')
+    gm_file = InputMultiPath(File(exists=True), desc='ROI volumes registered to fMRI space')
+    scrubbing = Bool(False, usedefault=True, desc='Compute the FD and DVARS scrubbing parameters')
+    detrending = Bool(False, usedefault=True, desc='Detrend the GM voxels')
+    detrending_mode = Enum(["linear", "quadratic", "cubic"])
+    spline_knot_spacing = Int(100, usedefault=True,
+                              desc='Number of time points between the knots of the cubic spline trend')
+    global_nuisance = Bool(False, usedefault=True)
+    csf_nuisance = Bool(False, usedefault=True)
+    wm_nuisance = Bool(False, usedefault=True)
+    motion_nuisance = Bool(False, usedefault=True)
+    nuisance_motion_nb_reg = Int('36')
+    compute_roi_timeseries = Bool(False, usedefault=True,
+                                  desc='Extract the average time-series of the ROIs of each gm_file volume')
+    write_intermediate_files = Bool(False, usedefault=True,
+                                    desc='Write the detrended volume before nuisance regression (for debugging)')
+    chunk_size = Int(10000, usedefault=True, desc='Number of voxels processed at once')
+
+
+class fused_processing_OutputSpec(TraitedSpec):
+    out_file = File(exists=True)
+    fd_npy = File()
+    dvars_npy = File()
+    fd_mat = File()
+    dvars_mat = File()
+    roi_timeseries = OutputMultiPath(File(), desc='ROI average time-series, one file per gm_file volume')
+
+
+class FusedProcessing(BaseInterface):
+    """ Scrubbing parameters, detrending, nuisance regression and ROI time-series in a single read
+    
+    The fMRI volume is loaded once and each step works on the data in memory,
+    in the same order as the Scrubbing, Detrending and nuisance_regression
+    interfaces of the functional stage, so that the intermediate volumes do
+    not need to be written and read back.
+    """
+    input_spec = fused_processing_InputSpec
+    output_spec = fused_processing_OutputSpec
+    
+    def _run_interface(self, runtime):
+        import scipy.io as sio
+        
+        dataimg = nib.load(self.inputs.in_file)
+        data = dataimg.get_data()
+        tp = data.shape[3]
+        gm = nib.load(self.inputs.gm_file[0]).get_data().astype(np.uint32)
+        
+        # FD and DVARS are computed on the input data
+        if self.inputs.scrubbing:
+            print("Compute FD and DVARS for scrubbing")
+            WM = nib.load(self.inputs.wm_file).get_data().astype(np.uint32)
+            move = np.genfromtxt(self.inputs.motion_file)
+            FD, DVARS = compute_scrubbing_parameters(data, WM + gm, move, chunk_size=self.inputs.chunk_size)
+            save_scrubbing_parameters(FD, DVARS)
+        
+        new_data = None
+        if self.inputs.detrending:
+            print("Detrending (%s)" % self.inputs.detrending_mode)
+            if self.inputs.detrending_mode == 'quadratic':
+                basis = polynomial_trend_basis(tp, 2)
+            elif self.inputs.detrending_mode == 'cubic':
+                basis = spline_trend_basis(tp, self.inputs.spline_knot_spacing, order=3)
+            else:
+                basis = polynomial_trend_basis(tp, 1)
+            new_data = compute_glm_residuals(data, basis, mask=gm, chunk_size=self.inputs.chunk_size)
+        
+        regressors = []
+        if self.inputs.global_nuisance or self.inputs.csf_nuisance or self.inputs.wm_nuisance or \
+                self.inputs.motion_nuisance:
+            if new_data is not None and self.inputs.write_intermediate_files:
+                img = nib.Nifti1Image(new_data, dataimg.get_affine(), dataimg.get_header())
+                nib.save(img, os.path.abspath('fMRI_detrending.nii.gz'))
+            
+            signals = new_data if new_data is not None else data
+            if self.inputs.global_nuisance:
+                brain = nib.load(self.inputs.brainfile).get_data().astype(np.uint32)
+                global_values = compute_average_signal(signals, brain)
+                np.save(os.path.abspath('averageGlobal.npy'), global_values)
+                sio.savemat(os.path.abspath('averageGlobal.mat'), {'avgGlobal': global_values})
+                regressors.append(global_values.reshape(tp, 1))
+            if self.inputs.csf_nuisance:
+                csf = nib.load(self.inputs.csf_file).get_data().astype(np.uint32)
+                csf_values = compute_average_signal(signals, csf)
+                np.save(os.path.abspath('averageCSF.npy'), csf_values)
+                sio.savemat(os.path.abspath('averageCSF.mat'), {'avgCSF': csf_values})
+                regressors.append(csf_values.reshape(tp, 1))
+            if self.inputs.wm_nuisance:
+                WM = nib.load(self.inputs.wm_file).get_data().astype(np.uint32)
+                wm_values = compute_average_signal(signals, WM)
+                np.save(os.path.abspath('averageWM.npy'), wm_values)
+                sio.savemat(os.path.abspath('averageWM.mat'), {'avgWM': wm_values})
+                regressors.append(wm_values.reshape(tp, 1))
+            if self.inputs.motion_nuisance:
+                move = np.genfromtxt(self.inputs.motion_file)
+                regressors.append(compute_motion_regressors(move, self.inputs.nuisance_motion_nb_reg))
+            
+            print("Nuisance regression")
+            X = np.column_stack([np.ones(tp)] + regressors)
+            new_data = compute_glm_residuals(signals, X, chunk_size=self.inputs.chunk_size,
+                                             overwrite=signals is new_data)
+        
+        if new_data is not None:
+            img = nib.Nifti1Image(new_data, dataimg.get_affine(), dataimg.get_header())
+            nib.save(img, os.path.abspath(self._out_fname()))
+        else:
+            new_data = data
+        
+        if self.inputs.compute_roi_timeseries:
+            from cmtklib.connectome import compute_roi_statistics
+            
+            for roi_fname in self.inputs.gm_file:
+                print("Extract ROI time-series of %s" % roi_fname)
+                roiData = nib.load(roi_fname).get_data()
+                _, _, ts = compute_roi_statistics(roiData, int(roiData.max()), new_data)
+                np.save(self._roi_timeseries_fname(roi_fname), ts)
+        
+        print("[ DONE ]")
+        return runtime
+    
+    def _out_fname(self):
+        if self.inputs.global_nuisance or self.inputs.csf_nuisance or self.inputs.wm_nuisance or \
+                self.inputs.motion_nuisance:
+            return 'fMRI_nuisance.nii.gz'
+        elif self.inputs.detrending:
+            return 'fMRI_detrending.nii.gz'
+        return None
+    
+    def _roi_timeseries_fname(self, roi_fname):
+        _, name, _ = split_filename(roi_fname)
+        return os.path.abspath('roiTimeseries_%s.npy' % name)
+    
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if self._out_fname() is not None:
+            outputs["out_file"] = os.path.abspath(self._out_fname())
+        else:
+            outputs["out_file"] = self.inputs.in_file
+        if self.inputs.scrubbing:
+            outputs["fd_mat"] = os.path.abspath("FD.mat")
+            outputs["dvars_mat"] = os.path.abspath("DVARS.mat")
+            outputs["fd_npy"] = os.path.abspath("FD.npy")
+            outputs["dvars_npy"] = os.path.abspath("DVARS.npy")
+        if self.inputs.compute_roi_timeseries:
+            outputs["roi_timeseries"] = [self._roi_timeseries_fname(f) for f in self.inputs.gm_file]
+        return outputs
+
@@ -13,7 +13,10 @@ from future import standard_library
 standard_library.install_aliases()
 # from builtins import str, open
 
+import os
 import os.path as op
+import glob
+import hashlib
 
 import time
 import numpy as np
@@ -29,6 +32,236 @@ from nipype.interfaces.dipy.base import DipyDiffusionInterface, DipyBaseInterfac
 IFLOGGER = logging.getLogger('nipype.interface')
 
 
+# State of the model fitting worker processes (model, shared input and output arrays)
+_FIT_WORKER_STATE = {}
+
+
+def _init_fit_worker(state):
+    """Set the state shared by the chunks fitted in a worker process"""
+    _FIT_WORKER_STATE.clear()
+    _FIT_WORKER_STATE.update(state)
+
+
+def _shared_array(shape, dtype=np.float64):
+    """Allocate a zero-initialized array in shared memory
+    
+    The array is visible (and writable) from the worker processes forked after
+    its allocation, so that they can write their results in place.
+    """
+    import multiprocessing as mp
+    
+    dtype = np.dtype(dtype)
+    raw = mp.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _iter_fit_chunks(fit_chunk, state, n_items, chunk_size, nbr_processes=1):
+    """Apply fit_chunk to the (start, stop) chunks of n_items items and yield its results
+    
+    The chunks are processed serially when nbr_processes is 1, and in a pool of
+    nbr_processes worker processes otherwise (0 means one per CPU). The state
+    is set once per worker; fit_chunk reads it from _FIT_WORKER_STATE. The
+    results are yielded in the order of the chunks, as soon as they are ready,
+    so that they can be consumed without being gathered.
+    """
+    import multiprocessing as mp
+    
+    chunks = [(start, min(start + chunk_size, n_items)) for start in range(0, n_items, chunk_size)]
+    if nbr_processes == 0:
+        nbr_processes = mp.cpu_count()
+    
+    try:
+        if nbr_processes == 1 or len(chunks) <= 1:
+            _init_fit_worker(state)
+            for chunk in chunks:
+                yield fit_chunk(chunk)
+        else:
+            pool = mp.Pool(processes=nbr_processes, initializer=_init_fit_worker, initargs=(state,))
+            try:
+                for result in pool.imap(fit_chunk, chunks):
+                    yield result
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _FIT_WORKER_STATE.clear()
+
+
+def _run_fit_chunks(fit_chunk, state, n_items, chunk_size, nbr_processes=1):
+    """Apply fit_chunk to the (start, stop) chunks of n_items items and return its results (see _iter_fit_chunks)"""
+    return list(_iter_fit_chunks(fit_chunk, state, n_items, chunk_size, nbr_processes))
+
+
+def _fit_shore_chunk(chunk):
+    """Fit the SHORE model on a chunk of in-mask voxels and store its ODF and scalar maps"""
+    from dipy.reconst.odf import gfa
+    from dipy.reconst.shm import sf_to_sh
+    
+    start, stop = chunk
+    state = _FIT_WORKER_STATE
+    shorefit = state['model'].fit(state['data'][start:stop])
+    odf = shorefit.odf(state['sphere'])
+    state['shODF'][start:stop] = sf_to_sh(odf, state['sphere'], sh_order=state['sh_order'],
+                                          basis_type=state['basis'])
+    state['GFA'][start:stop] = np.nan_to_num(gfa(odf))
+    state['MSD'][start:stop] = np.nan_to_num(shorefit.msd())
+    state['RTOP'][start:stop] = np.nan_to_num(shorefit.rtop_signal())
+
+
+def _track_seed_shard(chunk):
+    """Track the streamlines of a shard of seeds
+    
+    The random number generators are seeded from the random seed and the index
+    of the shard, so that the streamlines of a shard do not depend on the
+    process tracking it.
+    """
+    start, stop = chunk
+    state = _FIT_WORKER_STATE
+    shard_seed = (state['random_seed'] + start // state['shard_size']) % (2 ** 32)
+    np.random.seed(shard_seed)
+    args = (state['direction_getter'], state['classifier'], state['seeds'][start:stop], state['affine'])
+    try:
+        tracker = state['tracker_class'](*args, random_seed=shard_seed, **state['kwargs'])
+    except TypeError:
+        # dipy versions without the random_seed argument only use numpy's generator
+        tracker = state['tracker_class'](*args, **state['kwargs'])
+    return [np.asarray(streamline, dtype=np.float32) for streamline in tracker]
+
+
+# MAP-MRI scalar maps and the methods of the fitted model computing them
+MAPMRI_METRICS = [("rtop", "rtop"), ("rtap", "rtap"), ("rtpp", "rtpp"), ("msd", "msd"), ("qiv", "qiv"),
+                  ("ng", "ng"), ("ng_perp", "ng_perpendicular"), ("ng_para", "ng_parallel")]
+
+
+def _fit_mapmri_chunk(chunk):
+    """Fit the MAP-MRI model on a chunk of in-mask voxels and write its scalar maps in the memory-mapped outputs"""
+    start, stop = chunk
+    state = _FIT_WORKER_STATE
+    mapfit = state['model'].fit(state['data'][start:stop])
+    voxels = state['voxels'][start:stop]
+    for metric, method in MAPMRI_METRICS:
+        out = np.memmap(state['maps'][metric], dtype=np.float64, mode='r+', shape=state['shape'])
+        out.reshape(-1)[voxels] = getattr(mapfit, method)()
+        out.flush()
+        del out
+
+
+def _hash_update(h, obj, _visited=None):
+    """Update the hash h with the content of obj (arrays, numbers, strings, containers and plain objects)"""
+    if _visited is None:
+        _visited = set()
+    if isinstance(obj, np.ndarray):
+        h.update(('%s%s' % (obj.dtype.str, obj.shape)).encode('utf-8'))
+        h.update(np.ascontiguousarray(obj).tostring())
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=lambda k: '%s' % k):
+            h.update(('%s' % key).encode('utf-8'))
+            _hash_update(h, obj[key], _visited)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[')
+        for item in obj:
+            _hash_update(h, item, _visited)
+        h.update(b']')
+    elif callable(obj):
+        h.update(getattr(obj, '__name__', type(obj).__name__).encode('utf-8'))
+    elif hasattr(obj, '__dict__'):
+        if id(obj) in _visited:
+            return
+        _visited.add(id(obj))
+        h.update(type(obj).__name__.encode('utf-8'))
+        _hash_update(h, vars(obj), _visited)
+    else:
+        h.update(repr(obj).encode('utf-8'))
+
+
+def _csd_cache_key(in_file, model, sh_order, sh_basis_type, sphere):
+    """Return the key of the CSD fit of the diffusion image in_file by model in the cache
+    
+    The key hashes the content of the image, the parameters of the model (including
+    its gradient table and response function), and the order, basis and sphere of
+    the projection of the fODFs onto the SH basis done by peaks_from_model.
+    """
+    h = hashlib.sha1(b'csd_shm_coeff')
+    with open(in_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    _hash_update(h, model)
+    _hash_update(h, [sh_order, sh_basis_type, np.asarray(sphere.vertices)])
+    return h.hexdigest()
+
+
+# Number of entries kept in a CSD cache directory, the least recently used ones are evicted
+# (one entry for the reconstruction and one for the tractography if their fits differ)
+CSD_CACHE_MAX_ENTRIES = 2
+
+
+def _load_csd_cache(cache_dir, key, sh_order):
+    """Return the memory-mapped arrays cached for key (mask, shm_coeff, and the peaks if any), or None
+    
+    An entry whose SH coefficients are not of order sh_order is never returned. The SH
+    coefficients are mapped copy-on-write: they can be masked in place, and only the
+    pages that are written to are copied in memory.
+    """
+    prefix = op.join(cache_dir, key)
+    if not op.exists(prefix + '_mask.npy'):
+        return None
+    cache = {}
+    try:
+        for name in ['mask', 'shm_coeff', 'peak_dirs', 'peak_values']:
+            if op.exists(prefix + '_%s.npy' % name):
+                cache[name] = np.load(prefix + '_%s.npy' % name, mmap_mode='c' if name == 'shm_coeff' else 'r')
+        # Mark the entry as recently used
+        os.utime(prefix + '_mask.npy', None)
+    except (IOError, OSError):
+        # Evicted in the meantime by another node
+        return None
+    if 'shm_coeff' not in cache or cache['shm_coeff'].shape[-1] != (sh_order + 1) * (sh_order + 2) // 2:
+        return None
+    return cache
+
+
+def _evict_csd_cache(cache_dir, max_entries=CSD_CACHE_MAX_ENTRIES):
+    """Remove the least recently used entries of the cache, keeping max_entries of them"""
+    entries = []
+    for mask_file in glob.glob(op.join(cache_dir, '*_mask.npy')):
+        try:
+            entries.append((op.getmtime(mask_file), mask_file[:-len('_mask.npy')]))
+        except OSError:
+            continue
+    for _, prefix in sorted(entries, reverse=True)[max_entries:]:
+        # The mask goes first so that the entry is never loaded partially
+        for name in ['mask', 'shm_coeff', 'peak_dirs', 'peak_values']:
+            try:
+                os.remove(prefix + '_%s.npy' % name)
+            except OSError:
+                pass
+
+
+def _save_csd_cache(cache_dir, key, mask, shm_coeff, peak_dirs=None, peak_values=None):
+    """Store the SH coefficients (and peaks) fitted within mask in the cache
+    
+    Each array is written to a temporary file and then renamed, the mask last,
+    so that a partially written entry is never loaded. The least recently used
+    entries beyond CSD_CACHE_MAX_ENTRIES are then removed.
+    """
+    if not op.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Created in the meantime by another node
+            pass
+    prefix = op.join(cache_dir, key)
+    arrays = [('shm_coeff', shm_coeff), ('peak_dirs', peak_dirs), ('peak_values', peak_values),
+              ('mask', np.asarray(mask) > 0)]
+    for name, array in arrays:
+        if array is None:
+            continue
+        tmp_file = prefix + '_%s.%d.tmp.npy' % (name, os.getpid())
+        np.save(tmp_file, array)
+        os.rename(tmp_file, prefix + '_%s.npy' % name)
+    _evict_csd_cache(cache_dir)
+
+
 class DTIEstimateResponseSHInputSpec(DipyBaseInterfaceInputSpec):
     in_mask = File(
         exists=True, desc=('input mask in which we find single fibers'))
@@ -195,6 +428,8 @@ class CSDInputSpec(DipyBaseInterfaceInputSpec):
                                  desc=('save Spherical Harmonics Coefficients in file'))
     out_fods = File(desc=('fODFs output file name'))
     out_shm_coeff = File(desc=('Spherical Harmonics Coefficients output file name'))
+    cache_dir = traits.Str(desc=('directory of the cache of fitted SH coefficients and peaks, shared with '
+                                 'the tractography and reused by later runs (no caching if not set)'))
 
 
 class CSDOutputSpec(TraitedSpec):
@@ -295,29 +530,54 @@ class CSD(DipyDiffusionInterface):
         if self.inputs.save_shm_coeff:
             # isphere = get_sphere('symmetric724')
             from dipy.direction import peaks_from_model
-            IFLOGGER.info('Fitting CSD model')
-            csd_peaks = peaks_from_model(model=csd_model,
-                                         data=data,
-                                         sphere=sphere,
-                                         relative_peak_threshold=.5,
-                                         min_separation_angle=25,
-                                         mask=msk,
-                                         return_sh=True,
-                                         return_odf=False,
-                                         normalize_peaks=True,
-                                         npeaks=3,
-                                         parallel=False,
-                                         nbr_processes=None)
+            
+            # order of the SH projection of the fODFs (default of peaks_from_model)
+            projection_order = 8
+            
+            cache = None
+            if isdefined(self.inputs.cache_dir):
+                cache_key = _csd_cache_key(self.inputs.in_file, csd_model, projection_order, None, sphere)
+                cache = _load_csd_cache(self.inputs.cache_dir, cache_key, projection_order)
+                if cache is not None and ('peak_dirs' not in cache or
+                                          not np.array_equal(cache['mask'], msk > 0)):
+                    cache = None
+            
+            if cache is not None:
+                IFLOGGER.info('Loading cached CSD fit from %s' % self.inputs.cache_dir)
+                shm_coeff = cache['shm_coeff']
+                peak_dirs = cache['peak_dirs']
+                peak_values = cache['peak_values']
+            else:
+                IFLOGGER.info('Fitting CSD model')
+                csd_peaks = peaks_from_model(model=csd_model,
+                                             data=data,
+                                             sphere=sphere,
+                                             relative_peak_threshold=.5,
+                                             min_separation_angle=25,
+                                             mask=msk,
+                                             return_sh=True,
+                                             sh_order=projection_order,
+                                             return_odf=False,
+                                             normalize_peaks=True,
+                                             npeaks=3,
+                                             parallel=False,
+                                             nbr_processes=None)
+                shm_coeff = csd_peaks.shm_coeff
+                peak_dirs = csd_peaks.peak_dirs
+                peak_values = csd_peaks.peak_values
+                
+                if isdefined(self.inputs.cache_dir):
+                    _save_csd_cache(self.inputs.cache_dir, cache_key, msk, shm_coeff, peak_dirs, peak_values)
             # fods = csd_fit.odf(sphere)
             # IFLOGGER.info(fods)
             # IFLOGGER.info(fods.shape)
             IFLOGGER.info('Save Spherical Harmonics image')
-            nb.Nifti1Image(csd_peaks.shm_coeff, img.affine, None).to_filename(self._gen_filename('shm_coeff'))
+            nb.Nifti1Image(np.asarray(shm_coeff), img.affine, None).to_filename(self._gen_filename('shm_coeff'))
             
             from dipy.viz import actor, window
             ren = window.Renderer()
-            ren.add(actor.peak_slicer(csd_peaks.peak_dirs,
-                                      csd_peaks.peak_values,
+            ren.add(actor.peak_slicer(np.asarray(peak_dirs),
+                                      np.asarray(peak_values),
                                       colors=None))
             
             window.record(ren, out_path=self._gen_filename('csd_direction_field', ext='.png'), size=(900, 900))
@@ -347,6 +607,12 @@ class SHOREInputSpec(DipyBaseInterfaceInputSpec):
     
     constrain_e0 = traits.Bool(False, usedefault=True, desc=('Constrain the optimization such that E(0) = 1.'))
     positive_constraint = traits.Bool(False, usedefault=True, desc=('Constrain the optimization such that E(0) = 1.'))
+    
+    multiprocess = traits.Bool(False, usedefault=True,
+                               desc=('fit the voxels of the mask by chunks in a pool of processes'))
+    nbr_processes = traits.Int(0, usedefault=True,
+                               desc=('number of processes used if multiprocess (0: one per CPU)'))
+    chunk_size = traits.Int(1000, usedefault=True, desc=('number of voxels fitted at once'))
 
 
 class SHOREOutputSpec(TraitedSpec):
@@ -386,16 +652,12 @@ class SHORE(DipyDiffusionInterface):
         
         import pickle as pickle
         import gzip
-        import multiprocessing as mp
         
         from dipy.data import get_sphere, default_sphere
         from dipy.io import read_bvals_bvecs
         from dipy.core.gradients import gradient_table
         from dipy.reconst.shore import ShoreModel
-        from dipy.reconst.odf import gfa
         from dipy.reconst.csdeconv import odf_sh_to_sharp
-        from dipy.reconst.shm import sh_to_sf, sf_to_sh
-        from dipy.core.ndindex import ndindex
         
         img = nb.load(self.inputs.in_file)
         imref = nb.four_to_three(img)[0]
@@ -417,8 +679,7 @@ class SHORE(DipyDiffusionInterface):
         else:
             msk = clipMask(np.ones(imref.shape).astype('float32'))
         
-        data = img.get_data().astype(np.float32)
-        data[msk == 0] *= 0
+        data = img.get_data()
         
         hdr = imref.header.copy()
         
@@ -461,10 +722,6 @@ class SHORE(DipyDiffusionInterface):
         datashape = data.shape
         dimsODF = list(datashape)
         dimsODF[3] = int((lmax + 1) * (lmax + 2) / 2)
-        shODF = np.zeros(dimsODF)
-        GFA = np.zeros(dimsODF[:3])
-        RTOP = np.zeros(dimsODF[:3])
-        MSD = np.zeros(dimsODF[:3])
         
         # Dipy 0.16 - basis : {None, ‘tournier07’, ‘descoteaux07’}
         if self.inputs.tracking_processing_tool == "mrtrix":
@@ -472,21 +729,34 @@ class SHORE(DipyDiffusionInterface):
         else:
             basis = None
         
-        # calculate odf per slice
-        IFLOGGER.info('Fitting SHORE model')
-        for i in ndindex(data.shape[:1]):
-            print("Processing slice #%i " % i)
-            start_time = time.time()
-            shorefit = shore_model.fit(data[i])
-            sliceODF = shorefit.odf(sphere)
-            sliceGMSD = shorefit.msd()
-            sliceRTOP = shorefit.rtop_signal()
-            sliceGFA = gfa(sliceODF)
-            shODF[i] = sf_to_sh(sliceODF, sphere, sh_order=lmax, basis_type=basis)
-            GFA[i] = np.nan_to_num(sliceGFA)
-            MSD[i] = np.nan_to_num(sliceGMSD)
-            RTOP[i] = np.nan_to_num(sliceRTOP)
-            print("Computation Time (slice %s): " % str(i) + str(time.time() - start_time) + " seconds")
+        # fit only the voxels of the mask, the results of the chunks being written
+        # in shared memory by the worker processes
+        mask_idx = np.nonzero(msk)
+        n_voxels = len(mask_idx[0])
+        state = {'model': shore_model, 'sphere': sphere, 'sh_order': lmax, 'basis': basis,
+                 'data': _shared_array((n_voxels, datashape[3]), np.float32),
+                 'shODF': _shared_array((n_voxels, dimsODF[3])),
+                 'GFA': _shared_array(n_voxels),
+                 'MSD': _shared_array(n_voxels),
+                 'RTOP': _shared_array(n_voxels)}
+        state['data'][:] = data[mask_idx]
+        del data
+        
+        IFLOGGER.info('Fitting SHORE model on %d voxels' % n_voxels)
+        start_time = time.time()
+        _run_fit_chunks(_fit_shore_chunk, state, n_voxels, self.inputs.chunk_size,
+                        self.inputs.nbr_processes if self.inputs.multiprocess else 1)
+        print("Computation Time: " + str(time.time() - start_time) + " seconds")
+        
+        shODF = np.zeros(dimsODF)
+        GFA = np.zeros(dimsODF[:3])
+        RTOP = np.zeros(dimsODF[:3])
+        MSD = np.zeros(dimsODF[:3])
+        shODF[mask_idx] = state['shODF']
+        GFA[mask_idx] = state['GFA']
+        MSD[mask_idx] = state['MSD']
+        RTOP[mask_idx] = state['RTOP']
+        del state
         
         shFODF = odf_sh_to_sharp(shODF, sphere, basis=basis, ratio=0.2, sh_order=lmax, lambda_=1.0, tau=0.1,
                                  r2_term=True)
@@ -761,6 +1031,14 @@ class DirectionGetterTractographyInputSpec(BaseInterfaceInputSpec):
                              desc=('save seeding voxels coordinates'))
     num_seeds = traits.Int(10000, mandatory=True, usedefault=True,
                            desc=('desired number of tracks in tractography'))
+    nbr_processes = traits.Int(1, usedefault=True,
+                               desc=('number of processes tracking the seed shards (0: one per CPU)'))
+    seeds_per_shard = traits.Int(10000, usedefault=True,
+                                 desc=('number of seeds per shard when tracking in parallel'))
+    random_seed = traits.Int(desc=('seed of the random number generators, for reproducible tracking '
+                                   '(the seeds are then tracked by shards)'))
+    cache_dir = traits.Str(desc=('directory of the cache of fitted CSD SH coefficients, reused when it covers '
+                                 'the tracking mask (no caching if not set)'))
     out_prefix = traits.Str(desc=('output prefix for file names'))
 
 
@@ -770,7 +1048,7 @@ class DirectionGetterTractographyOutputSpec(TraitedSpec):
     tracks3 = File(desc='TrackVis file containing extracted streamlines')
     out_seeds = File(desc=('file containing the (N,3) *voxel* coordinates used'
                            ' in seeding.'))
-    streamlines = File(desc='Numpy array of streamlines')
+    streamlines = File(desc='Packed streamlines file (memory-mappable, see cmtklib.diffusion.PackedStreamlines)')
 
 
 class DirectionGetterTractography(DipyBaseInterface):
@@ -953,24 +1231,44 @@ class DirectionGetterTractography(DipyBaseInterface):
             csd_model = pickle.load(f)
             f.close()
             
-            IFLOGGER.info('Generating peaks from CSD model')
-            pfm = peaks_from_model(model=csd_model,
-                                   data=data,
-                                   sphere=sphere,
-                                   relative_peak_threshold=.2,
-                                   min_separation_angle=self.inputs.max_angle,
-                                   mask=tmsk,
-                                   return_sh=True,
-                                   # sh_basis_type=args.basis,
-                                   sh_order=self.inputs.recon_order,
-                                   normalize_peaks=False,  ##changed
-                                   parallel=True)
+            cache = None
+            if isdefined(self.inputs.cache_dir):
+                cache_key = _csd_cache_key(self.inputs.in_file, csd_model, self.inputs.recon_order, None, sphere)
+                cache = _load_csd_cache(self.inputs.cache_dir, cache_key, self.inputs.recon_order)
+                # The SH coefficients of a voxel do not depend on the peak extraction
+                # parameters, the cached fit can be used if it covers the tracking mask
+                if cache is not None and not np.all(cache['mask'][tmsk > 0]):
+                    cache = None
+            
+            if cache is not None:
+                IFLOGGER.info('Loading cached CSD SH coefficients from %s' % self.inputs.cache_dir)
+                # Zero the cached voxels outside the tracking mask, in the copy-on-write mapping
+                shm_coeff = cache['shm_coeff']
+                shm_coeff[np.logical_and(cache['mask'], tmsk == 0)] = 0
+            else:
+                IFLOGGER.info('Generating peaks from CSD model')
+                pfm = peaks_from_model(model=csd_model,
+                                       data=data,
+                                       sphere=sphere,
+                                       relative_peak_threshold=.2,
+                                       min_separation_angle=self.inputs.max_angle,
+                                       mask=tmsk,
+                                       return_sh=True,
+                                       # sh_basis_type=args.basis,
+                                       sh_order=self.inputs.recon_order,
+                                       normalize_peaks=False,  ##changed
+                                       parallel=True)
+                shm_coeff = pfm.shm_coeff
+                
+                if isdefined(self.inputs.cache_dir) and \
+                        _load_csd_cache(self.inputs.cache_dir, cache_key, self.inputs.recon_order) is None:
+                    _save_csd_cache(self.inputs.cache_dir, cache_key, tmsk, shm_coeff)
             
             if self.inputs.algo == 'deterministic':
-                dg = DeterministicMaximumDirectionGetter.from_shcoeff(pfm.shm_coeff, max_angle=self.inputs.max_angle,
+                dg = DeterministicMaximumDirectionGetter.from_shcoeff(shm_coeff, max_angle=self.inputs.max_angle,
                                                                       sphere=sphere)
             else:
-                dg = ProbabilisticDirectionGetter.from_shcoeff(pfm.shm_coeff, max_angle=self.inputs.max_angle,
+                dg = ProbabilisticDirectionGetter.from_shcoeff(shm_coeff, max_angle=self.inputs.max_angle,
                                                                sphere=sphere)
         
         else:
@@ -986,41 +1284,55 @@ class DirectionGetterTractography(DipyBaseInterface):
             else:
                 dg = ProbabilisticDirectionGetter.from_shcoeff(sh, max_angle=self.inputs.max_angle, sphere=sphere)
         
+        if not self.inputs.use_act:
+            tracker_class = LocalTracking
+            tracking_kwargs = dict(step_size=self.inputs.step_size, max_cross=1)
+        else:
+            tracker_class = ParticleFilteringTracking
+            classifier = cmc_classifier
+            tracking_kwargs = dict(max_cross=1,
+                                   step_size=step_size,
+                                   maxlen=200,
+                                   pft_back_tracking_dist=2,
+                                   pft_front_tracking_dist=1,
+                                   particle_count=15,
+                                   return_all=False)
+        
+        if self.inputs.nbr_processes != 1 or isdefined(self.inputs.random_seed):
+            # Track deterministic shards of seeds, in a pool of processes sharing
+            # the direction getter and the tissue classifier, and stream them in order
+            # to the tractogram file as they are tracked
+            random_seed = self.inputs.random_seed if isdefined(self.inputs.random_seed) else 0
+            state = {'tracker_class': tracker_class, 'direction_getter': dg, 'classifier': classifier,
+                     'seeds': np.asarray(tseeds), 'affine': affine, 'kwargs': tracking_kwargs,
+                     'random_seed': random_seed, 'shard_size': self.inputs.seeds_per_shard}
+            IFLOGGER.info('Tracking %d seeds by shards of %d seeds' % (len(state['seeds']),
+                                                                       self.inputs.seeds_per_shard))
+            shards = _iter_fit_chunks(_track_seed_shard, state, len(state['seeds']), self.inputs.seeds_per_shard,
+                                      self.inputs.nbr_processes)
+            streamline_generator = (streamline for shard in shards for streamline in shard)
+        else:
+            streamline_generator = tracker_class(dg, classifier, tseeds, affine, **tracking_kwargs)
+        
         if not self.inputs.use_act:
             
             IFLOGGER.info(('Performing %s tractography') % (self.inputs.algo))
             
-            streamlines = LocalTracking(dg, classifier, tseeds, affine, step_size=self.inputs.step_size, max_cross=1)
-            
+            streamlines = streamline_generator
+                        
             IFLOGGER.info('Saving tracks')
             save_trk(self._gen_filename('tracked', ext='.trk'), streamlines, affine, fa.shape)
         
         else:
             IFLOGGER.info('Performing PFT tractography')
             # Particle Filtering Tractography
-            pft_streamline_generator = ParticleFilteringTracking(dg,
-                                                                 cmc_classifier,
-                                                                 tseeds,
-                                                                 affine,
-                                                                 max_cross=1,
-                                                                 step_size=step_size,
-                                                                 maxlen=200,
-                                                                 pft_back_tracking_dist=2,
-                                                                 pft_front_tracking_dist=1,
-                                                                 particle_count=15,
-                                                                 return_all=False)
-            
-            # streamlines = list(pft_streamline_generator)
-            from dipy.tracking.streamline import Streamlines
-            streamlines = Streamlines(pft_streamline_generator)
-            
-            IFLOGGER.info('Saving tracks')
-            #
-            # save_trk(self._gen_filename('tracked_old', ext='.trk'), streamlines, affine, fa.shape)
-            
+            pft_streamline_generator = streamline_generator
+                        
+            import itertools
             import nibabel
-            from nibabel.streamlines import Field, Tractogram
+            from nibabel.streamlines import Field, LazyTractogram
             from nibabel.orientations import aff2axcodes
+            from cmtklib.diffusion import PackedStreamlines, PackedStreamlinesWriter
             
             print('-> Load nifti and copy header 1')
             
@@ -1030,7 +1342,18 @@ class DirectionGetterTractography(DipyBaseInterface):
             trkhdr['voxel_order'] = "".join(aff2axcodes(imref.affine))
             trkhdr['vox_to_ras'] = imref.affine.copy()  # utils.affine_for_trackvis(trkhdr['voxel_size'])
             
-            np.save(self._gen_filename('streamlines', ext='.npy'), streamlines)
+            # Pack the streamlines in a memory-mappable file as they are tracked
+            writer = PackedStreamlinesWriter(self._gen_filename('streamlines', ext='.pks'), trkhdr)
+            pft_streamline_generator = iter(pft_streamline_generator)
+            while True:
+                chunk = list(itertools.islice(pft_streamline_generator, 10000))
+                if len(chunk) == 0:
+                    break
+                writer.write((streamline, None, None) for streamline in chunk)
+            writer.close()
+            streamlines = PackedStreamlines.load(self._gen_filename('streamlines', ext='.pks'))
+            
+            IFLOGGER.info('Saving tracks')
             
             header = {}
             header[Field.ORIGIN] = imref.affine.copy()[:3, 3]
@@ -1039,12 +1362,13 @@ class DirectionGetterTractography(DipyBaseInterface):
             header[Field.DIMENSIONS] = imref.shape[:3]
             header[Field.VOXEL_ORDER] = "".join(aff2axcodes(imref.affine))
             
-            # Remove origin from streamlines (TODO: understand why needed)
-            for i, streamline in enumerate(streamlines):
-                for j, voxel in enumerate(streamline):
-                    streamlines[i][j] = streamlines[i][j] - imref.affine.copy()[:3, 3]
+            # Remove origin from streamlines (TODO: understand why needed), one streamline
+            # at a time so that the memory-mapped points are never copied as a whole
+            origin = imref.affine[:3, 3].astype(np.float32)
             
-            tractogram = Tractogram(streamlines=streamlines, affine_to_rasmm=imref.affine.copy())
+            # Stream the streamlines to the trk file
+            tractogram = LazyTractogram(lambda: (points - origin for points, _, _ in streamlines),
+                                        affine_to_rasmm=imref.affine.copy())
             nb.streamlines.save(tractogram, self._gen_filename('tracked', ext='.trk'), header=header)
             
             # nb.trackvis.write(self._gen_filename('tracked_nib2', ext='.trk'), streamlines, trkhdr)
@@ -1072,7 +1396,7 @@ class DirectionGetterTractography(DipyBaseInterface):
     
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['streamlines'] = self._gen_filename('streamlines', ext='.npy')
+        outputs['streamlines'] = self._gen_filename('streamlines', ext='.pks')
         outputs['tracks'] = self._gen_filename('tracked', ext='.trk')
         outputs['tracks2'] = self._gen_filename('tracked_old', ext='.trk')
         outputs['tracks3'] = self._gen_filename('tracked_nib2', ext='.trk')
@@ -1113,6 +1437,17 @@ class MAPMRIInputSpec(DipyBaseInterfaceInputSpec):
     
     big_delta = traits.Float(0.5, mandatory=True,
                              desc=('Small data for gradient table'))
+    
+    in_mask = File(exists=True, desc=('input mask in which compute the MAP-MRI solution '
+                                      '(default: voxels with a nonzero signal)'))
+    
+    multiprocess = traits.Bool(False, usedefault=True,
+                               desc=('fit the voxels of the mask by chunks in a pool of processes'))
+    
+    nbr_processes = traits.Int(0, usedefault=True,
+                               desc=('number of processes used if multiprocess (0: one per CPU)'))
+    
+    chunk_size = traits.Int(1000, usedefault=True, desc=('number of voxels fitted at once'))
 
 
 class MAPMRIOutputSpec(TraitedSpec):
@@ -1158,12 +1493,8 @@ class MAPMRI(DipyDiffusionInterface):
         import gzip
         
         img = nb.load(self.inputs.in_file)
-        imref = nb.four_to_three(img)[0]
         affine = img.affine
-        
-        data = img.get_data().astype(np.float32)
-        
-        hdr = imref.header.copy()
+        data = img.get_data()
         
         gtab = self._get_gradient_table()
         gtab = gradient_table(bvals=gtab.bvals, bvecs=gtab.bvecs,
@@ -1178,20 +1509,29 @@ class MAPMRI(DipyDiffusionInterface):
                                                   positivity_constraint=self.inputs.positivity_constraint
                                                   )
         
-        IFLOGGER.info('Fitting MAP-MRI model')
-        mapfit_both_aniso = map_model_both_aniso.fit(data)
-        
-        '''maps'''
-        maps = {}
-        maps["rtop"] = mapfit_both_aniso.rtop()  # '''1/Volume of pore'''
-        maps["rtap"] = mapfit_both_aniso.rtap()  # '''1/AREA ...'''
-        maps["rtpp"] = mapfit_both_aniso.rtpp()  # '''1/length ...'''
-        maps["msd"] = mapfit_both_aniso.msd()  # '''similar to mean diffusivity'''
-        maps["qiv"] = mapfit_both_aniso.qiv()  # '''almost reciprocal of rtop'''
-        maps["ng"] = mapfit_both_aniso.ng()  # '''general non Gaussianity'''
-        maps[
-            "ng_perp"] = mapfit_both_aniso.ng_perpendicular()  # '''perpendicular to main direction (likely to be non gaussian in white matter)'''
-        maps["ng_para"] = mapfit_both_aniso.ng_parallel()  # '''along main direction (likely to be gaussian)'''
+        if isdefined(self.inputs.in_mask):
+            msk = nb.load(self.inputs.in_mask).get_data() > 0
+        else:
+            msk = np.zeros(data.shape[:3], dtype=bool)
+            for k in range(data.shape[-1]):
+                msk |= data[..., k] != 0
+        voxels = np.flatnonzero(msk)
+        n_voxels = len(voxels)
+        
+        # in-mask signals in shared memory for the worker processes
+        state = {'model': map_model_both_aniso, 'voxels': voxels, 'shape': msk.shape,
+                 'data': _shared_array((n_voxels, data.shape[-1]), np.float32), 'maps': {}}
+        state['data'][:] = data[np.nonzero(msk)]
+        del data
+        
+        # the maps are preallocated as memory-mapped files, written chunk by chunk
+        for metric, _ in MAPMRI_METRICS:
+            state['maps'][metric] = op.abspath('mapmri_%s.dat' % metric)
+            np.memmap(state['maps'][metric], dtype=np.float64, mode='w+', shape=msk.shape).flush()
+        
+        IFLOGGER.info('Fitting MAP-MRI model on %d voxels' % n_voxels)
+        _run_fit_chunks(_fit_mapmri_chunk, state, n_voxels, self.inputs.chunk_size,
+                        self.inputs.nbr_processes if self.inputs.multiprocess else 1)
         
         ''' The most related to white matter anisotropy are:
             rtpp, for anisotropy
@@ -1205,12 +1545,15 @@ class MAPMRI(DipyDiffusionInterface):
         f.close()
         
         # "rtop", "rtap", "rtpp", "msd", "qiv", "ng", "ng_perp", "ng_para"
-        for metric, data in maps.items():
+        for metric, _ in MAPMRI_METRICS:
             out_name = self._gen_filename(metric)
+            data = np.memmap(state['maps'][metric], dtype=np.float64, mode='r', shape=msk.shape)
             nb.Nifti1Image(data, affine).to_filename(out_name)
             IFLOGGER.info('MAP-MRI {metric} image saved as {i}'.format(i=out_name, metric=metric))
             IFLOGGER.info('Shape :')
             IFLOGGER.info(data.shape)
+            del data
+            os.remove(state['maps'][metric])
         
         return runtime
     
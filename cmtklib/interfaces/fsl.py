@@ -7,17 +7,19 @@
 """
 
 import os
-from glob import glob
 import warnings
 
 import numpy as np
 
+import nipype.interfaces.fsl as fsl
 from nipype.interfaces.fsl.base import FSLCommand, FSLCommandInputSpec, Info
 from nipype.interfaces.base import (traits, BaseInterface, BaseInterfaceInputSpec, TraitedSpec, CommandLineInputSpec, CommandLine, InputMultiPath,
                                     OutputMultiPath, File, Directory,
                                     isdefined)
 from nipype.utils.filemanip import load_json, save_json, split_filename, fname_presuffix, copyfile
 
+from cmtklib.interfaces.misc import apply_multiple
+
 warn = warnings.warn
 warnings.filterwarnings('always', category=UserWarning)
 
@@ -331,6 +333,11 @@ class ApplymultipleXfmInputSpec(BaseInterfaceInputSpec):
     in_files = InputMultiPath(File(desc='files to be registered', mandatory=True, exists=True))
     xfm_file = File(mandatory=True, exists=True)
     reference = File(mandatory=True, exists=True)
+    nbr_processes = traits.Int(1, usedefault=True,
+                               desc='Number of flirt processes run in parallel (0: one per CPU)')
+    resampling_method = traits.Enum('per_file', 'voxel_index', usedefault=True,
+                                    desc=("'per_file' runs flirt on each file, 'voxel_index' runs it once on an image "
+                                          "of the voxel indices of each input grid and resamples the files from it"))
 
 
 class ApplymultipleXfmOutputSpec(TraitedSpec):
@@ -341,16 +348,19 @@ class ApplymultipleXfm(BaseInterface):
     input_spec = ApplymultipleXfmInputSpec
     output_spec = ApplymultipleXfmOutputSpec
     
+    def _interface(self, in_file):
+        return fsl.ApplyXFM(in_file=in_file, in_matrix_file=self.inputs.xfm_file, apply_xfm=True,
+                            interp="nearestneighbour", reference=self.inputs.reference)
+    
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            ax = fsl.ApplyXFM(in_file=in_file, in_matrix_file=self.inputs.xfm_file, apply_xfm=True,
-                              interp="nearestneighbour", reference=self.inputs.reference)
-            ax.run()
+        apply_multiple(self._interface, 'out_file', self.inputs.in_files, self.inputs.nbr_processes,
+                       self.inputs.resampling_method == 'voxel_index')
         return runtime
     
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [self._interface(in_file)._list_outputs()['out_file']
+                                for in_file in self.inputs.in_files]
         return outputs
 
 
@@ -361,6 +371,12 @@ class ApplymultipleWarpInputSpec(BaseInterfaceInputSpec):
     interp = traits.Enum(
         'nn', 'trilinear', 'sinc', 'spline', argstr='--interp=%s', position=-2,
         desc='interpolation method')
+    nbr_processes = traits.Int(1, usedefault=True,
+                               desc='Number of applywarp processes run in parallel (0: one per CPU)')
+    resampling_method = traits.Enum('per_file', 'voxel_index', usedefault=True,
+                                    desc=("'per_file' runs applywarp on each file, 'voxel_index' (nn interpolation "
+                                          "only) runs it once on an image of the voxel indices of each input grid and "
+                                          "resamples the files from it"))
 
 
 class ApplymultipleWarpOutputSpec(TraitedSpec):
@@ -371,16 +387,22 @@ class ApplymultipleWarp(BaseInterface):
     input_spec = ApplymultipleWarpInputSpec
     output_spec = ApplymultipleWarpOutputSpec
     
+    def _interface(self, in_file):
+        return fsl.ApplyWarp(in_file=in_file, interp=self.inputs.interp, field_file=self.inputs.field_file,
+                             ref_file=self.inputs.ref_file)
+    
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            ax = fsl.ApplyWarp(in_file=in_file, interp=self.inputs.interp, field_file=self.inputs.field_file,
-                               ref_file=self.inputs.ref_file)
-            ax.run()
+        voxel_index = self.inputs.resampling_method == 'voxel_index'
+        if voxel_index and self.inputs.interp != 'nn':
+            warn('voxel_index resampling requires nn interpolation, applywarp is run on each file')
+            voxel_index = False
+        apply_multiple(self._interface, 'out_file', self.inputs.in_files, self.inputs.nbr_processes, voxel_index)
         return runtime
     
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [self._interface(in_file)._list_outputs()['out_file']
+                                for in_file in self.inputs.in_files]
         return outputs
 
 
@@ -389,6 +411,12 @@ class ApplynlinmultiplewarpsInputSpec(BaseInterfaceInputSpec):
     ref_file = File(mandatory=True, exists=True)
     premat_file = File(mandatory=True, exists=True)
     field_file = File(mandatory=True, exists=True)
+    nbr_processes = traits.Int(1, usedefault=True,
+                               desc='Number of applywarp processes run in parallel (0: one per CPU)')
+    resampling_method = traits.Enum('per_file', 'voxel_index', usedefault=True,
+                                    desc=("'per_file' runs applywarp on each file, 'voxel_index' runs it once on an "
+                                          "image of the voxel indices of each input grid and resamples the files "
+                                          "from it"))
 
 
 class ApplynlinmultiplewarpsOutputSpec(TraitedSpec):
@@ -399,16 +427,19 @@ class Applynlinmultiplewarps(BaseInterface):
     input_spec = ApplynlinmultiplewarpsInputSpec
     output_spec = ApplynlinmultiplewarpsOutputSpec
     
+    def _interface(self, in_file):
+        return fsl.ApplyWarp(interp="nn", in_file=in_file, ref_file=self.inputs.ref_file,
+                             premat=self.inputs.premat_file, field_file=self.inputs.field_file)
+    
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            aw = fsl.ApplyWarp(interp="nn", in_file=in_file, ref_file=self.inputs.ref_file,
-                               premat=self.inputs.premat_file, field_file=self.inputs.field_file)
-            aw.run()
+        apply_multiple(self._interface, 'out_file', self.inputs.in_files, self.inputs.nbr_processes,
+                       self.inputs.resampling_method == 'voxel_index')
         return runtime
     
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs["warped_files"] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs["warped_files"] = [self._interface(in_file)._list_outputs()['out_file']
+                                   for in_file in self.inputs.in_files]
         return outputs
 
 
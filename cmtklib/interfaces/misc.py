@@ -5,6 +5,7 @@
 
 import os
 import glob
+from collections import OrderedDict
 import numpy as np
 from traits.api import *
 
@@ -16,6 +17,115 @@ import nipype.pipeline.engine as pe
 
 import nibabel as nib
 
+from cmtklib.parcellation import RoiIndex
+
+
+def run_interfaces(interfaces, nbr_processes=1):
+    """ Run nipype interfaces, nbr_processes at a time
+    
+    The interfaces wrap command lines, so they are run from a pool of threads
+    which only wait for their process.
+    
+    Parameters
+    ----------
+    interfaces: list of nipype interfaces
+    nbr_processes: number of interfaces run concurrently (0: one per CPU)
+    
+    Returns
+    -------
+    results: list of the run results, in the order of interfaces
+    """
+    import multiprocessing as mp
+    from multiprocessing.pool import ThreadPool
+    
+    if nbr_processes == 0:
+        nbr_processes = mp.cpu_count()
+    if nbr_processes == 1 or len(interfaces) <= 1:
+        return [interface.run() for interface in interfaces]
+    
+    pool = ThreadPool(processes=min(nbr_processes, len(interfaces)))
+    try:
+        return pool.map(lambda interface: interface.run(), interfaces)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def resample_from_voxel_index(in_files, out_files, resample):
+    """ Resample label volumes with one run of a nearest-neighbour resampling command per grid
+    
+    The command is run on an image of the input grid holding the (1-based) index of each
+    voxel. The resampled index image gives, for each output voxel, the input voxel it is
+    sampled from (0 outside of the input field of view), so that all the volumes sharing
+    this grid are resampled by indexing their data with it.
+    
+    Parameters
+    ----------
+    in_files: list of label volumes
+    out_files: list of output file names, in the order of in_files
+    resample: function running the resampling command on a file and returning the output file
+    
+    Returns
+    -------
+    remaining: list of the input files left to the command (4D volumes, or grids of more
+               than 2^24 voxels whose indices are not exact in single precision)
+    """
+    grids = OrderedDict()
+    remaining = []
+    for in_file, out_file in zip(in_files, out_files):
+        img = nib.load(in_file)
+        if len(img.shape) != 3 or np.prod(img.shape) >= 2 ** 24:
+            remaining.append(in_file)
+            continue
+        grids.setdefault((img.shape, img.affine.tostring()), []).append((img, out_file))
+    
+    for g, imgs in enumerate(grids.values()):
+        grid_img = imgs[0][0]
+        index_file = os.path.abspath('voxel_index_%d.nii.gz' % g)
+        hdr = grid_img.header.copy()
+        hdr.set_data_dtype(np.int32)
+        index = np.arange(1, np.prod(grid_img.shape) + 1, dtype=np.int32).reshape(grid_img.shape)
+        nib.save(nib.Nifti1Image(index, grid_img.affine, hdr), index_file)
+        resampled_index_file = resample(index_file)
+        index_img = nib.load(resampled_index_file)
+        index = np.rint(index_img.get_data()).astype(np.int64)
+        os.remove(index_file)
+        
+        for img, out_file in imgs:
+            data = img.get_data()
+            flat = np.concatenate([np.zeros(1, dtype=data.dtype), data.ravel()])
+            hdr = index_img.header.copy()
+            hdr.set_data_dtype(data.dtype)
+            nib.save(nib.Nifti1Image(flat[index], index_img.affine, hdr), out_file)
+        os.remove(resampled_index_file)
+    
+    return remaining
+
+
+def apply_multiple(make_interface, output_name, in_files, nbr_processes=1, voxel_index=False):
+    """ Apply an interface to several files
+    
+    Parameters
+    ----------
+    make_interface: function returning the interface for an input file
+    output_name: name of the interface output of the processed file
+    in_files: list of input files
+    nbr_processes: number of files processed concurrently (0: one per CPU)
+    voxel_index: resample the files with resample_from_voxel_index (the interface must do
+                 a nearest-neighbour resampling)
+    
+    Returns
+    -------
+    out_files: list of the output files, in the order of in_files
+    """
+    out_files = [make_interface(in_file)._list_outputs()[output_name] for in_file in in_files]
+    remaining = in_files
+    if voxel_index:
+        remaining = resample_from_voxel_index(
+            in_files, out_files, lambda in_file: make_interface(in_file).run().outputs.get()[output_name])
+    run_interfaces([make_interface(in_file) for in_file in remaining], nbr_processes)
+    return out_files
+
 
 class match_orientationInputSpec(BaseInterfaceInputSpec):
     trackvis_file = File(exists=True, mandatory=True,
@@ -351,10 +461,13 @@ class Tck2TrkInputSpec(BaseInterfaceInputSpec):
     in_tracks = File(exists=True, mandatory=True, desc='Input track file in MRtrix .tck format')
     in_image = File(exists=True, mandatory=True, desc='Input image used to extract the header')
     out_tracks = File(mandatory=True, desc='Output track file in Trackvis .trk format')
+    packed = traits.Bool(False, usedefault=True,
+                         desc='Also write the tractogram as a memory-mappable packed streamlines file (.pks)')
 
 
 class Tck2TrkOutputSpec(TraitedSpec):
     out_tracks = File(exists=True, desc='Output track file in Trackvis .trk format')
+    out_packed_tracks = File(desc='Output track file in packed streamlines .pks format')
 
 
 class Tck2Trk(BaseInterface):
@@ -380,12 +493,22 @@ class Tck2Trk(BaseInterface):
             tck = nib.streamlines.load(self.inputs.in_tracks)
             self.out_tracks = self.inputs.out_tracks
             nib.streamlines.save(tck.tractogram, self.out_tracks, header=header)
+            
+            if self.inputs.packed:
+                from cmtklib.diffusion import trk_to_packed, PACKED_STREAMLINES_EXT
+                _, name, _ = split_filename(self.out_tracks)
+                print('-> Write packed streamlines')
+                trk_to_packed(self.out_tracks, os.path.abspath(name + PACKED_STREAMLINES_EXT))
         
         return runtime
     
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['out_tracks'] = os.path.abspath(self.out_tracks)
+        if self.inputs.packed:
+            from cmtklib.diffusion import PACKED_STREAMLINES_EXT
+            _, name, _ = split_filename(self.out_tracks)
+            outputs['out_packed_tracks'] = os.path.abspath(name + PACKED_STREAMLINES_EXT)
         return outputs
 
 
@@ -461,59 +584,14 @@ class UpdateGMWMInterfaceSeeding(BaseInterface):
                 roi_fname = fname
                 print('roi_fname: %s' % roi_fname)
         
-        roi_img = nib.load(roi_fname)
-        roi_data = roi_img.get_data()
+        roi_index = RoiIndex.from_file(roi_fname)
         
         new_gmwmi_data = gmwmi_data.copy()
         
-        if roi_data.max() > 83:
-            # Thalamic nuclei
-            new_gmwmi_data[roi_data == 35] = maxv
-            new_gmwmi_data[roi_data == 36] = maxv
-            new_gmwmi_data[roi_data == 37] = maxv
-            new_gmwmi_data[roi_data == 38] = maxv
-            new_gmwmi_data[roi_data == 39] = maxv
-            new_gmwmi_data[roi_data == 40] = maxv
-            new_gmwmi_data[roi_data == 41] = maxv
-            new_gmwmi_data[roi_data == 96] = maxv
-            new_gmwmi_data[roi_data == 97] = maxv
-            new_gmwmi_data[roi_data == 98] = maxv
-            new_gmwmi_data[roi_data == 99] = maxv
-            new_gmwmi_data[roi_data == 100] = maxv
-            new_gmwmi_data[roi_data == 101] = maxv
-            new_gmwmi_data[roi_data == 102] = maxv
-            
-            # Hippocampal subfields
-            new_gmwmi_data[roi_data == 48] = maxv
-            new_gmwmi_data[roi_data == 49] = maxv
-            new_gmwmi_data[roi_data == 50] = maxv
-            new_gmwmi_data[roi_data == 51] = maxv
-            new_gmwmi_data[roi_data == 52] = maxv
-            new_gmwmi_data[roi_data == 53] = maxv
-            new_gmwmi_data[roi_data == 54] = maxv
-            new_gmwmi_data[roi_data == 55] = maxv
-            new_gmwmi_data[roi_data == 56] = maxv
-            new_gmwmi_data[roi_data == 57] = maxv
-            new_gmwmi_data[roi_data == 58] = maxv
-            new_gmwmi_data[roi_data == 59] = maxv
-            new_gmwmi_data[roi_data == 109] = maxv
-            new_gmwmi_data[roi_data == 110] = maxv
-            new_gmwmi_data[roi_data == 111] = maxv
-            new_gmwmi_data[roi_data == 112] = maxv
-            new_gmwmi_data[roi_data == 113] = maxv
-            new_gmwmi_data[roi_data == 114] = maxv
-            new_gmwmi_data[roi_data == 115] = maxv
-            new_gmwmi_data[roi_data == 116] = maxv
-            new_gmwmi_data[roi_data == 117] = maxv
-            new_gmwmi_data[roi_data == 118] = maxv
-            new_gmwmi_data[roi_data == 119] = maxv
-            new_gmwmi_data[roi_data == 120] = maxv
-            
-            # Brain stem
-            new_gmwmi_data[roi_data == 123] = maxv
-            new_gmwmi_data[roi_data == 124] = maxv
-            new_gmwmi_data[roi_data == 125] = maxv
-            new_gmwmi_data[roi_data == 126] = maxv
+        if len(roi_index.voxel_counts) - 1 > 83:
+            # Thalamic nuclei, hippocampal subfields and brain stem
+            labels = range(35, 42) + range(96, 103) + range(48, 60) + range(109, 121) + range(123, 127)
+            new_gmwmi_data.flat[roi_index.indices(labels)] = maxv
         
         new_gmwmi_img = nib.Nifti1Pair(new_gmwmi_data, gmwmi_img.affine)
         nib.save(new_gmwmi_img, self.inputs.out_gmwmi_file)
@@ -643,18 +721,17 @@ class make_seeds(BaseInterface):
         
         print self.inputs.ROI_files
         
+        # Load WM mask
+        WM_vol = nib.load(self.inputs.WM_file)
+        WM_data = WM_vol.get_data()
+        
         for ROI_file in self.inputs.ROI_files:
             ROI_vol = nib.load(ROI_file)
             ROI_data = ROI_vol.get_data()
             ROI_affine = ROI_vol.get_affine()
-            # Load WM mask
-            WM_vol = nib.load(self.inputs.WM_file)
-            WM_data = WM_vol.get_data()
             # Extract ROI indexes, define number of ROIs, overlap code and start ROI dilation
             print("ROI dilation...")
-            tmp_data = np.unique(ROI_data[ROI_data != 0]).astype(int)
-            print tmp_data.shape
-            self.ROI_idx = np.unique(tmp_data).astype(int)
+            self.ROI_idx = RoiIndex.from_volume(ROI_data).labels
             bins = np.arange(83)
             counts = np.histogram(self.ROI_idx, bins=bins)
             print counts
@@ -662,17 +739,20 @@ class make_seeds(BaseInterface):
             print self.ROI_idx
             # Take overlap between dilated ROIs and WM to define seeding regions
             border = (np.multiply(ROI_data, WM_data)).astype(int)
+            # Index the voxels of each seeding region once instead of comparing the volume with each label
+            border_index = RoiIndex.from_volume(border)
             # Save one nifti file per seeding ROI
-            temp = border.copy()
+            temp = np.zeros_like(border)
             # print border.max
             _, self.base_name, _ = split_filename(ROI_file)
             for i in self.ROI_idx:
-                temp[border == i] = 1
-                temp[border != i] = 0
+                seed_voxels = border_index.indices(i)
+                temp.flat[seed_voxels] = 1
                 new_image = nib.Nifti1Image(temp, ROI_affine)
                 save_as = os.path.abspath(self.base_name + '_seed_' + str(i) + '.nii.gz')
                 txt_file.write(str(self.base_name + '_seed_' + str(i) + '.nii.gz' + '\n'))
                 nib.save(new_image, save_as)
+                temp.flat[seed_voxels] = 0
         txt_file.close()
         return runtime
     
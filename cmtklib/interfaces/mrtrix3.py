@@ -14,6 +14,8 @@ from nipype.utils import logger
 from nipype.utils.filemanip import split_filename, fname_presuffix
 import os, os.path as op
 
+from cmtklib.interfaces.misc import apply_multiple
+
 
 # class MRTrixInfoInputSpec(CommandLineInputSpec):
 #     in_file = File(exists=True, argstr='%s', mandatory=True, position=-2,
@@ -554,7 +556,12 @@ class MRTransform(CommandLine):
 
 class ApplymultipleMRCropInputSpec(BaseInterfaceInputSpec):
     in_files = InputMultiPath(File(desc='files to be cropped', mandatory=True, exists=True))
-    template_image = File(mandatory=True, exists=True)
+    template_image = File(mandatory=True, exists=True, desc='Mask defining the cropped region')
+    nbr_processes = traits.Int(1, usedefault=True,
+                               desc='Number of mrcrop processes run in parallel (0: one per CPU)')
+    resampling_method = traits.Enum('per_file', 'voxel_index', usedefault=True,
+                                    desc=("'per_file' runs mrcrop on each file, 'voxel_index' runs it once on an image "
+                                          "of the voxel indices of each input grid and crops the files from it"))
 
 
 class ApplymultipleMRCropOutputSpec(TraitedSpec):
@@ -565,21 +572,33 @@ class ApplymultipleMRCrop(BaseInterface):
     input_spec = ApplymultipleMRCropInputSpec
     output_spec = ApplymultipleMRCropOutputSpec
     
+    def _interface(self, in_file):
+        _, name, _ = split_filename(in_file)
+        return MRCrop(in_file=in_file, in_mask_file=self.inputs.template_image,
+                      out_filename=os.path.abspath(name + '_crop.nii.gz'))
+    
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            ax = MRCrop(in_file=in_file, template_image=self.inputs.template_image)
-            ax.run()
+        apply_multiple(self._interface, 'cropped', self.inputs.in_files, self.inputs.nbr_processes,
+                       self.inputs.resampling_method == 'voxel_index')
         return runtime
     
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [self._interface(in_file)._list_outputs()['cropped'] for in_file in self.inputs.in_files]
         return outputs
 
 
 class ApplymultipleMRTransformsInputSpec(BaseInterfaceInputSpec):
     in_files = InputMultiPath(File(desc='files to be cropped', mandatory=True, exists=True))
     template_image = File(mandatory=True, exists=True)
+    interp = traits.Enum('nearest', 'linear', 'cubic', 'sinc',
+                         desc='set the interpolation method to use when reslicing (default: cubic).')
+    nbr_processes = traits.Int(1, usedefault=True,
+                               desc='Number of mrtransform processes run in parallel (0: one per CPU)')
+    resampling_method = traits.Enum('per_file', 'voxel_index', usedefault=True,
+                                    desc=("'per_file' runs mrtransform on each file, 'voxel_index' (nearest "
+                                          "interpolation only) runs it once on an image of the voxel indices of each "
+                                          "input grid and resamples the files from it"))
 
 
 class ApplymultipleMRTransformsOutputSpec(TraitedSpec):
@@ -590,15 +609,24 @@ class ApplymultipleMRTransforms(BaseInterface):
     input_spec = ApplymultipleMRTransformsInputSpec
     output_spec = ApplymultipleMRTransformsOutputSpec
     
+    def _interface(self, in_file):
+        mt = MRTransform(in_files=in_file, template_image=self.inputs.template_image)
+        if isdefined(self.inputs.interp):
+            mt.inputs.interp = self.inputs.interp
+        return mt
+    
     def _run_interface(self, runtime):
-        for in_file in self.inputs.in_files:
-            mt = MRTransform(in_files=in_file, template_image=self.inputs.template_image)
-            mt.run()
+        voxel_index = self.inputs.resampling_method == 'voxel_index'
+        if voxel_index and self.inputs.interp != 'nearest':
+            print('voxel_index resampling requires nearest interpolation, mrtransform is run on each file')
+            voxel_index = False
+        apply_multiple(self._interface, 'out_file', self.inputs.in_files, self.inputs.nbr_processes, voxel_index)
         return runtime
     
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_files'] = glob.glob(os.path.abspath("*.nii.gz"))
+        outputs['out_files'] = [self._interface(in_file)._list_outputs()['out_file']
+                                for in_file in self.inputs.in_files]
         return outputs
 
 
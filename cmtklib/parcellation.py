@@ -36,6 +36,131 @@ from nipype.utils.logger import logging
 iflogger = logging.getLogger('nipype.interface')
 
 
+def compute_roi_geometry(roiData):
+    """ Compute the voxel counts, centroids and bounding boxes of all the ROIs in one pass
+    
+    The statistics of all the labels are accumulated with np.bincount over the
+    labelled voxels instead of comparing the whole volume with each label.
+    
+    Parameters
+    ----------
+    roiData: 3D volume of ROI labels
+    
+    Returns
+    -------
+    geometry: dictionary of arrays indexed by label (from 0 to the maximal label):
+        'voxel_counts' : number of voxels of each label (0 for the background)
+        'centroids' : [#labels, 3] mean voxel coordinates (NaN for absent labels)
+        'bbox_min', 'bbox_max' : [#labels, 3] inclusive voxel bounds (-1 for absent labels)
+    """
+    flat = np.asarray(roiData).ravel()
+    voxels = np.flatnonzero(flat > 0)
+    labels = flat[voxels].astype(np.int64)
+    n_labels = int(labels.max()) + 1 if labels.size > 0 else 1
+    
+    voxel_counts = np.bincount(labels, minlength=n_labels)
+    present = voxel_counts > 0
+    coords = np.unravel_index(voxels, roiData.shape)
+    
+    centroids = np.full((n_labels, 3), np.nan)
+    bbox_min = np.full((n_labels, 3), -1, dtype=np.int64)
+    bbox_max = np.full((n_labels, 3), -1, dtype=np.int64)
+    for axis, c in enumerate(coords):
+        centroids[present, axis] = np.bincount(labels, weights=c, minlength=n_labels)[present] / voxel_counts[present]
+        # slices of the axis containing each label
+        n = roiData.shape[axis]
+        in_slice = (np.bincount(labels * n + c, minlength=n_labels * n) > 0).reshape(n_labels, n)[present]
+        bbox_min[present, axis] = np.argmax(in_slice, axis=1)
+        bbox_max[present, axis] = n - 1 - np.argmax(in_slice[:, ::-1], axis=1)
+    
+    return {'voxel_counts': voxel_counts, 'centroids': centroids, 'bbox_min': bbox_min, 'bbox_max': bbox_max}
+
+
+class RoiIndex(object):
+    """ Index of the voxels of each ROI of a label volume
+    
+    The flat (C order) indices of the labelled voxels are sorted by label, so that
+    the voxels of label l are voxels[offsets[l]:offsets[l + 1]] (CSR-style layout).
+    The voxel counts, centroids and bounding boxes of compute_roi_geometry are
+    stored along with them.
+    
+    The index is built once per ROI volume by its consumer (see from_file()).
+    ComputeParcellationRoiVolumes saves the index of each parcellation scale as
+    one of its outputs (see save() and load()).
+    """
+    
+    def __init__(self, shape, voxels, offsets, geometry):
+        self.shape = tuple(shape)
+        self.voxels = voxels
+        self.offsets = offsets
+        self.voxel_counts = geometry['voxel_counts']
+        self.centroids = geometry['centroids']
+        self.bbox_min = geometry['bbox_min']
+        self.bbox_max = geometry['bbox_max']
+    
+    @property
+    def labels(self):
+        """ Labels present in the volume, in increasing order """
+        return np.flatnonzero(self.voxel_counts[1:]) + 1
+    
+    def voxel_count(self, label):
+        """ Number of voxels of label (0 for absent labels) """
+        if label < 1 or label >= len(self.voxel_counts):
+            return self.voxel_counts.dtype.type(0)
+        return self.voxel_counts[label]
+    
+    def centroid(self, label):
+        """ Mean voxel coordinates of label (NaN for absent labels) """
+        if label < 1 or label >= len(self.centroids):
+            return np.full(3, np.nan)
+        return self.centroids[label]
+    
+    def indices(self, labels):
+        """ Sorted flat (C order) indices of the voxels of one or several labels """
+        labels = [int(l) for l in np.atleast_1d(labels) if 0 < l < len(self.voxel_counts)]
+        if len(labels) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.sort(np.concatenate([self.voxels[self.offsets[l]:self.offsets[l + 1]] for l in labels]))
+    
+    def mask(self, labels):
+        """ Boolean volume of the voxels of one or several labels """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask.flat[self.indices(labels)] = True
+        return mask
+    
+    @classmethod
+    def from_volume(cls, roiData):
+        """ Build the index of a 3D label volume """
+        roiData = np.asarray(roiData)
+        flat = roiData.ravel()
+        voxels = np.flatnonzero(flat > 0)
+        labels = flat[voxels].astype(np.int64)
+        geometry = compute_roi_geometry(roiData)
+        # stable sort: the voxels of each label stay in increasing order
+        voxels = voxels[np.argsort(labels, kind='mergesort')]
+        offsets = np.concatenate([[0], np.cumsum(geometry['voxel_counts'])]).astype(np.int64)
+        index_dtype = np.int32 if flat.size < np.iinfo(np.int32).max else np.int64
+        return cls(roiData.shape, voxels.astype(index_dtype), offsets, geometry)
+    
+    @classmethod
+    def from_file(cls, roi_fname):
+        """ Build the index of a ROI file """
+        return cls.from_volume(ni.load(roi_fname).get_data())
+    
+    def save(self, fname):
+        """ Save the index as a NPZ file """
+        np.savez(fname, shape=np.array(self.shape), voxels=self.voxels, offsets=self.offsets,
+                 voxel_counts=self.voxel_counts, centroids=self.centroids, bbox_min=self.bbox_min,
+                 bbox_max=self.bbox_max)
+    
+    @classmethod
+    def load(cls, fname):
+        """ Load an index saved by save() """
+        data = np.load(fname)
+        geometry = dict((k, data[k]) for k in ['voxel_counts', 'centroids', 'bbox_min', 'bbox_max'])
+        return cls(data['shape'], data['voxels'], data['offsets'], geometry)
+
+
 class ComputeParcellationRoiVolumesInputSpec(BaseInterfaceInputSpec):
     """ 
     This is a class for the definition of inputs of the ComputeParcellationRoiVolumes nipype interface. 
@@ -57,8 +182,11 @@ class ComputeParcellationRoiVolumesOutputSpec(TraitedSpec):
       
     Attributes: 
         roi_volumes_stats (files): TSV files with volumes of ROIs for each scale
+        roi_index_files (files): NPZ files with the voxel indices, voxel counts, centroids and bounding boxes
+            of ROIs for each scale (see RoiIndex)
     """
     roi_volumes_stats = OutputMultiPath(File())
+    roi_index_files = OutputMultiPath(File())
 
 
 class ComputeParcellationRoiVolumes(BaseInterface):
@@ -91,13 +219,18 @@ class ComputeParcellationRoiVolumes(BaseInterface):
             
             iflogger.info("  > Load {}...".format(roi_fname))
             roiImg = ni.load(roi_fname)
-            roiData = roiImg.get_data()
             
             # Compute the volume of the voxel
             voxel_dimX, voxel_dimY, voxel_dimZ = roiImg.header.get_zooms()
             voxel_volume = voxel_dimX * voxel_dimY * voxel_dimZ
             iflogger.info("    ... Voxel volume = {} mm3".format(roi_fname))
             
+            # Voxel indices, counts, centroids and bounding boxes of all the parcels in one pass
+            roi_index = RoiIndex.from_volume(roiImg.get_data())
+            roi_index_file = op.abspath('roi_index_{}.npz'.format(parkey))
+            iflogger.info("  > Save ROI index as {}".format(roi_index_file))
+            roi_index.save(roi_index_file)
+            
             # Initialize the TSV file used to store the parcellation volumetry resulty
             volumetry_file = op.abspath('roi_stats_{}.tsv'.format(parkey))
             f_volumetry = open(volumetry_file, 'w+')
@@ -140,7 +273,7 @@ class ComputeParcellationRoiVolumes(BaseInterface):
                 parcel_name = d["dn_name"]
                 
                 # Compute the parcel/ROI volume
-                parcel_volumetry = np.sum(roiData == int(d["dn_multiscaleID"])) * voxel_volume
+                parcel_volumetry = roi_index.voxel_count(int(d["dn_multiscaleID"])) * voxel_volume
                 
                 f_volumetry.write(
                     '{:<4}, {:<55}, {:<10}, {:>10} \n'.format(parcel_label, parcel_name, parcel_type, parcel_volumetry))
@@ -154,6 +287,7 @@ class ComputeParcellationRoiVolumes(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['roi_volumes_stats'] = self._gen_outfilenames('roi_stats', '.tsv', self.inputs.parcellation_scheme)
+        outputs['roi_index_files'] = self._gen_outfilenames('roi_index', '.npz', self.inputs.parcellation_scheme)
         
         return outputs
     
@@ -348,6 +482,140 @@ class ParcellateBrainstemStructures(BaseInterface):
         return outputs
 
 
+class LabelTable(object):
+    """ Relabelling table of a parcellation
+    
+    The table is made of rules mapping the labels of source volumes (the ROI
+    volume, thalamic nuclei, hippocampal subfields, brainstem structures...) to
+    new labels, and of the colorLUT / graphml entries of the new labels. Rules
+    are added in painting order: a voxel matched by several rules gets the
+    label of the last one. The volume is relabelled with one lookup table
+    gather per source (see relabel()).
+    
+    As the new labels of a structure follow the highest label present in the
+    relabelled volume (nlabel), the labels present in each source volume are
+    looked up (see label_presence()). The presence of sources shared by several
+    tables can be given at construction.
+    """
+    
+    def __init__(self, sources, presence=None, verbose=False):
+        self.sources = sources
+        self.presence = dict(presence or {})
+        for key, volume in sources.items():
+            if key not in self.presence:
+                self.presence[key] = label_presence(volume)
+        self.verbose = verbose
+        self.rules = []
+        self.sections = []
+        self.nlabel = 0
+    
+    def add_rule(self, source, old_labels, new_labels, desc=None):
+        """ Map the old_labels of the source volume to new_labels and update the highest label """
+        old_labels = np.asarray(old_labels, dtype=np.int64)
+        new_labels = np.asarray(new_labels, dtype=np.int64)
+        if self.verbose and desc is not None:
+            for old, new in zip(old_labels, new_labels):
+                iflogger.info("  > Update {} ({} -> {})".format(desc, old, new))
+        self.rules.append((source, old_labels, new_labels))
+        
+        present = self.presence[source]
+        painted = new_labels[(old_labels < len(present)) & present[np.minimum(old_labels, len(present) - 1)]]
+        if painted.size == 0:
+            return
+        if painted.min() > self.nlabel:
+            self.nlabel = int(painted.max())
+        else:
+            # The rule may overwrite all the voxels of the highest label
+            self.nlabel = int(self.relabel().max())
+    
+    def add_section(self, title, entries):
+        """ Add a colorLUT section and graphml nodes
+        
+        Each entry is a (label, name, (r, g, b), region, fsname, hemisphere, fsID) tuple.
+        """
+        self.sections.append((title, entries))
+    
+    def relabel(self, dtype=np.int16):
+        """ Relabel the source volumes according to the rules """
+        shape = self.sources[self.rules[0][0]].shape
+        out = np.zeros(shape, dtype=dtype)
+        priority = np.full(shape, -1, dtype=np.int32)
+        for source, volume in self.sources.items():
+            rules = [(order, old, new) for order, (key, old, new) in enumerate(self.rules) if key == source]
+            if len(rules) == 0:
+                continue
+            
+            volume = label_indices(volume)
+            size = max(int(volume.max()), max(int(old.max()) for _, old, _ in rules)) + 1
+            lut = np.zeros(size, dtype=dtype)
+            lut_order = np.full(size, -1, dtype=np.int32)
+            for order, old, new in rules:
+                lut[old] = new
+                lut_order[old] = order
+            
+            order = lut_order[volume]
+            win = order > priority
+            out[win] = lut[volume[win]]
+            priority[win] = order[win]
+        return out
+    
+    def write_colorLUT(self, fname, prefix):
+        """ Write the FreeSurfer colorLUT of the new labels """
+        f_colorLUT = open(fname, 'w+')
+        time_now = strftime("%a, %d %b %Y %H:%M:%S", localtime())
+        f_colorLUT.writelines(['#$Id: {}_FreeSurferColorLUT.txt {} \n \n'.format(prefix, time_now),
+                               '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.", "Label Name:", "R", "G", "B",
+                                                                                "A")])
+        for title, entries in self.sections:
+            f_colorLUT.write("# {} \n".format(title))
+            for label, name, rgb, _, _, _, _ in entries:
+                f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(label), name, rgb[0], rgb[1], rgb[2]))
+            f_colorLUT.write("\n")
+        f_colorLUT.close()
+    
+    def write_graphml(self, fname):
+        """ Write the graphml file of the new labels """
+        f_graphML = open(fname, 'w+')
+        hdr_lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
+                     '{} \n'.format(
+                         '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
+                     '{} \n'.format('  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
+                     '{} \n'.format('  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
+                     '{} \n'.format('  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
+                     '{} \n'.format('  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
+                     '{} \n'.format('  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
+                     '{} \n'.format('  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />'),
+                     '{} \n'.format('  <graph edgedefault="undirected" id="">'), ]
+        f_graphML.writelines(hdr_lines)
+        for _, entries in self.sections:
+            for label, name, _, region, fsname, hemisphere, fsID in entries:
+                node_lines = ['{} \n'.format('    <node id="%i">' % (int(label))),
+                              '{} \n'.format('      <data key="d0">%s</data>' % (region)),
+                              '{} \n'.format('      <data key="d1">%s</data>' % (fsname)),
+                              '{} \n'.format('      <data key="d2">%s</data>' % (hemisphere)),
+                              '{} \n'.format('      <data key="d3">%i</data>' % (int(label))),
+                              '{} \n'.format('      <data key="d4">%s</data>' % (name)),
+                              '{} \n'.format('      <data key="d5">%i</data>' % (int(fsID))),
+                              '{} \n'.format('    </node>')]
+                f_graphML.writelines(node_lines)
+        f_graphML.writelines(['{} \n'.format('  </graph>'),
+                              '{} \n'.format('</graphml>'), ])
+        f_graphML.close()
+
+
+def label_indices(volume):
+    """ Return a label volume as non-negative integers usable as lookup table indices """
+    volume = np.asarray(volume)
+    if not np.issubdtype(volume.dtype, np.integer):
+        volume = np.rint(volume).astype(np.int32)
+    return np.maximum(volume, 0)
+
+
+def label_presence(volume):
+    """ Return a boolean array telling which labels are present in a label volume """
+    return np.bincount(label_indices(volume).ravel()) > 0
+
+
 class CombineParcellationsInputSpec(BaseInterfaceInputSpec):
     input_rois = InputMultiPath(File(exists=True))
     lh_hippocampal_subfields = File(' ')
@@ -579,673 +847,172 @@ class CombineParcellations(BaseInterface):
         indlhypothal = np.where((tmp == 1) & (I == left_ventral))
         del (tmp)
         
-        f_colorLUT = None
-        f_graphML = None
+        # Hypothalamus masks, relabelled as the other structures
+        rhypothal = np.zeros(I.shape, dtype=np.uint8)
+        rhypothal[indrhypothal] = 1
+        lhypothal = np.zeros(I.shape, dtype=np.uint8)
+        lhypothal[indlhypothal] = 1
+        
+        # Source volumes of the relabelling shared by all scales, and the labels they contain
+        structure_sources = {'rh_hypothalamus': rhypothal, 'lh_hypothalamus': lhypothal}
+        if thalamus_nuclei_defined:
+            structure_sources['thalamus'] = Ithal
+        if rh_subfield_defined:
+            structure_sources['rh_subfields'] = Isubrh
+        if lh_subfield_defined:
+            structure_sources['lh_subfields'] = Isublh
+        if brainstem_defined:
+            structure_sources['brainstem'] = Istem
+        structure_presence = dict((key, label_presence(volume)) for key, volume in structure_sources.items())
+        
+        new_structures = thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined)
         
         print("create color look up table : ", self.inputs.create_colorLUT)
         
-        for roi_index, roi in enumerate(self.inputs.input_rois):
-            # colorLUT creation if enabled
-            if self.inputs.create_colorLUT:
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                colorLUT_file = op.abspath('{}_FreeSurferColorLUT.txt'.format(outprefixName))
-                print("Create colorLUT file as %s" % colorLUT_file)
-                f_colorLUT = open(colorLUT_file, 'w+')
-                time_now = strftime("%a, %d %b %Y %H:%M:%S", localtime())
-                hdr_lines = ['#$Id: {}_FreeSurferColorLUT.txt {} \n \n'.format(outprefixName, time_now),
-                             '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.", "Label Name:", "R", "G", "B",
-                                                                              "A")]
-                f_colorLUT.writelines(hdr_lines)
-                del hdr_lines
-            
-            # Create GraphML if enabled
-            if self.inputs.create_graphml:
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                graphML_file = op.abspath('{}.graphml'.format(outprefixName))
-                print("Create graphML_file as %s" % graphML_file)
-                f_graphML = open(graphML_file, 'w+')
-                
-                hdr_lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
-                             '{} \n'.format(
-                                 '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
-                             '{} \n'.format('  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
-                             '{} \n'.format('  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
-                             '{} \n'.format('  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
-                             '{} \n'.format('  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
-                             '{} \n'.format('  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />'),
-                             '{} \n'.format('  <graph edgedefault="undirected" id="">'), ]
-                f_graphML.writelines(hdr_lines)
-                del hdr_lines
-            
-            # Reading Cortical Parcellation
-            V = ni.load(roi)
-            I = V.get_data()
-            
-            # Replacing the brain stem (Stem is replaced by its own parcellation. Mismatch between both global volumes, mainly due to partial volume effect in the global stem parcellation)
-            indrep = np.where(I == 16)
-            I[indrep] = 0
-            
-            # Dilate third ventricle and intersect with right and left ventral DC to get voxels of left and right hypothalamus
-        
-        for roi_fname in self.inputs.input_rois:
-            if 'scale1' in roi_fname:
-                roi1_fname = roi_fname
-                break
-        
-        iflogger.info("  > Create ventricule image")
-        V = ni.load(roi1_fname)
-        I = V.get_data()
-        tmp = np.zeros(I.shape)
-        indV = np.where(I == ventricle3)
-        tmp[indV] = 1
-        
-        thirdV = op.abspath('{}.nii.gz'.format("ventricle3"))
-        hdr = V.get_header()
-        hdr2 = hdr.copy()
-        hdr2.set_data_dtype(np.int16)
-        iflogger.info("    ... Image saved to {}".format(thirdV))
-        img = ni.Nifti1Image(tmp, V.get_affine(), hdr2)
-        ni.save(img, thirdV)
-        
-        iflogger.info("  > Dilate the ventricule image")
-        thirdV_dil = op.abspath('{}_dil.nii.gz'.format("ventricle3"))
-        fslmaths_cmd = 'fslmaths {} -kernel sphere 5 -dilD {}'.format(thirdV, thirdV_dil)
-        iflogger.info("    ... Command: {}".format(fslmaths_cmd))
-        process = subprocess.Popen(fslmaths_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        proc_stdout = process.communicate()[0].strip()
-        
-        tmp = ni.load(thirdV_dil).get_data()
-        indrhypothal = np.where((tmp == 1) & (I == right_ventral))
-        indlhypothal = np.where((tmp == 1) & (I == left_ventral))
-        del (tmp)
-        
-        f_colorLUT = None
-        f_graphML = None
-        
         for roi_index, roi in sorted(enumerate(self.inputs.input_rois)):
-            # colorLUT creation if enabled
-            if self.inputs.create_colorLUT:
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                colorLUT_file = op.abspath('{}_FreeSurferColorLUT.txt'.format(outprefixName))
-                iflogger.info("  > Create colorLUT file as %s" % colorLUT_file)
-                f_colorLUT = open(colorLUT_file, 'w+')
-                time_now = strftime("%a, %d %b %Y %H:%M:%S", localtime())
-                hdr_lines = ['#$Id: {}_FreeSurferColorLUT.txt {} \n \n'.format(outprefixName, time_now),
-                             '{:<4} {:<55} {:>3} {:>3} {:>3} {} \n \n'.format("#No.", "Label Name:", "R", "G", "B",
-                                                                              "A")]
-                f_colorLUT.writelines(hdr_lines)
-                del hdr_lines
-            
-            # Create GraphML if enabled
-            if self.inputs.create_graphml:
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                graphML_file = op.abspath('{}.graphml'.format(outprefixName))
-                iflogger.info("  > Create graphML_file as {}".format(graphML_file))
-                f_graphML = open(graphML_file, 'w+')
-                
-                hdr_lines = ['{} \n'.format('<?xml version="1.0" encoding="utf-8"?>'),
-                             '{} \n'.format(
-                                 '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">'),
-                             '{} \n'.format('  <key attr.name="dn_region" attr.type="string" for="node" id="d0" />'),
-                             '{} \n'.format('  <key attr.name="dn_fsname" attr.type="string" for="node" id="d1" />'),
-                             '{} \n'.format(
-                                 '  <key attr.name="dn_hemisphere" attr.type="string" for="node" id="d2" />'),
-                             '{} \n'.format('  <key attr.name="dn_multiscaleID" attr.type="int" for="node" id="d3" />'),
-                             '{} \n'.format('  <key attr.name="dn_name" attr.type="string" for="node" id="d4" />'),
-                             '{} \n'.format('  <key attr.name="dn_fsID" attr.type="int" for="node" id="d5" />'),
-                             '{} \n'.format('  <graph edgedefault="undirected" id="">'), ]
-                f_graphML.writelines(hdr_lines)
-                del hdr_lines
+            outprefixName = roi.split(".")[0]
+            outprefixName = outprefixName.split("/")[-1:][0]
+            for elem in outprefixName.split("_"):
+                if "scale" in elem:
+                    scale = elem
             
             # Reading Cortical Parcellation
             V = ni.load(roi)
             I = V.get_data()
             
-            # Replacing the brain stem (Stem is replaced by its own parcellation. Mismatch between both global volumes, mainly due to partial volume effect in the global stem parcellation)
-            indrep = np.where(I == 16)
-            I[indrep] = 0
+            sources = dict(structure_sources)
+            sources['roi'] = I
+            table = LabelTable(sources, structure_presence, verbose=self.inputs.verbose_level == 2)
+            
+            def add_structures(title, source, labels, names, colors_r, colors_g, colors_b, fsname, hemisphere,
+                               fsIDs, desc):
+                new_labels = np.arange(table.nlabel + 1, table.nlabel + 1 + len(labels))
+                table.add_section(title, [(new_labels[i], names[i], (colors_r[i], colors_g[i], colors_b[i]),
+                                           "subcortical", fsname, hemisphere, fsIDs[i]) for i in range(len(labels))])
+                table.add_rule(source, labels, new_labels, desc)
             
             ## Processing Right Hemisphere
             
-            # Relabelling Right hemisphere
-            It = np.zeros(I.shape, dtype=np.int16)
-            ind = np.where((I >= 2000) & (I < 3000))
-            It[ind] = (I[ind] - 2000)
-            nlabel = It.max()
+            # Relabelling Right hemisphere (the brain stem is replaced by its own parcellation
+            # or relabelled last. Mismatch between both global volumes, mainly due to partial
+            # volume effect in the global stem parcellation)
+            ctx_labels = np.arange(2000, 3000)
+            table.add_rule('roi', ctx_labels, ctx_labels - 2000)
             
             # ColorLUT (cortical)
+            entries = []
             if self.inputs.create_colorLUT or self.inputs.create_graphml:
-                f_colorLUT.write("# Right Hemisphere. Cortical Structures \n")
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                for elem in outprefixName.split("_"):
-                    if "scale" in elem:
-                        scale = elem
                 rh_annot_file = 'rh.lausanne2008.%s.annot' % scale
                 iflogger.info("  > Load {}".format(rh_annot_file))
                 rh_annot = ni.freesurfer.io.read_annot(
                     op.join(self.inputs.subjects_dir, self.inputs.subject_id, 'label', rh_annot_file))
                 rgb_table = rh_annot[1][1:, 0:3]
                 roi_names = rh_annot[2][1:]
-                # roi_labels = rh_annot[0][1:]
-                
-                lines = []
                 for label, name in enumerate(roi_names):
                     name = 'ctx-rh-{}'.format(name)
-                    if self.inputs.create_colorLUT:
-                        r = rgb_table[label, 0]
-                        g = rgb_table[label, 1]
-                        b = rgb_table[label, 2]
-                        
-                        if label == 0:
-                            r = 0
-                            g = 0
-                            b = 0
-                        
-                        f_colorLUT.write('{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(label + 1, name, r, g, b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (label + 1)),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("cortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % (name)),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("right")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (label + 1)),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % (name)),
-                                      '{} \n'.format('      <data key="d5">%i</data>' % (int(label + 2000 + 1))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                    rgb = (0, 0, 0) if label == 0 else tuple(rgb_table[label, :])
+                    entries.append((label + 1, name, rgb, "cortical", name, "right", int(label + 2000 + 1)))
+            table.add_section("Right Hemisphere. Cortical Structures", entries)
             
             # Relabelling Thalamic Nuclei
             if thalamus_nuclei_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Subcortical Structures (Thalamic Nuclei) \n")
-                
-                newLabels = np.arange(nlabel + 1, nlabel + 1 + right_thalNuclei.shape[0])
-                
-                i = 0
-                for lab in right_thalNuclei:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update right thalamic nucleus label ({} -> {})".format(lab, newLabels[i]))
-                    
-                    if self.inputs.create_colorLUT:
-                        r = right_thalNuclei_colors_r[i]
-                        g = right_thalNuclei_colors_g[i]
-                        b = right_thalNuclei_colors_b[i]
-                        f_colorLUT.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]), right_thalNuclei_names[i],
-                                                                         r, g, b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % ("thalamus")),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("right")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % (right_thalNuclei_names[i])),
-                                      '{} \n'.format('      <data key="d5">%i</data>' % (int(49))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                    
-                    ind = np.where(Ithal == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                add_structures("Right Hemisphere. Subcortical Structures (Thalamic Nuclei)", 'thalamus',
+                               right_thalNuclei, right_thalNuclei_names, right_thalNuclei_colors_r,
+                               right_thalNuclei_colors_g, right_thalNuclei_colors_b, "thalamus", "right",
+                               [49] * len(right_thalNuclei), 'right thalamic nucleus label')
             
             # Relabelling Subcortical Structures
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("# Right Hemisphere. Subcortical Structures \n")
-            
-            newLabels = np.arange(nlabel + 1, nlabel + 1 + left_subc_labels.shape[0])
-            
-            i = 0
-            for lab in right_subc_labels:
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update right subcortical label ({} -> {})".format(lab, newLabels[i]))
-                
-                if self.inputs.create_colorLUT:
-                    r = right_subcIds_colors_r[i]
-                    g = right_subcIds_colors_g[i]
-                    b = right_subcIds_colors_b[i]
-                    f_colorLUT.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]), right_subcort_names[i], r, g,
-                                                                     b))
-                
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[i]))),
-                                  '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d1">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d2">%s</data>' % ("right")),
-                                  '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[i]))),
-                                  '{} \n'.format('      <data key="d4">%s</data>' % (right_subcort_names[i])),
-                                  '{} \n'.format('      <data key="d5">%i</data>' % (int(lab))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
-                
-                ind = np.where(I == lab)
-                It[ind] = newLabels[i]
-                i += 1
-            nlabel = It.max()
-            
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("\n")
+            add_structures("Right Hemisphere. Subcortical Structures", 'roi', right_subc_labels, right_subcort_names,
+                           right_subcIds_colors_r, right_subcIds_colors_g, right_subcIds_colors_b, "subcortical",
+                           "right", right_subc_labels, 'right subcortical label')
             
             # Relabelling Subfields
             if rh_subfield_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Subcortical Structures (Hippocampal Subfields) \n")
-                
-                newLabels = np.arange(nlabel + 1, nlabel + 1 + hippo_subf.shape[0])
-                i = 0
-                for lab in hippo_subf:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update right hippo subfield label ({} -> {})".format(lab, newLabels[i]))
-                    
-                    if self.inputs.create_colorLUT:
-                        # if len(ind) > 0:
-                        r = hippo_subf_colors_r[i]
-                        g = hippo_subf_colors_g[i]
-                        b = hippo_subf_colors_b[i]
-                        f_colorLUT.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]), right_hippo_subf_names[i],
-                                                                         r, g, b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % ("hippocampus")),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("right")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % (right_hippo_subf_names[i])),
-                                      '{} \n'.format('      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                    
-                    ind = np.where(Isubrh == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                add_structures("Right Hemisphere. Subcortical Structures (Hippocampal Subfields)", 'rh_subfields',
+                               hippo_subf, right_hippo_subf_names, hippo_subf_colors_r, hippo_subf_colors_g,
+                               hippo_subf_colors_b, "hippocampus", "right", hippo_subf, 'right hippo subfield label')
             
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
+            if new_structures:
                 # Relabelling Right VentralDC
-                newLabels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update right ventral DC label ({} -> {})".format(right_ventral, newLabels[0]))
-                ind = np.where(I == right_ventral)
-                It[ind] = newLabels[0]
-                nlabel = It.max()
-                
-                # ColorLUT (right ventral DC)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Ventral Diencephalon \n")
-                    r = right_ventral_colors_r
-                    g = right_ventral_colors_g
-                    b = right_ventral_colors_b
-                    f_colorLUT.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]), right_ventral_names[0], r, g,
-                                                                     b))
-                    f_colorLUT.write("\n")
+                add_structures("Right Hemisphere. Ventral Diencephalon", 'roi', [right_ventral], right_ventral_names,
+                               [right_ventral_colors_r], [right_ventral_colors_g], [right_ventral_colors_b],
+                               "ventral-diencephalon", "right", [right_ventral], 'right ventral DC label')
                 
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d1">%s</data>' % ("ventral-diencephalon")),
-                                  '{} \n'.format('      <data key="d2">%s</data>' % ("right")),
-                                  '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d4">%s</data>' % (right_ventral_names[0])),
-                                  '{} \n'.format('      <data key="d5">%i</data>' % (int(right_ventral))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
-            
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
                 # Relabelling Right Hypothalamus
-                newLabels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update right hypothalamus label ({} -> {})".format(right_ventral, newLabels[0]))
-                It[indrhypothal] = newLabels[0]
-                nlabel = It.max()
-                
-                # ColorLUT (right hypothalamus)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Right Hemisphere. Hypothalamus \n")
-                    r = hypothal_colors_r
-                    g = hypothal_colors_g
-                    b = hypothal_colors_b
-                    f_colorLUT.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]), right_hypothal_names[0], r, g,
-                                                                     b))
-                    f_colorLUT.write("\n")
-                
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d1">%s</data>' % ("hypothalamus")),
-                                  '{} \n'.format('      <data key="d2">%s</data>' % ("right")),
-                                  '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d4">%s</data>' % (right_hypothal_names[0])),
-                                  '{} \n'.format('      <data key="d5">%i</data>' % (-1)),
-                                  '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
+                add_structures("Right Hemisphere. Hypothalamus", 'rh_hypothalamus', [1], right_hypothal_names,
+                               [hypothal_colors_r], [hypothal_colors_g], [hypothal_colors_b], "hypothalamus", "right",
+                               [-1], 'right hypothalamus label')
             
             ## Processing Left Hemisphere
             # Relabelling Left hemisphere
-            ind = np.where((I > 1000) & (I < 2000))
-            It[ind] = (I[ind] - 1000 + nlabel)
-            old_nlabel = nlabel
-            nlabel = It.max()
+            old_nlabel = table.nlabel
+            ctx_labels = np.arange(1001, 2000)
+            table.add_rule('roi', ctx_labels, ctx_labels - 1000 + old_nlabel)
             
             # ColorLUT (cortical)
+            entries = []
             if self.inputs.create_colorLUT or self.inputs.create_graphml:
-                f_colorLUT.write("# Left Hemisphere. Cortical Structures \n")
-                outprefixName = roi.split(".")[0]
-                outprefixName = outprefixName.split("/")[-1:][0]
-                for elem in outprefixName.split("_"):
-                    if "scale" in elem:
-                        scale = elem
                 lh_annot_file = 'lh.lausanne2008.%s.annot' % scale
                 iflogger.info("  > Load {}".format(lh_annot_file))
                 lh_annot = ni.freesurfer.io.read_annot(
                     op.join(self.inputs.subjects_dir, self.inputs.subject_id, 'label', lh_annot_file))
                 rgb_table = lh_annot[1][1:, 0:3]
                 roi_names = lh_annot[2][1:]
-                
-                lines = []
                 for label, name in enumerate(roi_names):
                     name = 'ctx-lh-{}'.format(name)
-                    
-                    if self.inputs.create_colorLUT:
-                        r = rgb_table[label, 0]
-                        g = rgb_table[label, 1]
-                        b = rgb_table[label, 2]
-                        
-                        if label == 0:
-                            r = 0
-                            g = 0
-                            b = 0
-                        
-                        f_colorLUT.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(label + old_nlabel + 1), name, r, g, b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(label + old_nlabel + 1))),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("cortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % (name)),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("left")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (int(label + old_nlabel + 1))),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % (name)),
-                                      '{} \n'.format(
-                                          '      <data key="d5">%i</data>' % (int(label + 1000 - old_nlabel))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                    rgb = (0, 0, 0) if label == 0 else tuple(rgb_table[label, :])
+                    entries.append((label + old_nlabel + 1, name, rgb, "cortical", name, "left",
+                                    int(label + 1000 - old_nlabel)))
+            table.add_section("Left Hemisphere. Cortical Structures", entries)
             
             # Relabelling Thalamic Nuclei
             if thalamus_nuclei_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Subcortical Structures (Thalamic Nuclei) \n")
-                
-                newLabels = np.arange(nlabel + 1, nlabel + 1 + left_thalNuclei.shape[0])
-                i = 0
-                for lab in left_thalNuclei:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update left thalamic nucleus label ({} -> {})".format(lab, newLabels[i]))
-                    
-                    if self.inputs.create_colorLUT:
-                        r = left_thalNuclei_colors_r[i]
-                        g = left_thalNuclei_colors_g[i]
-                        b = left_thalNuclei_colors_b[i]
-                        f_colorLUT.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]), left_thalNuclei_names[i], r,
-                                                                         g, b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % ("thalamus")),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("left")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % (left_thalNuclei_names[i])),
-                                      '{} \n'.format('      <data key="d5">%i</data>' % (int(10))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                    
-                    ind = np.where(Ithal == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                add_structures("Left Hemisphere. Subcortical Structures (Thalamic Nuclei)", 'thalamus',
+                               left_thalNuclei, left_thalNuclei_names, left_thalNuclei_colors_r,
+                               left_thalNuclei_colors_g, left_thalNuclei_colors_b, "thalamus", "left",
+                               [10] * len(left_thalNuclei), 'left thalamic nucleus label')
             
             # Relabelling Subcortical Structures
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("# Left Hemisphere. Subcortical Structures \n")
-            
-            newLabels = np.arange(nlabel + 1, nlabel + 1 + left_subc_labels.shape[0])
-            
-            i = 0
-            for lab in left_subc_labels:
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update left subcortical label ({} -> {})".format(lab, newLabels[i]))
-                
-                if self.inputs.create_colorLUT:
-                    r = left_subcIds_colors_r[i]
-                    g = left_subcIds_colors_g[i]
-                    b = left_subcIds_colors_b[i]
-                    f_colorLUT.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]), left_subcort_names[i], r, g, b))
-                
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[i]))),
-                                  '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d1">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d2">%s</data>' % ("left")),
-                                  '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[i]))),
-                                  '{} \n'.format('      <data key="d4">%s</data>' % (left_subcort_names[i])),
-                                  '{} \n'.format('      <data key="d5">%i</data>' % (int(lab))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
-                
-                ind = np.where(I == lab)
-                It[ind] = newLabels[i]
-                i += 1
-            nlabel = It.max()
-            
-            if self.inputs.create_colorLUT:
-                f_colorLUT.write("\n")
+            add_structures("Left Hemisphere. Subcortical Structures", 'roi', left_subc_labels, left_subcort_names,
+                           left_subcIds_colors_r, left_subcIds_colors_g, left_subcIds_colors_b, "subcortical",
+                           "left", left_subc_labels, 'left subcortical label')
+            last_fsID = left_subc_labels[-1]
             
             # Relabelling Subfields
             if lh_subfield_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Subcortical Structures (Hippocampal Subfields) \n")
-                
-                newLabels = np.arange(nlabel + 1, nlabel + 1 + hippo_subf.shape[0])
-                i = 0
-                for lab in hippo_subf:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update left hippo subfield label ({} -> {})".format(lab, newLabels[i]))
-                    
-                    if self.inputs.create_colorLUT:
-                        r = hippo_subf_colors_r[i]
-                        g = hippo_subf_colors_g[i]
-                        b = hippo_subf_colors_b[i]
-                        f_colorLUT.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]), left_hippo_subf_names[i], r,
-                                                                         g, b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % ("hippocampus")),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("left")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % (left_hippo_subf_names[i])),
-                                      '{} \n'.format('      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                    
-                    ind = np.where(Isublh == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-                newIds_LH_subFields = newLabels
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                add_structures("Left Hemisphere. Subcortical Structures (Hippocampal Subfields)", 'lh_subfields',
+                               hippo_subf, left_hippo_subf_names, hippo_subf_colors_r, hippo_subf_colors_g,
+                               hippo_subf_colors_b, "hippocampus", "left", hippo_subf, 'left hippo subfield label')
+                last_fsID = hippo_subf[-1]
             
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
+            if new_structures:
                 # Relabelling Left VentralDC
-                newLabels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update left ventral DC label ({} -> {})".format(left_ventral, newLabels[0]))
-                ind = np.where(I == left_ventral)
-                It[ind] = newLabels[0]
-                nlabel = It.max()
-                newIds_LH_ventralDC = newLabels;
-                
-                # ColorLUT (left ventral DC)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Ventral Diencephalon \n")
-                    r = left_ventral_colors_r
-                    g = left_ventral_colors_g
-                    b = left_ventral_colors_b
-                    f_colorLUT.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]), left_ventral_names[0], r, g, b))
-                    f_colorLUT.write("\n")
+                add_structures("Left Hemisphere. Ventral Diencephalon", 'roi', [left_ventral], left_ventral_names,
+                               [left_ventral_colors_r], [left_ventral_colors_g], [left_ventral_colors_b],
+                               "ventral-diencephalon", "left", [left_ventral], 'left ventral DC label')
                 
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d1">%s</data>' % ("ventral-diencephalon")),
-                                  '{} \n'.format('      <data key="d2">%s</data>' % ("left")),
-                                  '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d4">%s</data>' % (left_ventral_names[0])),
-                                  '{} \n'.format('      <data key="d5">%i</data>' % (int(left_ventral))),
-                                  '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
-            
-            if thalamus_nuclei_defined or brainstem_defined or (lh_subfield_defined and rh_subfield_defined):
                 # Relabelling Left Hypothalamus
-                newLabels = np.arange(nlabel + 1, nlabel + 2)
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update left hypothalamus label ({} -> {})".format(-1, newLabels[0]))
-                It[indlhypothal] = newLabels[0]
-                nlabel = It.max()
-                
-                # ColorLUT (right hypothalamus)
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Left Hemisphere. Hypothalamus \n")
-                    r = hypothal_colors_r
-                    g = hypothal_colors_g
-                    b = hypothal_colors_b
-                    f_colorLUT.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]), left_hypothal_names[0], r, g,
-                                                                     b))
-                    f_colorLUT.write("\n")
-                
-                if self.inputs.create_graphml:
-                    node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                  '{} \n'.format('      <data key="d1">%s</data>' % ("hypothalamus")),
-                                  '{} \n'.format('      <data key="d2">%s</data>' % ("left")),
-                                  '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[0]))),
-                                  '{} \n'.format('      <data key="d4">%s</data>' % (left_hypothal_names[0])),
-                                  '{} \n'.format('      <data key="d5">%i</data>' % (-1)),
-                                  '{} \n'.format('    </node>')]
-                    f_graphML.writelines(node_lines)
+                add_structures("Left Hemisphere. Hypothalamus", 'lh_hypothalamus', [1], left_hypothal_names,
+                               [hypothal_colors_r], [hypothal_colors_g], [hypothal_colors_b], "hypothalamus", "left",
+                               [-1], 'left hypothalamus label')
             
             # Relabelling Brain Stem
             if brainstem_defined:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Brain Stem Structures \n")
-                
-                newLabels = np.arange(nlabel + 1, nlabel + 1 + brainstem.shape[0])
-                i = 0
-                for lab in brainstem:
-                    if self.inputs.verbose_level == 2:
-                        iflogger.info("  > Update brainstem parcellation label ({} -> {})".format(lab, newLabels[i]))
-                    
-                    if self.inputs.create_colorLUT:
-                        r = brainstem_colors_r[i]
-                        g = brainstem_colors_g[i]
-                        b = brainstem_colors_b[i]
-                        f_colorLUT.write(
-                            '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[i]), brainstem_names[i], r, g,
-                                                                         b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % ("brainstem")),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("central")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[i]))),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % (brainstem_names[i])),
-                                      '{} \n'.format('      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                    
-                    ind = np.where(Istem == lab)
-                    It[ind] = newLabels[i]
-                    i += 1
-                nlabel = It.max()
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                add_structures("Brain Stem Structures", 'brainstem', brainstem, brainstem_names, brainstem_colors_r,
+                               brainstem_colors_g, brainstem_colors_b, "brainstem", "central", brainstem,
+                               'brainstem parcellation label')
             else:
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("# Brain Stem \n")
-                
-                newLabels = np.arange(nlabel + 1, nlabel + 2)
-                It[indrep] = newLabels[0]
-                
-                if self.inputs.verbose_level == 2:
-                    iflogger.info("  > Update brainstem parcellation label ({} -> {})".format(lab, newLabels[0]))
-                
-                if self.inputs.create_colorLUT:
-                    r = 119
-                    g = 159
-                    b = 176
-                    f_colorLUT.write(
-                        '{:<4} {:<55} {:>3} {:>3} {:>3} 0 \n'.format(int(newLabels[0]), 'brainstem', r, g, b))
-                    
-                    if self.inputs.create_graphml:
-                        node_lines = ['{} \n'.format('    <node id="%i">' % (int(newLabels[0]))),
-                                      '{} \n'.format('      <data key="d0">%s</data>' % ("subcortical")),
-                                      '{} \n'.format('      <data key="d1">%s</data>' % ("brainstem")),
-                                      '{} \n'.format('      <data key="d2">%s</data>' % ("central")),
-                                      '{} \n'.format('      <data key="d3">%i</data>' % (int(newLabels[0]))),
-                                      '{} \n'.format('      <data key="d4">%s</data>' % ("brainstem")),
-                                      '{} \n'.format('      <data key="d5">%i</data>' % (int(lab))),
-                                      '{} \n'.format('    </node>')]
-                        f_graphML.writelines(node_lines)
-                
-                nlabel = It.max()
-                
-                if self.inputs.create_colorLUT:
-                    f_colorLUT.write("\n")
+                # the graphml node keeps the FreeSurfer ID of the last relabelled subcortical structure,
+                # as it was written so far
+                add_structures("Brain Stem", 'roi', [16], ['brainstem'], [119], [159], [176], "brainstem", "central",
+                               [last_fsID], 'brainstem parcellation label')
+            
+            It = table.relabel(dtype=np.int16)
             
             # Fix negative values
             It[It < 0] = 0
             
             # Saving the new parcellation
-            outprefixName = roi.split(".")[0]
-            outprefixName = outprefixName.split("/")[-1:][0]
             output_roi = op.abspath('{}_final.nii.gz'.format(outprefixName))
             hdr = V.get_header()
             hdr2 = hdr.copy()
@@ -1254,14 +1021,17 @@ class CombineParcellations(BaseInterface):
             img = ni.Nifti1Image(It, V.get_affine(), hdr2)
             ni.save(img, output_roi)
             
+            # colorLUT creation if enabled
             if self.inputs.create_colorLUT:
-                f_colorLUT.close()
+                colorLUT_file = op.abspath('{}_FreeSurferColorLUT.txt'.format(outprefixName))
+                iflogger.info("  > Create colorLUT file as %s" % colorLUT_file)
+                table.write_colorLUT(colorLUT_file, outprefixName)
             
+            # Create GraphML if enabled
             if self.inputs.create_graphml:
-                bottom_lines = ['{} \n'.format('  </graph>'),
-                                '{} \n'.format('</graphml>'), ]
-                f_graphML.writelines(bottom_lines)
-                f_graphML.close()
+                graphML_file = op.abspath('{}.graphml'.format(outprefixName))
+                iflogger.info("  > Create graphML_file as {}".format(graphML_file))
+                table.write_graphml(graphML_file)
         
         orig = op.join(fs_dir, 'mri', 'orig', '001.mgz')
         aparcaseg_fs = op.join(fs_dir, 'mri', 'aparc+aseg.mgz')
@@ -1416,6 +1186,39 @@ class CombineParcellations(BaseInterface):
         return filepaths
 
 
+class MaxProbAccumulator(object):
+    """ Running MaxProb labelling of probability maps given one volume at a time
+    
+    For thresholded maps (values set to 0 below the threshold), max_prob() gives the same
+    labels as np.argmax(Ispams, axis=3) + 1 set to 0 where np.sum(Ispams, axis=3) == 0,
+    without stacking the volumes into a 4D array: the first maximum wins and NaN values
+    are picked as np.argmax does.
+    """
+    
+    def __init__(self):
+        self.labels = None
+        self.max_values = None
+        self.nonzero = None
+    
+    def add(self, volume, label):
+        """ Account for the probability volume of label """
+        if self.labels is None:
+            self.labels = np.full(volume.shape, label, dtype=np.intp)
+            self.max_values = volume.copy()
+            self.nonzero = volume != 0
+            return
+        update = (volume > self.max_values) | (np.isnan(volume) & ~np.isnan(self.max_values))
+        self.labels[update] = label
+        self.max_values[update] = volume[update]
+        self.nonzero |= volume != 0
+    
+    def max_prob(self):
+        """ Return the label volume (0 where all the maps are 0) """
+        max_prob = self.labels.copy()
+        max_prob[~self.nonzero] = 0
+        return max_prob
+
+
 class ParcellateThalamusInputSpec(BaseInterfaceInputSpec):
     T1w_image = File(mandatory=True, desc='T1w image to be parcellated')
     bids_dir = Directory(desc='BIDS root directory')
@@ -1529,42 +1332,52 @@ class ParcellateThalamus(BaseInterface):
         Ij = ni.load(jacobian_file).get_data()  # numpy.ndarray
         
         # Load probability maps in native space after applying estimated transform and deformation
+        # The gzipped maps are decompressed once, in their own (float) precision, and each
+        # nucleus is then corrected in place
         imgVspams = ni.load(output_maps)
-        Vspams = imgVspams.get_data()  # numpy.ndarray
-        Vspams[Vspams < 0] = 0
-        Vspams[Vspams > 1] = 1
+        Nspams = imgVspams.shape[3]
+        Ispams = np.asanyarray(imgVspams.dataobj)
+        if not np.issubdtype(Ispams.dtype, np.floating):
+            Ispams = Ispams.astype(np.float32)
         
         Thresh = 0.05
-        # Creating MaxProb
-        Ispams = Vspams.copy()
-        Ispams[Ispams < Thresh] = 0
-        ind = np.where(np.sum(Ispams, axis=3) == 0)
-        MaxProb = Ispams.argmax(axis=3) + 1
-        MaxProb[ind] = 0;
+        MaxProbAnts = MaxProbAccumulator()
+        MaxProbCorr = MaxProbAccumulator()
+        
+        # Take into account jacobian to correct the probability maps after interpolation
+        for nuc in np.arange(Nspams):
+            IspamNuc = Ispams[:, :, :, nuc]
+            IspamNuc[IspamNuc < 0] = 0
+            IspamNuc[IspamNuc > 1] = 1
+            
+            # Creating MaxProb
+            T = IspamNuc.copy()
+            T[T < Thresh] = 0
+            MaxProbAnts.add(T, nuc + 1)
+            
+            IspamNuc *= Ij
+            IspamNuc /= IspamNuc.max()
+            
+            # Creating MaxProb
+            IspamNuc[IspamNuc < Thresh] = 0
+            MaxProbCorr.add(IspamNuc, nuc + 1)
+        del T, IspamNuc, Ij
+        
+        MaxProb = MaxProbAnts.max_prob()
         # ?MaxProb = imfill(MaxProb,'holes');
         
-        del Ispams
+        del MaxProbAnts
         
         debug_file = op.abspath('{}_class-thalamus_dtissue_after_ants.nii.gz'.format(outprefixName))
         print("Save output image to %s" % debug_file)
         img = ni.Nifti1Image(MaxProb, Vatlas.get_affine(), hdr2)
         ni.save(img, debug_file)
         
-        # Take into account jacobian to correct the probability maps after interpolation
-        Ispams = np.zeros(Vspams.shape)
-        for nuc in np.arange(Vspams.shape[3]):
-            tempImage = Vspams[:, :, :, nuc]
-            T = np.multiply(tempImage, Ij)
-            Ispams[:, :, :, nuc] = T / T.max()
-        del tempImage, T, Vspams, Ij
-        
-        # Creating MaxProb
-        Ispams[Ispams < Thresh] = 0
-        ind = np.where(np.sum(Ispams, axis=3) == 0)
-        MaxProb = Ispams.argmax(axis=3) + 1
-        MaxProb[ind] = 0;
+        MaxProb = MaxProbCorr.max_prob()
         # ?MaxProb = imfill(MaxProb,'holes');
         
+        del MaxProbCorr
+        
         debug_file = op.abspath('{}_class-thalamus_dtissue_after_jacobiancorr.nii.gz'.format(outprefixName))
         print("Save output image to %s" % debug_file)
         img = ni.Nifti1Image(MaxProb, Vatlas.get_affine(), hdr2)
@@ -1643,9 +1456,6 @@ class ParcellateThalamus(BaseInterface):
         
         del hdr, hdr2, Vthal
         
-        Nspams = Ispams.shape[3]
-        Thresh = 0.05
-        
         use_thalamus_mask = True
         if use_thalamus_mask:
             IthalL = np.zeros(Ithal.shape)
@@ -1659,48 +1469,35 @@ class ParcellateThalamus(BaseInterface):
             
             del Ithal
             
-            # Mask probability maps using the left-hemisphere thalamus mask
-            tmpIthalL = np.zeros((IthalL.shape[0], IthalL.shape[1], IthalL.shape[2], 1))
-            tmpIthalL[:, :, :, 0] = IthalL
-            tempM = np.repeat(tmpIthalL, Nspams / 2, axis=3)
-            del tmpIthalL
-            IspamL = np.multiply(Ispams[:, :, :, 0:Nspams / 2], tempM)
-            print('IspamL shape:', IspamL.shape)
-            del tempM
-            
-            # Creating MaxProb
-            IspamL[IspamL < Thresh] = 0
-            ind = np.where(np.sum(IspamL, axis=3) == 0)
-            # MaxProbL = IspamL.max(axis=3)
-            MaxProbL = np.argmax(IspamL, axis=3) + 1
-            MaxProbL[ind] = 0
-            # MaxProbL[ind] = 0
+            # Mask probability maps using the left-hemisphere thalamus mask, in place and one nucleus at a time
+            MaxProbAccL = MaxProbAccumulator()
+            for nuc in np.arange(0, Nspams / 2):
+                IspamNuc = Ispams[:, :, :, nuc]
+                IspamNuc *= IthalL
+                
+                # Creating MaxProb
+                IspamNuc[IspamNuc < Thresh] = 0
+                MaxProbAccL.add(IspamNuc, nuc + 1)
+            MaxProbL = MaxProbAccL.max_prob()
             # ?MaxProbL = ndimage.binary_fill_holes(MaxProbL)
             # ?MaxProbL = Atlas_Corr(IthalL,MaxProbL)
             
             # Mask probability maps using the right-hemisphere thalamus mask
-            tmpIthalR = np.zeros((IthalR.shape[0], IthalR.shape[1], IthalR.shape[2], 1))
-            tmpIthalR[:, :, :, 0] = IthalR
-            tempM = np.repeat(tmpIthalR, Nspams / 2, axis=3)
-            del tmpIthalR
-            IspamR = np.multiply(Ispams[:, :, :, Nspams / 2:Nspams], tempM)
-            print('IspamR shape:', IspamR.shape)
-            del tempM
-            
-            # Creating MaxProb
-            IspamR[IspamR < Thresh] = 0
-            ind = np.where(np.sum(IspamR, axis=3) == 0)
-            # MaxProbR = IspamR.max(axis=3)
-            MaxProbR = np.argmax(IspamR, axis=3) + 1
+            MaxProbAccR = MaxProbAccumulator()
+            for nuc in np.arange(Nspams / 2, Nspams):
+                IspamNuc = Ispams[:, :, :, nuc]
+                IspamNuc *= IthalR
+                
+                # Creating MaxProb
+                IspamNuc[IspamNuc < Thresh] = 0
+                MaxProbAccR.add(IspamNuc, nuc - Nspams / 2 + 1)
+            MaxProbR = MaxProbAccR.max_prob()
             # ?MaxProbR = imfill(MaxProbR,'holes');
             # ?MaxProbR = Atlas_Corr(IthalR,MaxProbR);
             MaxProbR[indr] = MaxProbR[indr] + Nspams / 2;
-            MaxProbR[ind] = 0
+            MaxProbR[~MaxProbAccR.nonzero] = 0
             
-            del indr
-            
-            Ispams[:, :, :, 0:Nspams / 2] = IspamL
-            Ispams[:, :, :, Nspams / 2:Nspams] = IspamR
+            del indr, IspamNuc, MaxProbAccL, MaxProbAccR
         
         # Save corrected probability maps of thalamic nuclei
         # update the header
@@ -1722,13 +1519,7 @@ class ParcellateThalamus(BaseInterface):
         
         if use_thalamus_mask:
             MaxProb = MaxProbL + MaxProbR
-        else:
-            # Creating MaxProb
-            Ispams[Ispams < Thresh] = 0
-            ind = np.where(np.sum(Ispams, axis=3) == 0)
-            MaxProb = Ispams.argmax(axis=3) + 1
-            MaxProb[ind] = 0;
-            # ?MaxProb = imfill(MaxProb,'holes');
+        # else: the MaxProb of the thresholded maps after jacobian correction computed above
         
         del Ispams
         
@@ -1779,6 +1570,11 @@ class ParcellateInputSpec(BaseInterfaceInputSpec):
     parcellation_scheme = traits.Enum('Lausanne2008', ['Lausanne2008', 'Lausanne2018', 'NativeFreesurfer'],
                                       usedefault=True)
     erode_masks = traits.Bool(False)
+    label2vol_method = traits.Enum('python', ['python', 'freesurfer'], usedefault=True,
+                                   desc='Rasterize the Lausanne2008 cortical labels in-process (python) '
+                                        'or with one mri_label2vol per label (freesurfer)')
+    nbr_processes = traits.Int(1, usedefault=True,
+                               desc='Number of mri_label2vol processes run in parallel (0: one per CPU)')
 
 
 class ParcellateOutputSpec(TraitedSpec):
@@ -1835,7 +1631,8 @@ class Parcellate(BaseInterface):
             print "Parcellation scheme : Lausanne2008"
             create_T1_and_Brain(self.inputs.subject_id, self.inputs.subjects_dir)
             create_annot_label(self.inputs.subject_id, self.inputs.subjects_dir)
-            create_roi(self.inputs.subject_id, self.inputs.subjects_dir)
+            create_roi(self.inputs.subject_id, self.inputs.subjects_dir, self.inputs.label2vol_method,
+                       self.inputs.nbr_processes)
             create_wm_mask(self.inputs.subject_id, self.inputs.subjects_dir)
             if self.inputs.erode_masks:
                 erode_mask(fsdir, op.join(fsdir, 'mri', 'fsmask_1mm.nii.gz'))
@@ -2080,6 +1877,161 @@ def extract(Z, shape, position, fill):
     return R
 
 
+def distance_shells(radius):
+    """ Group the voxel offsets within a sphere by distance to its center
+    Parameters
+    ----------
+    radius: radius of the sphere (in voxels)
+    Returns
+    -------
+    shells: list of (squared distance, [N, 3] offsets) tuples sorted by increasing
+    distance, the null offset excluded
+    """
+    r = int(radius)
+    offsets = np.mgrid[-r:r + 1, -r:r + 1, -r:r + 1].reshape(3, -1).T
+    sqdist = np.sum(offsets ** 2, axis=1)
+    shells = []
+    for d2 in np.unique(sqdist[(sqdist > 0) & (sqdist <= radius ** 2)]):
+        shells.append((d2, offsets[sqdist == d2]))
+    return shells
+
+
+def majority_labels(labels, coords, offsets):
+    """ Most frequent label around voxels
+    Parameters
+    ----------
+    labels: the label volume (0 is unlabeled)
+    coords: [N, 3] array of voxel indexes
+    offsets: [M, 3] array of offsets from the voxels at which labels are read
+    Returns
+    -------
+    values: the most frequent non-zero label at the offsets of each voxel (the
+    smallest one in case of ties, as np.argmax(np.bincount()) does), 0 if there is none
+    """
+    points = coords[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+    inside = np.all((points >= 0) & (points < np.array(labels.shape)), axis=2)
+    points = np.clip(points, 0, np.array(labels.shape) - 1)
+    local = labels[points[..., 0], points[..., 1], points[..., 2]]
+    local[~inside] = 0
+    
+    values = local.max(axis=1)
+    smallest = np.where(local > 0, local, values.max() + 1).min(axis=1)
+    # several distinct labels: majority vote
+    for j in np.where((values > 0) & (smallest != values))[0]:
+        values[j] = np.argmax(np.bincount(local[j][local[j] > 0]))
+    return values
+
+
+def nearest_labels(labels, idx, radius=12):
+    """ Label of the nearest labeled voxels
+    Parameters
+    ----------
+    labels: the label volume (0 is unlabeled)
+    idx: tuple of voxel index arrays (as returned by np.where)
+    radius: maximal distance (in voxels) of the labeled voxels
+    Returns
+    -------
+    values: for each voxel, the most frequent label among the closest labeled voxels
+    other than itself (the smallest one in case of ties), 0 if there is none within radius
+    """
+    coords = np.array(idx, dtype=np.int64).T.reshape(-1, 3)
+    values = np.zeros(len(coords), dtype=labels.dtype)
+    
+    # squared distance of each voxel to the closest labeled voxel
+    dist = ndimage.distance_transform_edt(labels == 0)
+    sqdist = np.round(dist[tuple(coords.T)] ** 2).astype(np.int64)
+    del dist
+    
+    # labeled voxels are searched shell by shell until another labeled voxel is found
+    pending = np.ones(len(coords), dtype=bool)
+    for d2, offsets in distance_shells(radius):
+        sel = np.where(pending & ((sqdist == d2) | (sqdist == 0)))[0]
+        if sel.size == 0:
+            continue
+        shell_values = majority_labels(labels, coords[sel], offsets)
+        found = shell_values > 0
+        values[sel[found]] = shell_values[found]
+        pending[sel[found]] = False
+    return values
+
+
+def read_label_coordinates(fname):
+    """ Read the vertex coordinates of a FreeSurfer .label file
+    Parameters
+    ----------
+    fname: path of the .label file
+    Returns
+    -------
+    coords: [N, 3] array of the (tkregister RAS) coordinates of the label vertices
+    """
+    # nibabel.freesurfer.read_label only returns the vertex indices
+    return np.loadtxt(fname, skiprows=2, usecols=(1, 2, 3), ndmin=2)
+
+
+def _label2vol_freesurfer(args):
+    """ Rasterize a label file with mri_label2vol and return its flat voxel indices """
+    label_file, template, out_file = args
+    mri_cmd = ['mri_label2vol', '--label', label_file, '--temp', template, '--o', out_file, '--identity']
+    subprocess.check_call(mri_cmd)
+    return np.flatnonzero(np.squeeze(ni.load(out_file).get_data()) == 1)
+
+
+def label2vol(label_files, template, method='python', nbr_processes=1):
+    """ Rasterize FreeSurfer label files in the voxel grid of a template volume
+    Parameters
+    ----------
+    label_files: list of .label files (vertex coordinates in the surface space of the template)
+    template: template volume (e.g. orig.mgz)
+    method: 'python' maps the coordinates of all the labels to their nearest voxels
+    at once, 'freesurfer' runs mri_label2vol --identity on each label (exact FreeSurfer
+    behaviour) in a pool of nbr_processes processes
+    nbr_processes: number of mri_label2vol processes run in parallel (0: one per CPU)
+    Returns
+    -------
+    voxels: list of the flat (C order) indices of the voxels of each label
+    """
+    if len(label_files) == 0:
+        return []
+    
+    if method == 'freesurfer':
+        import multiprocessing as mp
+        import tempfile
+        
+        tmp_dir = tempfile.mkdtemp(prefix='label2vol_')
+        jobs = [(label_file, template, op.join(tmp_dir, 'label_%d.nii.gz' % k))
+                for k, label_file in enumerate(label_files)]
+        try:
+            if nbr_processes == 1:
+                voxels = [_label2vol_freesurfer(job) for job in jobs]
+            else:
+                pool = mp.Pool(processes=nbr_processes if nbr_processes > 0 else mp.cpu_count())
+                try:
+                    voxels = pool.map(_label2vol_freesurfer, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            shutil.rmtree(tmp_dir)
+        return voxels
+    
+    img = ni.load(template)
+    shape = np.array(img.shape[:3])
+    ras2vox = np.linalg.inv(img.header.get_vox2ras_tkr())
+    
+    coords = [read_label_coordinates(label_file) for label_file in label_files]
+    vox = np.concatenate(coords).dot(ras2vox[:3, :3].T) + ras2vox[:3, 3]
+    # round half away from zero, as FreeSurfer's nint
+    vox = (np.sign(vox) * np.floor(np.abs(vox) + 0.5)).astype(np.int64)
+    inside = np.all((vox >= 0) & (vox < shape), axis=1)
+    flat = np.ravel_multi_index(tuple(np.clip(vox, 0, shape - 1).T), tuple(shape))
+    flat[~inside] = -1
+    
+    voxels = []
+    for label_flat in np.split(flat, np.cumsum([len(c) for c in coords])[:-1]):
+        voxels.append(np.unique(label_flat[label_flat >= 0]))
+    return voxels
+
+
 def create_T1_and_Brain(subject_id, subjects_dir):
     fs_dir = op.join(subjects_dir, subject_id)
     
@@ -2192,9 +2144,11 @@ def create_annot_label(subject_id, subjects_dir):
     print("[ DONE ]")
 
 
-def create_roi(subject_id, subjects_dir):
+def create_roi(subject_id, subjects_dir, label2vol_method='python', nbr_processes=1):
     """ Creates the ROI_%s.nii.gz files using the given parcellation information
-    from networks. Iteratively create volume. """
+    from networks. Iteratively create volume.
+    
+    The cortical labels are rasterized with label2vol(label2vol_method, nbr_processes). """
     
     print("Create the ROIs:")
     fs_dir = op.join(subjects_dir, subject_id)
@@ -2210,17 +2164,8 @@ def create_roi(subject_id, subjects_dir):
     yy = np.concatenate((idxr[1], idxl[1]))
     zz = np.concatenate((idxr[2], idxl[2]))
     
-    # initialize variables necessary for cortical ROIs dilation
-    # dimensions of the neighbourhood for rois labels assignment (choose odd dimensions!)
-    shape = (25, 25, 25)
-    center = np.array(shape) // 2
-    # dist: distances from the center of the neighbourhood
-    dist = np.zeros(shape, dtype='float32')
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            for z in range(shape[2]):
-                distxyz = center - [x, y, z]
-                dist[x, y, z] = math.sqrt(np.sum(np.multiply(distxyz, distxyz)))
+    # maximal distance (in voxels) of the rois labels assigned to unlabeled voxels
+    radius = 12
     
     # LOOP throughout all the SCALES
     # (from the one with the highest number of region to the one with the lowest number of regions)
@@ -2244,12 +2189,24 @@ def create_roi(subject_id, subjects_dir):
         # create a big 256^3 volume for storage of all ROIs
         rois = np.zeros((256, 256, 256), dtype=np.int16)  # numpy.ndarray
         
-        for brk, brv in pg.nodes(data=True):  # slow loop
-            
-            if brv['dn_hemisphere'] == 'left':
-                hemi = 'lh'
-            elif brv['dn_hemisphere'] == 'right':
-                hemi = 'rh'
+        hemis = {'left': 'lh', 'right': 'rh'}
+        
+        # rasterize all the cortical labels of the scale at once
+        cortical = []
+        label_files = []
+        for brk, brv in pg.nodes(data=True):
+            if brv['dn_region'] == 'cortical':
+                hemi = hemis[brv['dn_hemisphere']]
+                labelpath = op.join(fs_dir, 'label', parval['fs_label_subdir_name'] % hemi)
+                cortical.append(brk)
+                label_files.append(op.join(labelpath, '%s.%s.label' % (hemi, brv['dn_fsname'])))
+        cortical_voxels = dict(zip(cortical, label2vol(label_files, op.join(fs_dir, 'mri', 'orig.mgz'),
+                                                       label2vol_method, nbr_processes)))
+        
+        # voxels (flat indices) and values of the regions, painted at once in node order
+        region_voxels = []
+        region_values = []
+        for brk, brv in pg.nodes(data=True):
             
             if brv['dn_region'] == 'subcortical':
                 
@@ -2259,8 +2216,7 @@ def create_roi(subject_id, subjects_dir):
                 print("---------------------")
                 
                 # if it is subcortical, retrieve roi from aseg
-                idx = np.where(asegd == int(brv['dn_fs_aseg_val']))
-                rois[idx] = int(brv['dn_correspondence_id'])
+                idx = np.flatnonzero(asegd == int(brv['dn_fs_aseg_val']))
             
             elif brv['dn_region'] == 'cortical':
                 print("---------------------")
@@ -2268,61 +2224,36 @@ def create_roi(subject_id, subjects_dir):
                 print("Freesurfer Name: %s" % brv['dn_fsname'])
                 print("---------------------")
                 
-                labelpath = op.join(fs_dir, 'label', parval['fs_label_subdir_name'] % hemi)
-                
-                # construct .label file name
-                fname = '%s.%s.label' % (hemi, brv['dn_fsname'])
-                
-                # execute fs mri_label2vol to generate volume roi from the label file
-                # store it in temporary file to be overwritten for each region (slow!)
-                # mri_cmd = 'mri_label2vol --label "%s" --temp "%s" --o "%s" --identity' % (op.join(labelpath, fname),
-                #        op.join(fs_dir, 'mri', 'orig.mgz'), op.join(labelpath, 'tmp.nii.gz'))
-                # runCmd( mri_cmd, log )
-                mri_cmd = ['mri_label2vol', '--label', op.join(labelpath, fname), '--temp',
-                           op.join(fs_dir, 'mri', 'orig.mgz'), '--o', op.join(labelpath, 'tmp.nii.gz'), '--identity']
-                subprocess.check_call(mri_cmd)
-                
-                tmp = ni.load(op.join(labelpath, 'tmp.nii.gz'))
-                tmpd = tmp.get_data()
-                
-                # find voxel and set them to intensity value in rois
-                idx = np.where(tmpd == 1)
-                rois[idx] = int(brv['dn_correspondence_id'])
+                # voxels of the label file
+                idx = cortical_voxels[brk]
+            
+            else:
+                continue
+            
+            region_voxels.append(idx)
+            region_values.append(np.repeat(np.int16(brv['dn_correspondence_id']), len(idx)))
+        
+        if len(region_voxels) > 0:
+            # reversed, so that the region painted last is kept on overlapping voxels
+            region_voxels = np.concatenate(region_voxels)[::-1]
+            region_values = np.concatenate(region_values)[::-1]
+            region_voxels, last = np.unique(region_voxels, return_index=True)
+            rois.flat[region_voxels] = region_values[last]
         
         newrois = rois.copy()
         # store scale500 volume for correction on multi-resolution consistency
         if i == 0:
             print("Storing ROIs volume maximal resolution...")
             roisMax = rois.copy()
-            idxMax = np.where(roisMax > 0)
-            xxMax = idxMax[0]
-            yyMax = idxMax[1]
-            zzMax = idxMax[2]
         # correct cortical surfaces using as reference the roisMax volume (for consistency between resolutions)
         else:
             print("Adapt cortical surfaces...")
             # adaptstart = time()
-            idxRois = np.where(rois > 0)
-            xxRois = idxRois[0]
-            yyRois = idxRois[1]
-            zzRois = idxRois[2]
             # correct voxels labeled in current resolution, but not labeled in highest resolution
-            for j in range(xxRois.size):
-                if (roisMax[xxRois[j], yyRois[j], zzRois[j]] == 0):
-                    newrois[xxRois[j], yyRois[j], zzRois[j]] = 0;
+            newrois[roisMax == 0] = 0
             # correct voxels not labeled in current resolution, but labeled in highest resolution
-            for j in range(xxMax.size):
-                if (newrois[xxMax[j], yyMax[j], zzMax[j]] == 0):
-                    local = extract(rois, shape, position=(xxMax[j], yyMax[j], zzMax[j]), fill=0)
-                    mask = local.copy()
-                    mask[np.nonzero(local > 0)] = 1
-                    thisdist = np.multiply(dist, mask)
-                    thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                    value = np.int_(local[np.nonzero(thisdist == np.amin(thisdist))])
-                    if value.size > 1:
-                        counts = np.bincount(value)
-                        value = np.argmax(counts)
-                    newrois[xxMax[j], yyMax[j], zzMax[j]] = value
+            idx = np.where((roisMax > 0) & (newrois == 0))
+            newrois[idx] = nearest_labels(rois, idx, radius)
             # print("Cortical ROIs adaptation took %s seconds to process." % (time()-adaptstart))
         
         # store volume eg in ROI_scale33.nii.gz
@@ -2338,19 +2269,10 @@ def create_roi(subject_id, subjects_dir):
         # dilate cortical regions
         print("Dilating cortical regions...")
         # dilatestart = time()
-        # loop throughout all the voxels belonging to the aseg GM volume
-        for j in range(xx.size):
-            if newrois[xx[j], yy[j], zz[j]] == 0:
-                local = extract(rois, shape, position=(xx[j], yy[j], zz[j]), fill=0)
-                mask = local.copy()
-                mask[np.nonzero(local > 0)] = 1
-                thisdist = np.multiply(dist, mask)
-                thisdist[np.nonzero(thisdist == 0)] = np.amax(thisdist)
-                value = np.int_(local[np.nonzero(thisdist == np.amin(thisdist))])
-                if value.size > 1:
-                    counts = np.bincount(value)
-                    value = np.argmax(counts)
-                newrois[xx[j], yy[j], zz[j]] = value
+        # assign the unlabeled voxels of the aseg GM volume to their nearest roi
+        unlabeled = newrois[xx, yy, zz] == 0
+        idx = (xx[unlabeled], yy[unlabeled], zz[unlabeled])
+        newrois[idx] = nearest_labels(rois, idx, radius)
         # print("Cortical ROIs dilation took %s seconds to process." % (time()-dilatestart))
         
         # Create Gray Matter mask
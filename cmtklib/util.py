@@ -181,3 +181,101 @@ def mean_curvature(xyz):
     k = magn(np.cross(dxyz, ddxyz), 1) / (magn(dxyz, 1) ** 3)
     
     return np.mean(k)
+
+
+def _packed_fibers(n_points, offsets, lengths):
+    """ Fiber index of each point (-1 for the points between fibers) and mask of the fibers with at least 2 points """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    fiber_of_point = np.full(n_points, -1, dtype=np.int64)
+    # position of each point in its fiber, shifted by the offset of the fiber
+    starts = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + np.repeat(offsets - starts, lengths)
+    fiber_of_point[positions] = np.repeat(np.arange(len(lengths)), lengths)
+    return fiber_of_point, lengths >= 2
+
+
+def batched_length(points, offsets, lengths):
+    ''' Euclidean lengths of all the tracks of a packed points buffer
+    
+    Parameters
+    ----------
+    points : array-like shape (P,3)
+       contiguous buffer of the x,y,z of the points of all the tracks
+    offsets : array-like shape (N,)
+       index in points of the first point of each track (increasing, the
+       tracks do not overlap but the buffer may hold points between them)
+    lengths : array-like shape (N,)
+       number of points of each track
+    
+    Returns
+    -------
+    L : array shape (N,)
+       length of each track, as returned by length()
+    
+    Examples
+    --------
+    >>> xyz = np.array([[1,1,1],[2,3,4],[0,0,0],[1,1,1]])
+    >>> L = batched_length(xyz, [0, 3], [3, 1])
+    >>> np.allclose(L, [length(xyz[:3]), 0])
+    True
+    >>> gap = np.concatenate([np.zeros((2, 3)), xyz])
+    >>> np.allclose(batched_length(gap, [2, 5], [3, 1]), L)
+    True
+    '''
+    points = np.asarray(points)
+    fiber_of_point, _ = _packed_fibers(len(points), offsets, lengths)
+    if len(points) < 2:
+        return np.zeros(len(lengths))
+    
+    dists = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+    # only keep the segments joining two points of the same track
+    same = (fiber_of_point[1:] == fiber_of_point[:-1]) & (fiber_of_point[1:] >= 0)
+    return np.bincount(fiber_of_point[:-1][same], weights=dists[same], minlength=len(lengths))
+
+
+def _batched_gradient(xyz, first, last):
+    """ np.gradient(xyz)[0] computed separately on each track of a packed buffer """
+    grad = np.zeros_like(xyz)
+    grad[1:-1] = (xyz[2:] - xyz[:-2]) / 2.
+    grad[first] = xyz[first + 1] - xyz[first]
+    grad[last] = xyz[last] - xyz[last - 1]
+    return grad
+
+
+def batched_mean_curvature(points, offsets, lengths):
+    ''' Mean curvatures of all the curves of a packed points buffer
+    
+    Parameters
+    ----------
+    points : array-like shape (P,3)
+       contiguous buffer of the x,y,z of the points of all the curves
+    offsets : array-like shape (N,)
+       index in points of the first point of each curve (increasing, the
+       curves do not overlap but the buffer may hold points between them)
+    lengths : array-like shape (N,)
+       number of points of each curve
+    
+    Returns
+    -------
+    m : array shape (N,)
+       mean curvature of each curve, as returned by mean_curvature(), NaN for
+       the curves with less than 2 points
+    '''
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    fiber_of_point, valid = _packed_fibers(len(points), offsets, lengths)
+    first = offsets[valid]
+    last = offsets[valid] + lengths[valid] - 1
+    
+    dxyz = _batched_gradient(points, first, last)
+    ddxyz = _batched_gradient(dxyz, first, last)
+    
+    # Curvature of the points of the curves with at least 2 points
+    inside = valid[np.maximum(fiber_of_point, 0)] & (fiber_of_point >= 0)
+    k = magn(np.cross(dxyz[inside], ddxyz[inside]), 1)[:, 0] / (magn(dxyz[inside], 1)[:, 0] ** 3)
+    
+    m = np.full(len(lengths), np.nan)
+    m[valid] = np.bincount(fiber_of_point[inside], weights=k, minlength=len(lengths))[valid] / lengths[valid]
+    return m
@@ -0,0 +1,220 @@
+import hashlib
+import os
+import shlex
+from os import path as op
+
+import numpy as np
+import pytest
+
+SCALES = ['scale1', 'scale2']
+
+# Digests of the outputs (volumes, colorLUTs and graphmls) of the painting implementation of
+# CombineParcellations on the synthetic subject below, per (thalamus, brainstem, lh subfields, rh subfields)
+REFERENCE_DIGESTS = {
+    (False, False, False, False): '02aad19c499a993e2bcbc9741a84fa24400c91c2',
+    (False, False, False, True): 'e0d88ecbd3923b18ea8e637a20804e3bd5436318',
+    (False, False, True, False): 'f87b45348d4af2cb2a7fbf78896ae6dbea9feb15',
+    (False, False, True, True): '715ffa2ea7fc34b1459cb5b062ee7bdc6b7abcfa',
+    (False, True, False, False): '63def2992a1f72d0ed8d3fea7a38ca21ef74b5cd',
+    (False, True, False, True): '31195bc246a16d33db00aac5bd4598cfeb358d3a',
+    (False, True, True, False): 'd5584df216800342f580b0e63af8eb5dcfe60b67',
+    (False, True, True, True): '6fc2687492899b9b8f9d587f7a0a03e887acf03b',
+    (True, False, False, False): '6a6f921817ef21b8c61632c12f8bc5a0a3461c36',
+    (True, False, False, True): 'db4ee49f3abb9fb138ef5c39250d12a7376efac9',
+    (True, False, True, False): '32e3de2b393d14c80722446432875160f2b05467',
+    (True, False, True, True): 'b7d633ea2ec443182e74db627acb636eb5564e1d',
+    (True, True, False, False): 'ce136f342e987d0965c337bdf63f731fa3300d72',
+    (True, True, False, True): '3bb0f2ee405b196fa0460527b4f768882e2e92b0',
+    (True, True, True, False): '1f1d77975467c9d156ae74405000a5130af3db88',
+    (True, True, True, True): 'f54ef4b0efddcb2c0348ab1ea237faf43f61fc26',
+}
+
+
+class _FakeCommands(object):
+    """ Run fslmaths and mri_vol2vol the way CombineParcellations calls them, without FSL or FreeSurfer """
+    
+    PIPE = -1
+    STDOUT = -2
+    
+    class Popen(object):
+        
+        def __init__(self, cmd, **kwargs):
+            _FakeCommands.run(cmd)
+        
+        def communicate(self):
+            return '', ''
+    
+    @staticmethod
+    def call(cmd, **kwargs):
+        _FakeCommands.run(cmd)
+        return 0
+    
+    @staticmethod
+    def run(cmd):
+        import nibabel as ni
+        from scipy import ndimage
+        
+        args = shlex.split(cmd)
+        if args[0] == 'fslmaths':
+            img = ni.load(args[1])
+            dil = ndimage.binary_dilation(img.get_data() > 0, iterations=2).astype(np.int16)
+            ni.save(ni.Nifti1Image(dil, img.get_affine()), args[-1])
+        elif args[0] == 'mri_vol2vol':
+            img = ni.load(args[args.index('--mov') + 1])
+            ni.save(ni.Nifti1Image(np.asarray(img.get_data()), img.get_affine()), args[args.index('--o') + 1])
+        else:
+            raise ValueError('Unexpected command: {}'.format(cmd))
+
+
+def _random_labels(rng, shape, labels, density):
+    volume = np.zeros(shape, dtype=np.int16)
+    mask = rng.rand(*shape) < density
+    volume[mask] = rng.choice(labels, mask.sum())
+    return volume
+
+
+def _make_subject(base_dir):
+    """ Write a synthetic FreeSurfer subject, its Lausanne2018 ROI volumes and its structure parcellations """
+    import nibabel as ni
+    
+    rng = np.random.RandomState(0)
+    shape = (12, 12, 12)
+    affine = np.eye(4)
+    subjects_dir = op.join(base_dir, 'subjects')
+    fs_dir = op.join(subjects_dir, 'sub')
+    for dname in ['label', op.join('mri', 'orig'), 'tmp']:
+        os.makedirs(op.join(fs_dir, dname))
+    
+    subcortical = [10, 11, 12, 13, 26, 18, 17, 49, 50, 51, 52, 58, 54, 53, 28, 60, 16, 14]
+    files = {'input_rois': []}
+    for k, scale in enumerate(SCALES):
+        nroi = 4 * (k + 1)
+        for hemi in ['lh', 'rh']:
+            ctab = rng.randint(0, 255, (nroi + 1, 4))
+            ctab[:, 3] = 0
+            ni.freesurfer.io.write_annot(op.join(fs_dir, 'label', '{}.lausanne2008.{}.annot'.format(hemi, scale)),
+                                         np.arange(nroi + 1), ctab, ['unknown'] + ['roi{}'.format(i)
+                                                                                  for i in range(nroi)])
+        labels = list(range(2000, 2001 + nroi)) + list(range(1000, 1001 + nroi)) + subcortical
+        fname = op.join(base_dir, 'ROIv_Lausanne2018_{}.nii.gz'.format(scale))
+        ni.save(ni.Nifti1Image(_random_labels(rng, shape, labels, 0.9), affine), fname)
+        files['input_rois'].append(fname)
+    
+    aparcaseg = _random_labels(rng, shape, subcortical + [2, 41], 0.9).astype(np.int32)
+    ni.save(ni.MGHImage(aparcaseg, affine), op.join(fs_dir, 'mri', 'aparc+aseg.mgz'))
+    ni.save(ni.MGHImage(np.zeros(shape, dtype=np.uint8), affine), op.join(fs_dir, 'mri', 'orig', '001.mgz'))
+    
+    # Thalamic nucleus 14 and brainstem structure 178 are left out on purpose
+    structures = {'thalamus_nuclei': list(range(1, 14)),
+                  'brainstem_structures': [173, 174, 175],
+                  'lh_hippocampal_subfields': [203, 204, 205, 206, 208, 209, 210, 211, 212, 214, 215, 226],
+                  'rh_hippocampal_subfields': [203, 204, 205, 206]}
+    for name, labels in sorted(structures.items()):
+        fname = op.join(base_dir, '{}.nii.gz'.format(name))
+        ni.save(ni.Nifti1Image(_random_labels(rng, shape, labels, 0.1), affine), fname)
+        files[name] = fname
+    
+    return subjects_dir, files
+
+
+def _combine_digest(parcellation, base_dir, subjects_dir, files, flags):
+    """ Run CombineParcellations with the structures enabled by flags and return a digest of its outputs """
+    import nibabel as ni
+    
+    thalamus, brainstem, lh_subfields, rh_subfields = flags
+    inputs = {'input_rois': files['input_rois']}
+    for name, enabled in [('thalamus_nuclei', thalamus), ('brainstem_structures', brainstem),
+                          ('lh_hippocampal_subfields', lh_subfields), ('rh_hippocampal_subfields', rh_subfields)]:
+        if enabled:
+            inputs[name] = files[name]
+    
+    combiner = parcellation.CombineParcellations(subjects_dir=subjects_dir, subject_id='sub', create_colorLUT=True,
+                                                 create_graphml=True, verbose_level=1, **inputs)
+    out_dir = op.join(base_dir, 'out_{}'.format('_'.join(str(int(flag)) for flag in flags)))
+    os.makedirs(out_dir)
+    cwd = os.getcwd()
+    os.chdir(out_dir)
+    try:
+        combiner._run_interface(None)
+    finally:
+        os.chdir(cwd)
+    
+    h = hashlib.sha1()
+    for scale in SCALES:
+        prefix = op.join(out_dir, 'ROIv_Lausanne2018_{}'.format(scale))
+        h.update(np.ascontiguousarray(ni.load(prefix + '_final.nii.gz').get_data(), dtype=np.int16).tobytes())
+        # the first colorLUT line holds the creation time
+        h.update(''.join(open(prefix + '_FreeSurferColorLUT.txt').readlines()[1:]).encode('utf-8'))
+        h.update(open(prefix + '.graphml').read().encode('utf-8'))
+    return h.hexdigest()
+
+
+@pytest.mark.parametrize('flags', sorted(REFERENCE_DIGESTS))
+def test_combine_parcellations_reference(tmpdir, monkeypatch, flags):
+    """ The relabelling of the parcellations matches the painting implementation for all the structure combinations """
+    pytest.importorskip('nipype')
+    pytest.importorskip('scipy')
+    from cmtklib import parcellation
+    
+    monkeypatch.setattr(parcellation, 'subprocess', _FakeCommands)
+    base_dir = str(tmpdir)
+    subjects_dir, files = _make_subject(base_dir)
+    assert _combine_digest(parcellation, base_dir, subjects_dir, files, flags) == REFERENCE_DIGESTS[flags]
+
+
+def _paint(sources, rules):
+    """ Paint the rules one after the other, as the former implementation did, and return the highest labels """
+    painted = np.zeros(sources[rules[0][0]].shape, dtype=np.int16)
+    nlabels = []
+    for source, old_labels, new_labels in rules:
+        volume = sources[source]
+        for old, new in zip(old_labels, new_labels):
+            painted[volume == old] = new
+        nlabels.append(painted.max())
+    return painted, nlabels
+
+
+def test_label_table_overwritten_highest_label():
+    """ nlabel follows the relabelled volume when rules overwrite some or all the voxels of the highest label """
+    pytest.importorskip('nipype')
+    from cmtklib.parcellation import LabelTable
+    
+    sources = {'roi': np.array([[1, 1, 2, 2], [3, 3, 0, 0]]),
+               'thalamus': np.array([[0, 0, 0, 7], [0, 0, 0, 0]]),
+               'brainstem': np.array([[0, 0, 9, 0], [0, 0, 0, 0]])}
+    rules = [('roi', [1, 2, 3], [1, 6, 2]),
+             ('thalamus', [7], [3]),  # overwrites some voxels of label 6
+             ('brainstem', [5], [8]),  # absent from the source
+             ('brainstem', [9], [4]),  # overwrites the last voxels of label 6
+             ('roi', [3], [5])]
+    
+    expected, expected_nlabels = _paint(sources, rules)
+    table = LabelTable(sources)
+    nlabels = []
+    for source, old_labels, new_labels in rules:
+        table.add_rule(source, old_labels, new_labels)
+        nlabels.append(table.nlabel)
+        assert table.nlabel == table.relabel().max()
+    assert nlabels == expected_nlabels == [6, 6, 6, 4, 5]
+    assert np.array_equal(table.relabel(), expected)
+
+
+def test_label_table_increasing_labels():
+    """ Rules painting above the highest label give the relabelled volume of the painting implementation """
+    pytest.importorskip('nipype')
+    from cmtklib.parcellation import LabelTable
+    
+    rng = np.random.RandomState(0)
+    sources = {'roi': rng.randint(0, 10, (8, 8, 8)), 'thalamus': rng.randint(0, 4, (8, 8, 8))}
+    rules = [('roi', range(10), range(10)),
+             ('thalamus', [1, 2, 3], [10, 11, 12]),
+             ('roi', [4, 20], [13, 14]),
+             ('thalamus', [2], [15])]
+    
+    expected, expected_nlabels = _paint(sources, rules)
+    table = LabelTable(sources)
+    for (source, old_labels, new_labels), nlabel in zip(rules, expected_nlabels):
+        table.add_rule(source, old_labels, new_labels)
+        assert table.nlabel == nlabel
+    assert np.array_equal(table.relabel(), expected)
+
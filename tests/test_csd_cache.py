@@ -0,0 +1,74 @@
+import os
+from glob import glob
+from os import path as op
+
+import numpy as np
+import pytest
+
+
+def _make_dataset(base_dir):
+    """ Write a small synthetic two-fiber DWI dataset with its gradients, response, FA and mask """
+    import nibabel as nb
+    from dipy.core.gradients import gradient_table
+    from dipy.data import get_sphere
+    from dipy.sims.voxel import multi_tensor
+    
+    directions = get_sphere('repulsion100').vertices
+    bvals = np.concatenate([np.zeros(3), 1000. * np.ones(len(directions))])
+    bvecs = np.concatenate([np.zeros((3, 3)), directions])
+    gtab = gradient_table(bvals, bvecs)
+    
+    mevals = np.array([[0.0015, 0.0003, 0.0003], [0.0015, 0.0003, 0.0003]])
+    signal, _ = multi_tensor(gtab, mevals, S0=100, angles=[(0, 0), (60, 0)], fractions=[50, 50], snr=None)
+    shape = (6, 6, 6)
+    data = np.tile(signal, shape + (1,)).astype(np.float32)
+    affine = np.eye(4)
+    
+    files = {'in_file': op.join(base_dir, 'dwi.nii.gz'),
+             'in_bval': op.join(base_dir, 'dwi.bval'),
+             'in_bvec': op.join(base_dir, 'dwi.bvec'),
+             'response': op.join(base_dir, 'response.txt'),
+             'in_fa': op.join(base_dir, 'fa.nii.gz'),
+             'mask': op.join(base_dir, 'mask.nii.gz')}
+    nb.Nifti1Image(data, affine).to_filename(files['in_file'])
+    np.savetxt(files['in_bval'], bvals[np.newaxis], fmt='%g')
+    np.savetxt(files['in_bvec'], bvecs.T, fmt='%.6f')
+    np.savetxt(files['response'], [0.0015, 0.0003, 0.0003, 100])
+    nb.Nifti1Image(0.5 * np.ones(shape, dtype=np.float32), affine).to_filename(files['in_fa'])
+    nb.Nifti1Image(np.ones(shape, dtype=np.uint8), affine).to_filename(files['mask'])
+    return files
+
+
+def test_csd_cache_tracking_order(tmpdir):
+    """ Tracking at another SH order than the reconstruction must not reuse its cached coefficients """
+    pytest.importorskip('dipy')
+    pytest.importorskip('dipy.viz')
+    pytest.importorskip('nipype')
+    from cmtklib.interfaces.dipy import CSD, DirectionGetterTractography
+    
+    base_dir = str(tmpdir)
+    cache_dir = op.join(base_dir, 'csd_cache')
+    files = _make_dataset(base_dir)
+    
+    cwd = os.getcwd()
+    os.chdir(base_dir)
+    try:
+        csd = CSD(in_file=files['in_file'], in_bval=files['in_bval'], in_bvec=files['in_bvec'],
+                  in_mask=files['mask'], response=files['response'], cache_dir=cache_dir)
+        res = csd.run()
+        
+        recon_cache = glob(op.join(cache_dir, '*_shm_coeff.npy'))
+        assert len(recon_cache) == 1
+        assert np.load(recon_cache[0], mmap_mode='r').shape[-1] == 45
+        
+        tracking = DirectionGetterTractography(in_file=files['in_file'], in_fa=files['in_fa'],
+                                               in_model=res.outputs.model, tracking_mask=files['mask'],
+                                               seed_mask=[files['mask']], recon_model='CSD', recon_order=6,
+                                               num_seeds=10, random_seed=0, cache_dir=cache_dir)
+        tracking.run()
+    finally:
+        os.chdir(cwd)
+    
+    # the tracking fitted its own order 6 coefficients (28 per voxel) next to the order 8 ones
+    n_coeffs = sorted(np.load(f, mmap_mode='r').shape[-1] for f in glob(op.join(cache_dir, '*_shm_coeff.npy')))
+    assert n_coeffs == [28, 45]